@@ -57,10 +57,14 @@ DEFAULT_PARAMS = {
     '__version__': FREEZER_VERSION,
     'access_key': '',
     'action': 'backup',
+    'adaptive_compression': False,
     'always_level': False,
     'backup_name': "freezer_{mode}_{resource_id}",
+    'change_log': None,
     'command': None,
     'compression': 'gzip',
+    'compression_level': None,
+    'compression_threads': 0,
     'consistency_check': False,
     'consistency_checksum': None,
     'cindernative_backup_id': None,
@@ -73,6 +77,9 @@ DEFAULT_PARAMS = {
     'config': None,
     'container': 'freezer_backups',
     'dereference_symlink': None,
+    'dir_change_tracking': False,
+    'download_buffer_size': 134217728,
+    'download_concurrency': 4,
     'download_limit': -1,
     'dry_run': False,
     'encrypt_pass_file': None,
@@ -114,13 +121,20 @@ DEFAULT_PARAMS = {
     'project_id': None,
     'os_trust_id': None,
     'proxy': None,
+    'queue_max_bytes': 0,
     'quiet': False,
     'remove_from_date': None,
     'remove_older_than': None,
     'restore_abs_path': None,
     'restart_always_level': False,
     'restore_from_date': None,
+    'restore_prefetch_depth': 0,
+    'restore_spill_dir': None,
+    'restore_workers': 4,
     'rsync_block_size': 4096,
+    'rsync_workers': 1,
+    's3_max_pool_connections': 0,
+    'scan_workers': 4,
     'secret_key': '',
     'snapshot': None,
     'shadow': '',
@@ -135,6 +149,8 @@ DEFAULT_PARAMS = {
     'sync': True,
     'temp_resource_prefix': 'freezer_',
     'timeout': 120,
+    'upload_buffer_size': 134217728,
+    'upload_concurrency': 4,
     'upload_limit': -1,
     'version': None,
     'volume': None,
@@ -361,11 +377,53 @@ _COMMON = [
                help="Set the maximum file chunk size in bytes to upload to "
                     "swift. Default 33554432 bytes (32MB)"
                ),
+    cfg.IntOpt('queue-max-bytes',
+               default=DEFAULT_PARAMS['queue_max_bytes'],
+               dest='queue_max_bytes',
+               min=0,
+               help="Maximum number of bytes queued between the backup "
+                    "engine and the storage, and between a multiple "
+                    "storage and each of its storages, on top of the "
+                    "maximum number of queued segments. A segment bigger "
+                    "than this is still queued alone. Default 0 (no "
+                    "limit)."
+               ),
     cfg.IntOpt('rsync-block-size',
                default=DEFAULT_PARAMS['rsync_block_size'],
                dest='rsync_block_size',
                help="Set the data block size of used by rsync to "
                     "generate signature. Default 4096 bytes (4K)."),
+    cfg.IntOpt('rsync-workers',
+               dest='rsync_workers',
+               default=DEFAULT_PARAMS['rsync_workers'],
+               min=0,
+               help="Number of processes computing the deltas and the "
+                    "signatures of the modified files with the rsyncv2 "
+                    "engine. 0 starts one process per CPU. Default 1 (the "
+                    "backup process computes them itself)."),
+    cfg.IntOpt('scan-workers',
+               dest='scan_workers',
+               default=DEFAULT_PARAMS['scan_workers'],
+               min=1,
+               help="Number of threads listing the directories of the "
+                    "backup path with the rsync and rsyncv2 engines. More "
+                    "threads hide the latency of network file systems. "
+                    "Default 4."),
+    cfg.BoolOpt('dir-change-tracking',
+                dest='dir_change_tracking',
+                default=DEFAULT_PARAMS['dir_change_tracking'],
+                help="With the rsyncv2 engine, do not list again the "
+                     "directories whose mtime and ctime did not change since "
+                     "the previous backup. Their files are considered "
+                     "unchanged unless reported by --change-log, which is "
+                     "required. Default False."),
+    cfg.StrOpt('change-log',
+               dest='change_log',
+               default=DEFAULT_PARAMS['change_log'],
+               help="Change log of the backup path written by "
+                    "freezer-changelog, read by the rsyncv2 engine with "
+                    "--dir-change-tracking to find the files changed since "
+                    "the previous backup."),
     cfg.StrOpt('restore-abs-path',
                dest='restore_abs_path',
                default=DEFAULT_PARAMS['restore_abs_path'],
@@ -389,6 +447,32 @@ _COMMON = [
                     "i.e. '1979-10-03T23:23:23'. Make sure the 'T' is between "
                     "date and time Default None."
                ),
+    cfg.IntOpt('restore-prefetch-depth',
+               dest='restore_prefetch_depth',
+               default=DEFAULT_PARAMS['restore_prefetch_depth'],
+               min=0,
+               help="Number of incremental levels downloaded ahead of the "
+                    "level being restored, so that download and restore "
+                    "overlap. Prefetched levels are kept in memory up to "
+                    "64MB each, then in --restore-spill-dir. Default 0 "
+                    "(no prefetch)."
+               ),
+    cfg.StrOpt('restore-spill-dir',
+               dest='restore_spill_dir',
+               default=DEFAULT_PARAMS['restore_spill_dir'],
+               help="Directory holding the prefetched levels of a restore. "
+                    "Default the system temporary directory."
+               ),
+    cfg.IntOpt('restore-workers',
+               dest='restore_workers',
+               default=DEFAULT_PARAMS['restore_workers'],
+               min=1,
+               help="Number of threads writing the small files and setting "
+                    "the owner, mode and times of the files restored by the "
+                    "rsyncv2 engine, while the backup data is read. More "
+                    "threads hide the latency of the file system calls. "
+                    "Default 4."
+               ),
     cfg.StrOpt('max-priority',
                dest='max_priority',
                default=DEFAULT_PARAMS['max_priority'],
@@ -431,6 +515,39 @@ _COMMON = [
                default=DEFAULT_PARAMS['upload_limit'],
                help="Upload bandwidth limit in Bytes per sec. "
                     "Can be invoked with dimensions (10K, 120M, 10G)."),
+    cfg.IntOpt('upload-concurrency',
+               dest='upload_concurrency',
+               default=DEFAULT_PARAMS['upload_concurrency'],
+               min=1,
+               help="Number of backup segments (swift) or multipart upload "
+                    "parts (s3) uploaded in parallel to object storages. "
+                    "Default {0}.".format(
+                   DEFAULT_PARAMS['upload_concurrency'])),
+    cfg.IntOpt('upload-buffer-size',
+               dest='upload_buffer_size',
+               default=DEFAULT_PARAMS['upload_buffer_size'],
+               min=0,
+               help="Maximum amount of data in bytes held in memory by "
+                    "segments waiting to be or being uploaded in parallel. "
+                    "0 means limited only by --upload-concurrency. "
+                    "Default 134217728 bytes (128MB)."),
+    cfg.IntOpt('download-concurrency',
+               dest='download_concurrency',
+               default=DEFAULT_PARAMS['download_concurrency'],
+               min=1,
+               help="Number of segments (swift) or byte ranges (s3) "
+                    "downloaded in parallel from object storages on "
+                    "restore. 1 downloads the backup as a single stream. "
+                    "Default {0}.".format(
+                   DEFAULT_PARAMS['download_concurrency'])),
+    cfg.IntOpt('download-buffer-size',
+               dest='download_buffer_size',
+               default=DEFAULT_PARAMS['download_buffer_size'],
+               min=0,
+               help="Maximum amount of data in bytes downloaded ahead of "
+                    "the restore and held in memory. 0 means limited only "
+                    "by --download-concurrency. "
+                    "Default 134217728 bytes (128MB)."),
     cfg.IntOpt('download-limit',
                dest='download_limit',
                default=DEFAULT_PARAMS['download_limit'],
@@ -526,9 +643,40 @@ _COMMON = [
     cfg.StrOpt('compression',
                dest='compression',
                default=DEFAULT_PARAMS['compression'],
-               choices=['gzip', 'bzip2', 'xz'],
-               help="Compression algorithm to use. Gzip is default algorithm"
+               choices=['gzip', 'bzip2', 'xz', 'zstd', 'lz4'],
+               help="Compression algorithm to use. Gzip is default "
+                    "algorithm. zstd and lz4 need the zstandard and lz4 "
+                    "python modules, and the zstd and lz4 executables with "
+                    "the tar engine."
+               ),
+    cfg.IntOpt('compression-level',
+               dest='compression_level',
+               default=DEFAULT_PARAMS['compression_level'],
+               help="Compression level of the rsync and rsyncv2 engines, "
+                    "from 1 (fastest) to 9 with gzip and bzip2, 0 to 9 with "
+                    "xz, 1 to 22 with zstd and 0 to 16 with lz4. Default 9 "
+                    "with gzip and bzip2, 6 with xz, 3 with zstd and 0 with "
+                    "lz4."
                ),
+    cfg.IntOpt('compression-threads',
+               dest='compression_threads',
+               default=DEFAULT_PARAMS['compression_threads'],
+               min=0,
+               help="Number of threads compressing the backup data of the "
+                    "rsync and rsyncv2 engines by frames of 1 MiB, and "
+                    "decompressing the frames on restore. Default 0 (the "
+                    "data is compressed as a single stream by the engine "
+                    "thread)."
+               ),
+    cfg.BoolOpt('adaptive-compression',
+                dest='adaptive_compression',
+                default=DEFAULT_PARAMS['adaptive_compression'],
+                help="Compress the backup data of the rsync and rsyncv2 "
+                     "engines by blocks of 1 MiB, storing uncompressed the "
+                     "blocks whose samples do not compress, like media "
+                     "files, compressed archives or encrypted data. Saves "
+                     "the time spent compressing them. Default False."
+                ),
     cfg.StrOpt('storage',
                dest='storage',
                default=DEFAULT_PARAMS['storage'],
@@ -554,6 +702,15 @@ _COMMON = [
                default=DEFAULT_PARAMS['endpoint'],
                help="Endpoint of S3 compatible storage"
                ),
+    cfg.IntOpt('s3-max-pool-connections',
+               dest='s3_max_pool_connections',
+               default=DEFAULT_PARAMS['s3_max_pool_connections'],
+               min=0,
+               help="Maximum number of HTTP connections kept open by the "
+                    "S3 client. 0 sizes the pool to the largest of "
+                    "--upload-concurrency and --download-concurrency, with "
+                    "a minimum of 10. Default 0."
+               ),
     cfg.StrOpt('ssh-key',
                dest='ssh_key',
                default=DEFAULT_PARAMS['ssh_key'],
@@ -14,10 +14,12 @@
 
 
 import abc
+import collections
+from concurrent import futures
 import multiprocessing
 import shutil
 import tempfile
-import time
+import threading
 
 from oslo_log import log
 from oslo_serialization import jsonutils as json
@@ -33,6 +35,53 @@ from multiprocessing import SimpleQueue
 
 LOG = log.getLogger(__name__)
 
+# Bytes of every prefetched restore level kept in memory, the rest of the
+# level is written to the spill directory
+PREFETCH_MEMORY_SIZE = 64 * 1024 * 1024
+
+
+class LevelPipe(object):
+    """
+    Read end of the restore pipe limited to the data of a single level.
+
+    read_blocks sends an empty message after the last chunk of every level.
+    recv_bytes() raises EOFError there, as a closed pipe does, so the
+    restore_level implementations read a level the way they always did.
+    """
+
+    def __init__(self, pipe):
+        """
+        :type pipe: multiprocessing.connection.Connection
+        """
+        self.pipe = pipe
+        self.finished = False
+        # the pipe was closed before the end of the level
+        self.closed = False
+
+    def recv_bytes(self):
+        if self.finished:
+            raise EOFError()
+        try:
+            data = self.pipe.recv_bytes()
+        except EOFError:
+            self.finished = self.closed = True
+            raise
+        if not data:
+            self.finished = True
+            raise EOFError()
+        return data
+
+    def drain(self):
+        """Discard the data of the level not read by the engine."""
+        while not self.finished:
+            try:
+                self.recv_bytes()
+            except EOFError:
+                pass
+
+    def close(self):
+        pass
+
 
 class BackupEngine(metaclass=abc.ABCMeta):
     """
@@ -57,7 +106,7 @@ class BackupEngine(metaclass=abc.ABCMeta):
           Storage write_backup is consumer of data, it creates a thread
           that store data in storage.
           Both streams communicate in non-blocking mode
-       3) invoke post_backup - now it uploads metadata file
+       3) upload the metadata file and invoke post_backup
 
     2) restore backup
 
@@ -73,13 +122,23 @@ class BackupEngine(metaclass=abc.ABCMeta):
     :type storage: freezer.storage.base.Storage
     """
 
-    def __init__(self, storage):
+    def __init__(self, storage, **kwargs):
         """
         :type storage: freezer.storage.base.Storage
         :param storage:
+        :param restore_prefetch_depth: number of levels downloaded ahead of
+                                       the level being restored
+        :param restore_spill_dir: directory holding the prefetched levels,
+                                  system temporary directory if not set
+        :param queue_max_bytes: maximum number of bytes queued between the
+                                backup stream and the storage, no limit if
+                                not set
         :return:
         """
         self.storage = storage
+        self.queue_max_bytes = kwargs.get('queue_max_bytes') or None
+        self.restore_prefetch_depth = kwargs.get('restore_prefetch_depth') or 0
+        self.restore_spill_dir = kwargs.get('restore_spill_dir')
 
     @property
     @abc.abstractmethod
@@ -140,7 +199,8 @@ class BackupEngine(metaclass=abc.ABCMeta):
                 level=(prev_backup.level + 1 if prev_backup else 0)
             )
 
-            input_queue = streaming.RichQueue(queue_size)
+            input_queue = streaming.RichQueue(queue_size,
+                                              self.queue_max_bytes)
             read_except_queue = queue.Queue()
             write_except_queue = queue.Queue()
 
@@ -164,6 +224,13 @@ class BackupEngine(metaclass=abc.ABCMeta):
             read_stream.join()
             write_stream.join()
 
+            stats = input_queue.stats()
+            LOG.info('Backup stream: {0} bytes in {1} messages, the engine '
+                     'waited {2:.2f}s for the storage and the storage '
+                     'waited {3:.2f}s for the engine'.format(
+                         stats['bytes'], stats['messages'],
+                         stats['put_wait_time'], stats['get_wait_time']))
+
             # queue handling is different from SimpleQueue handling.
             def handle_except_queue(except_queue):
                 if not except_queue.empty():
@@ -188,36 +255,139 @@ class BackupEngine(metaclass=abc.ABCMeta):
                 b_file.write(
                     json.dumps(self.metadata(backup_resource)).encode())
             self.storage.put_metadata(engine_meta, freezer_meta, backup)
+            self.post_backup(backup_resource)
         finally:
             shutil.rmtree(tmpdir)
 
-    def read_blocks(self, backup, write_pipe, read_pipe, except_queue):
-        # Close the read pipe in this child as it is unneeded
-        # and download the objects from swift in chunks. The
-        # Chunk size is set by RESP_CHUNK_SIZE and sent to che write
-        # pipe
+    def post_backup(self, backup_resource):
+        """
+        Called once the backup data and metadata are stored, not called if
+        the backup failed.
 
-        try:
+        :param backup_resource:
+        """
+        pass
 
-            read_pipe.close()
-            for block in backup.storage.backup_blocks(backup):
-                write_pipe.send_bytes(block)
+    def read_blocks(self, backups, write_pipe, read_pipe, except_queue):
+        # Close the read pipe in this child as it is unneeded and download
+        # the objects of every level in chunks. The chunk size is set by
+        # the storage. An empty message is sent to the write pipe after
+        # the last chunk of each level.
 
-            # Closing the pipe after checking no data
-            # is still available in the pipe.
-            while True:
-                if not write_pipe.poll():
-                    write_pipe.close()
-                    break
-                time.sleep(1)
+        try:
+            read_pipe.close()
+            for blocks in self.levels_blocks(backups):
+                for block in blocks:
+                    # empty messages are reserved to the end of level marker
+                    if block:
+                        write_pipe.send_bytes(block)
+                write_pipe.send_bytes(b'')
+            write_pipe.close()
 
-        except IOError:
+        except BrokenPipeError:
+            # the restore process stopped reading and reports its own error
             pass
 
         except Exception as e:
             except_queue.put(e)
             raise
 
+    def levels_blocks(self, backups):
+        """
+        Generator of the blocks of every level, in order.
+
+        With a prefetch depth, the next levels are downloaded by background
+        threads while the blocks of the current one are consumed. Each
+        prefetched level is kept in memory up to PREFETCH_MEMORY_SIZE bytes
+        and spilled to restore_spill_dir beyond that.
+
+        :type backups: list[freezer.storage.base.Backup]
+        :return: generator of iterables of blocks, one per level
+        """
+        depth = self.restore_prefetch_depth
+        if not depth or len(backups) < 2:
+            for backup in backups:
+                yield backup.storage.backup_blocks(backup)
+            return
+
+        executor = futures.ThreadPoolExecutor(max_workers=depth)
+        # stops the prefetches already running when the restore ends,
+        # shutdown only cancels the ones not started yet
+        stop = threading.Event()
+        prefetches = collections.deque()
+        next_level = 1
+        try:
+            for index, backup in enumerate(backups):
+                if index:
+                    blocks = self._spilled_blocks(
+                        *prefetches.popleft().result())
+                else:
+                    blocks = backup.storage.backup_blocks(backup)
+                while (next_level < len(backups) and
+                       next_level <= index + depth):
+                    prefetches.append(executor.submit(
+                        self._prefetch_level, backups[next_level], stop))
+                    next_level += 1
+                yield blocks
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _prefetch_level(self, backup, stop):
+        """
+        Download all the blocks of a level in a spill file.
+
+        :type backup: freezer.storage.base.Backup
+        :type stop: threading.Event
+        :return: the spill file and the size of every block, the blocks
+                 boundaries are kept as they may matter for decryption
+        """
+        LOG.info("Prefetching level {0}".format(backup.level))
+        spill = tempfile.SpooledTemporaryFile(
+            max_size=PREFETCH_MEMORY_SIZE, dir=self.restore_spill_dir)
+        sizes = []
+        try:
+            for block in backup.storage.backup_blocks(backup):
+                if stop.is_set():
+                    raise engine_exceptions.EngineException(
+                        "Prefetch of level {0} stopped".format(backup.level))
+                if block:
+                    spill.write(block)
+                    sizes.append(len(block))
+            spill.seek(0)
+        except Exception:
+            spill.close()
+            raise
+        return spill, sizes
+
+    @staticmethod
+    def _spilled_blocks(spill, sizes):
+        with spill:
+            for size in sizes:
+                yield spill.read(size)
+
+    def restore_levels(self, restore_resource, read_pipe, backups,
+                       except_queue):
+        """
+        Restore every level, in order, from the data sent by read_blocks.
+
+        :param restore_resource:
+        :param read_pipe: read end of the pipe shared by all the levels
+        :type backups: list[freezer.storage.base.Backup]
+        :param except_queue:
+        """
+        for backup in backups:
+            LOG.info("Restoring from level {0}".format(backup.level))
+            level_pipe = LevelPipe(read_pipe)
+            self.restore_level(restore_resource, level_pipe, backup,
+                               except_queue)
+            level_pipe.drain()
+            if level_pipe.closed:
+                # the process exit code reports the failure
+                raise engine_exceptions.EngineException(
+                    "Restore data of level {0} is truncated".format(
+                        backup.level))
+
     def restore(self, hostname_backup_name, restore_resource,
                 overwrite,
                 recent_to_date,
@@ -248,58 +418,54 @@ class BackupEngine(metaclass=abc.ABCMeta):
             recent_to_date=recent_to_date)
 
         max_level = max(backups.keys())
+        backups = [backups[level] for level in range(0, max_level + 1)]
 
-        # Use SimpleQueue because Queue does not work on Mac OS X.
+        # A single reader process downloads the levels one after the other
+        # and a single process restores them, both live for the whole
+        # restore. Use SimpleQueue because Queue does not work on Mac OS X.
         read_except_queue = SimpleQueue()
+        write_except_queue = SimpleQueue()
         LOG.info("Restoring backup {0}".format(hostname_backup_name))
-        for level in range(0, max_level + 1):
-            LOG.info("Restoring from level {0}".format(level))
-            backup = backups[level]
-            read_pipe, write_pipe = multiprocessing.Pipe()
-            process_stream = multiprocessing.Process(
-                target=self.read_blocks,
-                args=(backup, write_pipe, read_pipe, read_except_queue))
-
-            process_stream.daemon = True
-            process_stream.start()
-            write_pipe.close()
-
-            # Start the tar pipe consumer process
-
-            # Use SimpleQueue because Queue does not work on Mac OS X.
-            write_except_queue = SimpleQueue()
-
-            engine_stream = multiprocessing.Process(
-                target=self.restore_level,
-                args=(restore_resource, read_pipe, backup, write_except_queue))
-
-            engine_stream.daemon = True
-            engine_stream.start()
-
-            read_pipe.close()
-            write_pipe.close()
-            process_stream.join()
-            engine_stream.join()
-
-            # SimpleQueue handling is different from queue handling.
-            def handle_except_SimpleQueue(except_queue):
-                if not except_queue.empty():
-                    while not except_queue.empty():
-                        e = except_queue.get()
-                        LOG.exception('Engine error: {0}'.format(e))
-                    return True
-                else:
-                    return False
-
-            got_exception = None
-            got_exception = (handle_except_SimpleQueue(read_except_queue) or
-                             got_exception)
-            got_exception = (handle_except_SimpleQueue(write_except_queue) or
-                             got_exception)
-
-            if engine_stream.exitcode or got_exception:
-                raise engine_exceptions.EngineException(
-                    "Engine error. Failed to restore.")
+        read_pipe, write_pipe = multiprocessing.Pipe()
+        process_stream = multiprocessing.Process(
+            target=self.read_blocks,
+            args=(backups, write_pipe, read_pipe, read_except_queue))
+
+        process_stream.daemon = True
+        process_stream.start()
+        write_pipe.close()
+
+        engine_stream = multiprocessing.Process(
+            target=self.restore_levels,
+            args=(restore_resource, read_pipe, backups, write_except_queue))
+
+        engine_stream.daemon = True
+        engine_stream.start()
+
+        read_pipe.close()
+        engine_stream.join()
+        process_stream.join()
+
+        # SimpleQueue handling is different from queue handling.
+        def handle_except_SimpleQueue(except_queue):
+            if not except_queue.empty():
+                while not except_queue.empty():
+                    e = except_queue.get()
+                    LOG.exception('Engine error: {0}'.format(e))
+                return True
+            else:
+                return False
+
+        got_exception = None
+        got_exception = (handle_except_SimpleQueue(read_except_queue) or
+                         got_exception)
+        got_exception = (handle_except_SimpleQueue(write_except_queue) or
+                         got_exception)
+
+        if (engine_stream.exitcode or process_stream.exitcode or
+                got_exception):
+            raise engine_exceptions.EngineException(
+                "Engine error. Failed to restore.")
 
         LOG.info(
             'Restore completed successfully for backup name '
@@ -34,7 +34,7 @@ CONF = cfg.CONF
 class GlanceEngine(engine.BackupEngine):
 
     def __init__(self, storage, **kwargs):
-        super(GlanceEngine, self).__init__(storage=storage)
+        super(GlanceEngine, self).__init__(storage=storage, **kwargs)
         self.client = client_manager.get_client_manager(CONF)
         self.glance = self.client.create_glance()
         self.encrypt_pass_file = kwargs.get('encrypt_key')
@@ -34,7 +34,7 @@ CONF = cfg.CONF
 class NovaEngine(engine.BackupEngine):
 
     def __init__(self, storage, **kwargs):
-        super(NovaEngine, self).__init__(storage=storage)
+        super(NovaEngine, self).__init__(storage=storage, **kwargs)
         self.client = client_manager.get_client_manager(CONF)
         self.nova = self.client.create_nova()
         self.glance = self.client.create_glance()
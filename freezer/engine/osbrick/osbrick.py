@@ -35,7 +35,7 @@ CONF = cfg.CONF
 
 class OsbrickEngine(engine.BackupEngine):
     def __init__(self, storage, **kwargs):
-        super(OsbrickEngine, self).__init__(storage=storage)
+        super(OsbrickEngine, self).__init__(storage=storage, **kwargs)
         self.client = client_manager.get_client_manager(CONF)
         self.cinder = self.client.create_cinder()
         self.volume_info = None
@@ -24,13 +24,17 @@ Technical Report TR-CS-96-05, Canberra 0200 ACT, Australia, 1996.
 https://samba.anu.edu.au/rsync/.
 """
 
-import collections
+import bisect
 import hashlib
+import itertools
 
 
 __all__ = ["rollingchecksum", "weakchecksum", "rsyncdelta",
            "blockchecksums"]
 
+# Size of the reads of the data stream by rsyncdelta
+READ_BUFFER_SIZE = 1024 * 1024
+
 
 def rollingchecksum(removed, new, a, b, blocksize=4096):
     """
@@ -47,11 +51,10 @@ def weakchecksum(data):
     """
     Generates a weak checksum from an iterable set of bytes.
     """
-    a = b = 0
-    le = len(data)
-    for i in range(le):
-        a += data[i]
-        b += (le - i) * data[i]
+    # b is the sum of (len(data) - i) * data[i], that is the sum of the
+    # prefix sums of data
+    a = sum(data)
+    b = sum(itertools.accumulate(data))
 
     return (b << 16) | a, a, b
 
@@ -67,85 +70,144 @@ def blockchecksums(instream, blocksize=4096):
     read = instream.read(blocksize)
 
     while read:
-        weakhashes.append(weakchecksum(bytes(read))[0])
+        weakhashes.append(weakchecksum(read)[0])
         stronghashes.append(hashlib.sha1(read).hexdigest())
         read = instream.read(blocksize)
 
     return weakhashes, stronghashes
 
 
+def _index(hashes):
+    """
+    :return: dict of every hash to the sorted list of its positions
+    """
+    index = {}
+    for position, value in enumerate(hashes):
+        index.setdefault(value, []).append(position)
+    return index
+
+
+def _find(index, value, start):
+    """
+    :return: first position of value at or after start, as list.index,
+             None if there is none
+    """
+    positions = index.get(value)
+    if positions:
+        found = bisect.bisect_left(positions, start)
+        if found < len(positions):
+            return positions[found]
+    return None
+
+
 def rsyncdelta(datastream, remotesignatures, blocksize=4096):
     """
     Generates a binary patch when supplied with the weak and strong
     hashes from an unpatched target and a readable stream for the
     up-to-date data. The blocksize must be the same as the value
     used to generate remotesignatures.
+
+    The stream is read by READ_BUFFER_SIZE and the window is a slice of
+    the buffer. The hashes are looked up in dicts of their positions
+    instead of scanning the signature lists for every byte.
     """
 
     remote_weak, remote_strong = remotesignatures
+    weak_index = _index(remote_weak)
+    strong_index = _index(remote_strong)
+
+    data = bytearray()
+    # The window is data[start:end], the bytes not matched since the last
+    # yield are data[literal:start]
+    literal = start = end = 0
+    eof = False
 
     match = True
     matchblock = -1
-    last_byte = []
     tailsize = 0
     while True:
-        if match and datastream is not None:
+        if match and not eof:
             # Whenever there is a match or the loop is running for the first
             # time, populate the window using weakchecksum instead of rolling
             # through every single byte which takes at least twice as long.
-            window = collections.deque(bytes(datastream.read(blocksize)))
-            checksum, a, b = weakchecksum(window)
-
-        try:
-            # If there are two identical weak checksums in a file, and the
-            # matching strong hash does not occur at the first match, it will
-            # be missed and the data sent over. May fix eventually, but this
-            # problem arises very rarely.
-            matchblock = remote_weak.index(
-                checksum, matchblock + 1)  # pylint: disable=E0606
-            stronghash = hashlib.sha1(bytes(window)).hexdigest()
-            matchblock = remote_strong.index(stronghash, matchblock)
-
+            if end > READ_BUFFER_SIZE:
+                del data[:end]
+                end = 0
+            literal = start = end
+            while len(data) < start + blocksize:
+                read = datastream.read(READ_BUFFER_SIZE)
+                if not read:
+                    break
+                data += read
+            end = min(len(data), start + blocksize)
+            checksum, a, b = weakchecksum(data[start:end])
+
+        # If there are two identical weak checksums in a file, and the
+        # matching strong hash does not occur at the first match, it will
+        # be missed and the data sent over. May fix eventually, but this
+        # problem arises very rarely.
+        found = _find(weak_index, checksum, matchblock + 1)
+        if found is not None:
+            matchblock = found
+            found = _find(strong_index,
+                          hashlib.sha1(data[start:end]).hexdigest(),
+                          matchblock)
+        if found is not None:
+            matchblock = found
             match = True
-            # print "MATCHBLOCK: {}".format(matchblock)
-            # print "MATCHBLOCK TYPE: {}".format(type(matchblock))
-            # print "LAST BYTE WHEN MATCH: {}".format(last_byte)
-            if last_byte:
-                yield bytes(last_byte)
-                last_byte = []
+            if start > literal:
+                yield bytes(data[literal:start])
             yield matchblock
-            if datastream.closed:
+            if eof:
                 break
             continue
 
-        except ValueError:
-            # The weakchecksum did not match
-            match = False
-            try:
-                if datastream:
-                    # Get the next byte and affix to the window
-                    newbyte = ord(datastream.read(1))
-                    window.append(newbyte)
-            except TypeError:
-                # No more data from the file; the window will slowly shrink.
-                # newbyte needs to be zero from here on to keep the checksum
-                # correct.
-                newbyte = 0
-                tailsize = datastream.tell() % blocksize
-                datastream = None
-
-            if datastream is None and len(window) <= tailsize:
-                # The likelihood that any blocks will match after this is
-                # nearly nil so call it quits.
-                yield bytes(window)
-                break
-
-            # Yank off the extra byte and calculate the new window checksum
-            oldbyte = window.popleft()
-            checksum, a, b = rollingchecksum(
-                oldbyte, newbyte, a, b, blocksize)  # pylint: disable=E0601
+        # The weakchecksum did not match
+        match = False
+        if not eof and end == len(data):
+            if literal > READ_BUFFER_SIZE:
+                del data[:literal]
+                start -= literal
+                end -= literal
+                literal = 0
+            data += datastream.read(READ_BUFFER_SIZE)
+
+        if not eof and end < len(data):
+            # Roll the window over the buffer until a weak checksum is
+            # known or a block of unmatched bytes is complete
+            data_end = len(data)
+            while end < data_end:
+                oldbyte = data[start]
+                a -= oldbyte - data[end]
+                b -= oldbyte * blocksize - a
+                start += 1
+                end += 1
+                checksum = (b << 16) | a
+                if start - literal == blocksize:
+                    yield bytes(data[literal:start])
+                    literal = start
+                if checksum in weak_index:
+                    break
+            continue
 
-            last_byte.append(oldbyte)
-            if len(last_byte) == blocksize:
-                yield bytes(last_byte)
-                last_byte = []
+        if not eof:
+            # No more data from the file; the window will slowly shrink.
+            # The new byte is zero from here on to keep the checksum
+            # correct.
+            tailsize = datastream.tell() % blocksize
+            eof = True
+
+        if end - start <= tailsize:
+            # The likelihood that any blocks will match after this is
+            # nearly nil so call it quits.
+            yield bytes(data[start:end])
+            break
+
+        # Yank off the extra byte and calculate the new window checksum
+        oldbyte = data[start]
+        start += 1
+        checksum, a, b = rollingchecksum(oldbyte, 0, a, b, blocksize)
+
+        if start - literal == blocksize:
+            yield bytes(data[literal:start])
+            literal = start
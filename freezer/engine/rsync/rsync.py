@@ -33,6 +33,8 @@ from freezer.engine import engine
 from freezer.engine.rsync import pyrsync
 from freezer.utils import compress
 from freezer.utils import crypt
+from freezer.utils import scanner
+from freezer.utils import streaming
 from freezer.utils import winutils
 
 LOG = log.getLogger(__name__)
@@ -61,10 +63,19 @@ class RsyncEngine(engine.BackupEngine):
         self.is_windows = winutils.is_windows()
         self.dry_run = dry_run
         self.max_segment_size = max_segment_size
+        self.scan_workers = kwargs.get('scan_workers', 1)
+        self.compression_level = kwargs.get('compression_level')
+        self.compression_threads = kwargs.get('compression_threads', 0)
+        self.adaptive_compression = kwargs.get('adaptive_compression', False)
+        # the backup data is compressed by frames, see
+        # compress.FrameCompressor
+        self.compression_frames = (self.adaptive_compression or
+                                   self.compression_threads > 0)
+        self.owner_names = scanner.OwnerNames()
         # Compression and encryption objects
         self.compressor = None
         self.cipher = None
-        super(RsyncEngine, self).__init__(storage=storage)
+        super(RsyncEngine, self).__init__(storage=storage, **kwargs)
 
     @property
     def name(self):
@@ -74,6 +85,7 @@ class RsyncEngine(engine.BackupEngine):
         return {
             "engine_name": self.name,
             "compression": self.compression_algo,
+            "compression_frames": self.compression_frames,
             # the encrypt_pass_file might be key content so we need to convert
             # to boolean
             "encryption": bool(self.encrypt_pass_file)
@@ -92,16 +104,22 @@ class RsyncEngine(engine.BackupEngine):
         LOG.info("Starting RSYNC engine backup data stream")
 
         file_read_limit = 0
-        data_chunk = b''
+        segment = streaming.SegmentAssembler()
         LOG.info(
             'Recursively archiving and compressing files from {}'.format(
                 os.getcwd()))
 
-        self.compressor = compress.Compressor(self.compression_algo)
+        if self.compression_frames:
+            self.compressor = compress.FrameCompressor(
+                self.compression_algo, self.compression_level,
+                self.compression_threads, self.adaptive_compression)
+        else:
+            self.compressor = compress.Compressor(
+                self.compression_algo, self.compression_level)
 
         if self.encrypt_pass_file:
             self.cipher = crypt.AESEncrypt(self.encrypt_pass_file)
-            data_chunk += self.cipher.generate_header()
+            segment.append(self.cipher.generate_header())
 
         rsync_queue = queue.Queue(maxsize=2)
 
@@ -121,14 +139,14 @@ class RsyncEngine(engine.BackupEngine):
             if len(file_block) == 0:
                 continue
 
-            data_chunk += file_block
+            segment.append(file_block)
             file_read_limit += len(file_block)
             if file_read_limit >= self.max_segment_size:
-                yield data_chunk
-                data_chunk = b''
+                yield segment.take()
                 file_read_limit = 0
 
         # Upload segments smaller then max_segment_size
+        data_chunk = segment.take()
         if len(data_chunk) < self.max_segment_size:
             yield data_chunk
 
@@ -159,6 +177,8 @@ class RsyncEngine(engine.BackupEngine):
 
             self.compression_algo = metadata.get('compression',
                                                  self.compression_algo)
+            self.compression_frames = metadata.get('compression_frames',
+                                                   False)
 
             if not os.path.exists(restore_resource):
                 raise ValueError(
@@ -170,7 +190,12 @@ class RsyncEngine(engine.BackupEngine):
 
             raw_data_chunk = read_pipe.recv_bytes()
 
-            self.compressor = compress.Decompressor(self.compression_algo)
+            if self.compression_frames:
+                self.compressor = compress.FrameDecompressor(
+                    self.compression_algo, self.compression_threads)
+            else:
+                self.compressor = compress.Decompressor(
+                    self.compression_algo)
 
             if self.encrypt_pass_file:
                 self.cipher = crypt.AESDecrypt(self.encrypt_pass_file,
@@ -597,22 +622,24 @@ class RsyncEngine(engine.BackupEngine):
 
         return data_chunk
 
-    def get_file_struct(self, fs_path, new_level=False):
+    def get_file_struct(self, fs_path, new_level=False, os_stat=None):
         """Generate file meta data from file abs path.
 
         Return the meta data as a dict structure and a binary string
 
         :param fs_path: file abs path
         :param new_level:
+        :param os_stat: lstat of the file if already known
         :return: file data structure
         """
 
         # Get file inode information, whether the file is a regular
         # file or a symbolic link
-        try:
-            os_stat = os.lstat(fs_path)
-        except (OSError, IOError) as error:
-            raise Exception('[*] Error on file stat: {}'.format(error))
+        if os_stat is None:
+            try:
+                os_stat = os.lstat(fs_path)
+            except (OSError, IOError) as error:
+                raise Exception('[*] Error on file stat: {}'.format(error))
 
         file_mode = os_stat.st_mode
         # Get file type. If file type is a link it returns also the
@@ -625,8 +652,8 @@ class RsyncEngine(engine.BackupEngine):
 
         ctime = int(os_stat.st_ctime)
         mtime = int(os_stat.st_mtime)
-        uname = pwd.getpwuid(os_stat.st_uid)[0]
-        gname = grp.getgrgid(os_stat.st_gid)[0]
+        uname = self.owner_names.user(os_stat.st_uid)
+        gname = self.owner_names.group(os_stat.st_gid)
 
         dev = os_stat.st_dev
         inumber = os_stat.st_ino
@@ -710,22 +737,28 @@ class RsyncEngine(engine.BackupEngine):
         write_queue.put(compr_block)
 
     def process_file(self, file_path, fs_path, files_meta,
-                     old_fs_meta_struct, write_queue):
+                     old_fs_meta_struct, write_queue, os_stat=None):
         rel_path = os.path.relpath(file_path, fs_path)
 
         new_level = True if self.get_old_file_meta(
             old_fs_meta_struct, rel_path) else False
 
         inode_dict_struct, inode_str_struct = self.get_file_struct(
-            rel_path, new_level)
+            rel_path, new_level, os_stat)
 
         if not inode_dict_struct:
             return
 
-        if os.path.isdir(file_path):
+        if os_stat is None:
+            is_dir = os.path.isdir(file_path)
+        else:
+            is_dir = stat.S_ISDIR(os_stat.st_mode)
+
+        if is_dir:
             files_meta['directories'][file_path] = inode_dict_struct
-            files_meta['meta']['backup_size_on_disk'] += os.path.getsize(
-                rel_path)
+            files_meta['meta']['backup_size_on_disk'] += (
+                os.path.getsize(rel_path) if os_stat is None
+                else os_stat.st_size)
             file_header = self.gen_file_header(rel_path, inode_str_struct)
 
             compressed_block = self.process_backup_data(file_header)
@@ -772,25 +805,26 @@ class RsyncEngine(engine.BackupEngine):
         if os.path.isdir(fs_path):
             # If given path is a directory, change cwd to path to backup
             os.chdir(fs_path)
-            for root, dirs, files in os.walk(fs_path):
+            for root, dirs, files in scanner.walk(fs_path,
+                                                  self.scan_workers):
                 self.process_file(root, fs_path, files_meta,
                                   old_fs_meta_struct, write_queue)
 
                 # Check if exclude is in filename. If it is, log the file
                 # exclusion and continue to the next iteration.
                 if self.exclude:
-                    files = [name for name in files if
-                             self.exclude not in name]
+                    files = [entry for entry in files if
+                             self.exclude not in entry.name]
                     if files:
                         LOG.warning(
                             ('Excluding file names matching with: '
                              '{}'.format(self.exclude)))
 
-                for name in files:
-                    file_path = os.path.join(root, name)
-                    self.process_file(file_path, fs_path,
+                for entry in files:
+                    self.process_file(entry.path, fs_path,
                                       files_meta, old_fs_meta_struct,
-                                      write_queue)
+                                      write_queue,
+                                      entry.stat(follow_symlinks=False))
         else:
             self.process_file(fs_path, os.getcwd(), files_meta,
                               old_fs_meta_struct, write_queue)
@@ -0,0 +1,317 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Log of the files changed between two rsyncv2 backups
+
+The change log is written by a long-running agent watching the backup path
+with inotify and read by the next backup. It holds one path per line,
+relative to the backup path. The backup requests the agent to write the
+changes it collected so far, moves the log aside and removes it once the
+backup is complete, so the changes logged for a backup that failed are read
+again by the next one.
+"""
+
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import select
+import shutil
+import struct
+import sys
+import time
+
+from oslo_config import cfg
+from oslo_log import log
+
+from freezer.utils import scanner
+
+LOG = log.getLogger(__name__)
+
+# A line of the change log meaning that any file may have changed, written
+# when the agent starts and when it lost events
+ALL_CHANGED = '.'
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR |
+              IN_DONT_FOLLOW)
+
+# struct inotify_event without its name
+_EVENT = struct.Struct('iIII')
+
+EVENTS_BUFFER_SIZE = 64 * 1024
+
+# Suffix of the file requesting the agent to write the change log, removed
+# once written
+FLUSH_REQUEST_SUFFIX = '.flush'
+# Seconds between two checks of a flush request by the agent
+FLUSH_POLL_INTERVAL = 0.1
+# Seconds a backup waits for the agent to write the change log
+FLUSH_TIMEOUT = 10
+
+
+@contextlib.contextmanager
+def _locked(log_path):
+    """Serialize the agent and the backup accessing a change log."""
+    with open(log_path + '.lock', 'ab') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _request_flush(log_path, timeout):
+    """Make the agent write the changes it collected so far.
+
+    :return: False if the agent is not running or did not write them
+             within timeout seconds
+    """
+    request_path = log_path + FLUSH_REQUEST_SUFFIX
+    with _locked(log_path):
+        # The agent creates the log when it starts
+        if not os.path.exists(log_path):
+            return False
+        open(request_path, 'ab').close()
+
+    deadline = time.monotonic() + timeout
+    while os.path.exists(request_path):
+        if time.monotonic() >= deadline:
+            with _locked(log_path):
+                if os.path.exists(request_path):
+                    os.unlink(request_path)
+                    return False
+            break
+        time.sleep(FLUSH_POLL_INTERVAL)
+    return True
+
+
+def take(log_path, timeout=FLUSH_TIMEOUT):
+    """Move the changes logged so far aside for a backup.
+
+    The agent first writes the changes it collected and not logged yet.
+
+    :param timeout: seconds to wait for the agent to write them
+    :return: set of the paths changed since the previous backup, None if
+             any file may have changed
+    """
+    flushed = _request_flush(log_path, timeout)
+    taken_path = log_path + '.taken'
+    with _locked(log_path):
+        if os.path.exists(log_path):
+            if os.path.exists(taken_path):
+                # Changes already taken by a backup that failed
+                with open(log_path, 'rb') as log_file, \
+                        open(taken_path, 'ab') as taken_file:
+                    shutil.copyfileobj(log_file, taken_file)
+                os.unlink(log_path)
+            else:
+                os.rename(log_path, taken_path)
+
+    if not flushed or not os.path.exists(taken_path):
+        LOG.warning('[*] The agent logging the changes to {} is not '
+                    'running, all the files are checked'.format(log_path))
+        return None
+
+    changes = set()
+    with open(taken_path, 'rb') as taken_file:
+        for line in taken_file:
+            path = os.fsdecode(line.rstrip(b'\n'))
+            if path == ALL_CHANGED:
+                return None
+            changes.add(path)
+    return changes
+
+
+def commit(log_path):
+    """Remove the changes taken by a backup once it is complete."""
+    try:
+        os.unlink(log_path + '.taken')
+    except FileNotFoundError:
+        pass
+
+
+class InotifyWatcher(object):
+    """Collect the paths changed under a directory tree with inotify."""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.changes = set()
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        # watch descriptor to the directory path, relative to self.path
+        self._watches = {}
+        self._add_tree(os.curdir)
+
+    def close(self):
+        os.close(self._fd)
+
+    def _add_watch(self, rel_path):
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(os.path.join(self.path, rel_path)),
+            WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                # Removed since listed
+                return
+            raise OSError(error, '{0}: {1}'.format(
+                os.strerror(error), rel_path))
+        # A directory moved in the tree keeps its watch descriptor
+        self._watches[wd] = rel_path
+
+    def _add_tree(self, rel_path, new=False):
+        """Watch a directory and its subdirectories.
+
+        :param new: the directory was created or moved in the tree, its
+                    content created before it was watched is logged
+        """
+        self._add_watch(rel_path)
+        for _, dirs, files in scanner.walk(os.path.join(self.path,
+                                                        rel_path)):
+            for entry in dirs:
+                self._add_watch(os.path.relpath(entry.path, self.path))
+            if new:
+                for entry in dirs + files:
+                    self._add_change(os.path.relpath(entry.path, self.path))
+
+    def _add_change(self, rel_path):
+        if '\n' in rel_path:
+            rel_path = ALL_CHANGED
+        self.changes.add(os.path.normpath(rel_path))
+
+    def read_events(self, timeout):
+        """Read the events available within timeout seconds.
+
+        :return: False if no event was available
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return False
+        data = os.read(self._fd, EVENTS_BUFFER_SIZE)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                LOG.warning('[*] Inotify events lost')
+                self._add_change(ALL_CHANGED)
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            dir_path = self._watches.get(wd)
+            if dir_path is None:
+                continue
+
+            rel_path = os.path.join(dir_path, name) if name else dir_path
+            self._add_change(rel_path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(rel_path, new=True)
+        return True
+
+    def flush(self, log_path, request=False):
+        """Append the changes collected to the change log.
+
+        :param request: serve the flush request of a backup
+        """
+        lines = b''.join(os.fsencode(path) + b'\n'
+                         for path in sorted(self.changes))
+        with _locked(log_path):
+            # The log is created even without changes, a missing log means
+            # that the agent is not running
+            with open(log_path, 'ab') as log_file:
+                log_file.write(lines)
+                log_file.flush()
+                os.fsync(log_file.fileno())
+            if request:
+                os.unlink(log_path + FLUSH_REQUEST_SUFFIX)
+        self.changes.clear()
+
+    def run_once(self, log_path, flush_interval):
+        """Collect the changes for flush_interval seconds, or until a backup
+        requests them, and append them to the change log.
+        """
+        request_path = log_path + FLUSH_REQUEST_SUFFIX
+        deadline = time.monotonic() + flush_interval
+        timeout = flush_interval
+        while timeout > 0 and not os.path.exists(request_path):
+            self.read_events(min(timeout, FLUSH_POLL_INTERVAL))
+            timeout = deadline - time.monotonic()
+        # The changes done before the request are queued, a request made
+        # after reading them is served by the next flush
+        request = os.path.exists(request_path)
+        while self.read_events(0):
+            pass
+        self.flush(log_path, request)
+
+    def run(self, log_path, flush_interval):
+        # The changes done while the agent was not running are unknown
+        self._add_change(ALL_CHANGED)
+        self.flush(log_path)
+        while True:
+            self.run_once(log_path, flush_interval)
+
+
+def main(argv=None):
+    conf = cfg.ConfigOpts()
+    conf.register_cli_opts([
+        cfg.StrOpt('path',
+                   positional=True,
+                   required=True,
+                   help="Path to backup watched for changes"),
+        cfg.StrOpt('change-log',
+                   positional=True,
+                   required=True,
+                   help="Change log read by the rsyncv2 backups of the path, "
+                        "see --change-log of freezer-agent"),
+        cfg.IntOpt('flush-interval',
+                   default=1,
+                   min=1,
+                   help="Seconds between two writes of the change log. "
+                        "Default 1."),
+    ])
+    log.register_options(conf)
+    conf(sys.argv[1:] if argv is None else argv, project='freezer')
+    log.setup(conf, 'freezer-changelog')
+
+    watcher = InotifyWatcher(conf.path)
+    try:
+        watcher.run(conf.change_log, conf.flush_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
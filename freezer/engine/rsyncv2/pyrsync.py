@@ -11,15 +11,22 @@
 # limitations under the License.
 
 
+import array
 import hashlib
+import sys
 import zlib
 
 
 _BASE = 65521  # largest prime smaller than 65536
 
-
-def adler32fast(data):
-    return zlib.adler32(data) & 0xffffffff
+# Size of the strong checksums (sha1 digests) of the packed signatures
+STRONG_SIZE = 20
+# Bytes searched for a moved block byte by byte before searching only one
+# block out of ROLLING_PROBE_INTERVAL
+ROLLING_SEARCH_LIMIT = 1024 * 1024
+ROLLING_PROBE_INTERVAL = 64
+# Size of the chunks of the files read at once
+READ_CHUNK_SIZE = 1024 * 1024
 
 
 def adler32(data):
@@ -36,42 +43,299 @@ def adler32rolling(removed, new, s1, s2, blocksize=4096):
     return ((s2 << 16) | s1) & 0xffffffff, s1, s2
 
 
-def blockchecksums(args):
+class BlockChecksums(object):
     """
-    Returns a list of weak and strong hashes for each block of the
-    defined size for the given data stream.
+    Packed weak and strong hashes of data given in successive chunks.
+
+    The chunks do not have to be aligned on the block size, the end of a
+    chunk is kept until the next one completes its block.
     """
-    path, blocksize = args
-    weakhashes = []
-    stronghashes = []
-    weak_append = weakhashes.append
-    strong_append = stronghashes.append
 
-    with open(path, 'rb') as instream:
-        instream_read = instream.read
-        read = instream_read(blocksize)
+    def __init__(self, blocksize):
+        self.blocksize = blocksize
+        # 'I' is 4 bytes wide on every platform freezer supports
+        self._weak = array.array('I')
+        self._strong = []
+        self._partial = b''
+
+    def _add(self, block):
+        self._weak.append(zlib.adler32(block))
+        self._strong.append(hashlib.sha1(block).digest())
+
+    def update(self, data):
+        blocksize = self.blocksize
+        view = memoryview(data)
+        try:
+            offset = 0
+            if self._partial:
+                offset = blocksize - len(self._partial)
+                self._partial += view[:offset].tobytes()
+                if len(self._partial) < blocksize:
+                    return
+                self._add(self._partial)
+                self._partial = b''
+            end = offset + (len(view) - offset) // blocksize * blocksize
+            for block_offset in range(offset, end, blocksize):
+                block = view[block_offset:block_offset + blocksize]
+                self._add(block)
+                block.release()
+            self._partial = view[end:].tobytes()
+        finally:
+            view.release()
+
+    def update_zeros(self, length):
+        """
+        Same as update(bytes(length)), the blocks of zeros are hashed once.
+        """
+        blocksize = self.blocksize
+        if self._partial:
+            head = min(length, blocksize - len(self._partial))
+            self.update(bytes(head))
+            length -= head
+        count = length // blocksize
+        if count:
+            zeros = bytes(blocksize)
+            self._weak.extend(array.array('I', [zlib.adler32(zeros)]) *
+                              count)
+            self._strong.extend([hashlib.sha1(zeros).digest()] * count)
+        if length % blocksize:
+            self.update(bytes(length % blocksize))
+
+    def digest(self):
+        """
+        :return: tuple of bytes (weak hashes, strong hashes)
+        """
+        if self._partial:
+            self._add(self._partial)
+            self._partial = b''
+        weak = array.array('I', self._weak)
+        if sys.byteorder != 'little':
+            weak.byteswap()
+        return weak.tobytes(), b''.join(self._strong)
+
+
+def _read_chunks(path, blocksize):
+    """
+    Yields the data of the file by chunks of whole blocks, the last one
+    possibly shorter.
+
+    The chunks are memoryviews of a buffer reused for the next chunk. The
+    file is read instead of memory mapped: reading a mapping of a file
+    truncated meanwhile would kill the process with SIGBUS.
+    """
+    chunk_size = max(READ_CHUNK_SIZE // blocksize, 1) * blocksize
+    buffer = memoryview(bytearray(chunk_size))
+    with open(path, 'rb', buffering=0) as instream:
+        while True:
+            length = 0
+            while length < chunk_size:
+                read = instream.readinto(buffer[length:])
+                if not read:
+                    break
+                length += read
+            if length:
+                yield buffer[:length]
+            if length < chunk_size:
+                return
+
+
+def blockchecksums_packed(path, blocksize):
+    """
+    Returns the weak and strong hashes of each block of the file, packed.
 
-        while read:
-            weak_append(adler32fast(read))
-            strong_append(hashlib.sha1(read).hexdigest())
-            read = instream_read(blocksize)
+    The weak hashes are the adler32 checksums of the blocks, as little
+    endian uint32, and the strong hashes their sha1 digests, all of them
+    concatenated. The file is read by large chunks and no per block
+    string is created.
 
-    return weakhashes, stronghashes
+    :return: tuple of bytes (weak hashes, strong hashes)
+    """
+    checksums = BlockChecksums(blocksize)
+    for chunk in _read_chunks(path, blocksize):
+        checksums.update(chunk)
+    return checksums.digest()
 
 
-def rsyncdelta_fast(datastream, remotesignatures, blocksize=4096):
-    rem_weak, rem_strong = remotesignatures
-    data_block = datastream.read(blocksize)
+def blockdeltas_packed(path, remotesignatures, blocksize):
+    """
+    Compares every block of the file with the block at the same position
+    in the remote file and computes the signatures of the file, in a single
+    read of the file.
+
+    :param remotesignatures: packed weak and strong hashes of the remote
+                             file (blockchecksums_packed)
+    :return: indexes of the modified blocks, their total size and the
+             packed weak and strong hashes of the file
+    """
+    rem_weak = array.array('I', remotesignatures[0])
+    if sys.byteorder != 'little':
+        rem_weak.byteswap()
+    rem_strong = remotesignatures[1]
+    count = len(rem_weak)
+
+    weak = array.array('I')
+    strong = []
+    modified_blocks = []
+    len_deltas = 0
     index = 0
-    while data_block:
-        try:
-            if adler32fast(data_block) == rem_weak[index] and hashlib.sha1(
-                    data_block).hexdigest() == rem_strong[index]:
-                yield index
-            else:
-                yield data_block
-        except IndexError:
-            yield data_block
-
-        index += 1
-        data_block = datastream.read(blocksize)
+    for chunk in _read_chunks(path, blocksize):
+        for offset in range(0, len(chunk), blocksize):
+            block = chunk[offset:offset + blocksize]
+            block_weak = zlib.adler32(block)
+            block_strong = hashlib.sha1(block).digest()
+            weak.append(block_weak)
+            strong.append(block_strong)
+            if (index >= count or block_weak != rem_weak[index] or
+                    block_strong != rem_strong[index * STRONG_SIZE:
+                                               (index + 1) * STRONG_SIZE]):
+                modified_blocks.append(index)
+                len_deltas += len(block)
+            index += 1
+
+    if sys.byteorder != 'little':
+        weak.byteswap()
+    return modified_blocks, len_deltas, (weak.tobytes(), b''.join(strong))
+
+
+def _signature_table(remotesignatures, blocksize):
+    """
+    :return: dict of the weak hash of every block to the indexes of the
+             blocks and the weak hashes
+    """
+    rem_weak = array.array('I', remotesignatures[0])
+    if sys.byteorder != 'little':
+        rem_weak.byteswap()
+    table = {}
+    for index, weak in enumerate(rem_weak):
+        table.setdefault(weak, []).append(index)
+    return table, rem_weak
+
+
+def rollingdelta_packed(path, remotesignatures, blocksize, remotesize,
+                        start=0):
+    """
+    Finds the blocks of the remote file anywhere in the file, whatever
+    their offset, as the rsync algorithm does.
+
+    The weak hash of the window at the current offset is looked up in a
+    table of the remote blocks. On a match the window moves by a block,
+    otherwise it rolls byte by byte over the next block. After
+    ROLLING_SEARCH_LIMIT bytes without any match, the data is probably new
+    and only one block out of ROLLING_PROBE_INTERVAL is rolled over, the
+    others are looked up at their offset only.
+
+    :param remotesignatures: packed weak and strong hashes of the remote
+                             file (blockchecksums_packed)
+    :param remotesize: size of the remote file, its last block is shorter
+                       than blocksize if the size is not a multiple of it.
+                       If None, the last block is never matched.
+    :param start: offset of the data to compare, the data before it is
+                  considered unchanged and is not part of the result
+    :return: list of [remote offset, length] copies of the remote file
+             data, the remote offset is -1 for data not found in the
+             remote file, and total length of that data
+    """
+    table, rem_weak = _signature_table(remotesignatures, blocksize)
+    rem_strong = remotesignatures[1]
+    count = len(rem_weak)
+    last_length = None
+    if count and remotesize is not None:
+        last_length = remotesize - (count - 1) * blocksize
+    ops = []
+    literal = [0]
+
+    def add(offset, length):
+        if offset < 0:
+            literal[0] += length
+        if ops and ops[-1][1] and (
+                (offset < 0 and ops[-1][0] < 0) or
+                (offset >= 0 and ops[-1][0] >= 0 and
+                 ops[-1][0] + ops[-1][1] == offset)):
+            ops[-1][1] += length
+        else:
+            ops.append([offset, length])
+
+    def find(window, weak, expected):
+        candidates = table.get(weak)
+        if not candidates:
+            return None
+        strong = hashlib.sha1(window).digest()
+        if expected in candidates:
+            candidates = [expected] + candidates
+        for index in candidates:
+            if (rem_strong[index * STRONG_SIZE:(index + 1) * STRONG_SIZE] ==
+                    strong and (index < count - 1 or
+                                last_length == len(window))):
+                return index
+        return None
+
+    # The data is read by windows starting at the current offset and
+    # holding at least two blocks, the rolled window and the block rolled
+    # over, until the end of the file
+    window_size = max(READ_CHUNK_SIZE, 2 * blocksize)
+    data = bytearray()
+    base = start
+    eof = False
+    with open(path, 'rb') as instream:
+        instream.seek(start)
+        offset = literal_start = start
+        expected = start // blocksize
+        while True:
+            if not eof and base + len(data) < offset + 2 * blocksize:
+                del data[:offset - base]
+                base = offset
+                while not eof and len(data) < window_size:
+                    chunk = instream.read(window_size - len(data))
+                    eof = not chunk
+                    data += chunk
+            size = base + len(data)
+            if offset + blocksize > size:
+                break
+
+            position = offset - base
+            window = data[position:position + blocksize]
+            weak = zlib.adler32(window)
+            index = find(window, weak, expected)
+            if index is None:
+                missed = offset - literal_start
+                if (missed >= ROLLING_SEARCH_LIMIT and
+                        (missed // blocksize) % ROLLING_PROBE_INTERVAL):
+                    offset += blocksize
+                    continue
+                # Roll the window over the next block
+                s1, s2 = weak & 0xffff, weak >> 16
+                last = min(offset + blocksize, size - blocksize) - base
+                while position < last:
+                    removed = data[position]
+                    s1 = (s1 - removed + data[position + blocksize]) % _BASE
+                    s2 = (s2 - blocksize * removed + s1 - 1) % _BASE
+                    position += 1
+                    if (s2 << 16) | s1 in table:
+                        window = data[position:position + blocksize]
+                        index = find(window, (s2 << 16) | s1, expected)
+                        if index is not None:
+                            break
+                if index is None:
+                    offset = max(base + position, offset + 1)
+                    continue
+                offset = base + position
+            if offset > literal_start:
+                add(-1, offset - literal_start)
+            add(index * blocksize, blocksize)
+            offset += blocksize
+            literal_start = offset
+            expected = index + 1
+
+    # The data after the last full window may be the short last block of
+    # the remote file
+    if (size - offset and last_length == size - offset and
+            offset >= literal_start):
+        window = data[offset - base:]
+        if find(window, zlib.adler32(window), count - 1) == count - 1:
+            if offset > literal_start:
+                add(-1, offset - literal_start)
+            add((count - 1) * blocksize, last_length)
+            literal_start = size
+    if size > literal_start:
+        add(-1, size - literal_start)
+    return ops, literal[0]
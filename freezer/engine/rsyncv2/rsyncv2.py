@@ -15,37 +15,318 @@
 Freezer rsync incremental engine
 """
 
+import collections
+from concurrent import futures
+import errno
 import fnmatch
 import getpass
 import grp
 import io
+import multiprocessing
 import os
 import pwd
 import queue
 import shutil
 import stat
 import sys
+import tempfile
 import threading
+import time
 
 import msgpack
 from oslo_log import log
 
 
 from freezer.engine import engine
+from freezer.engine.rsyncv2 import changelog
 from freezer.engine.rsyncv2 import pyrsync
+from freezer.engine.rsyncv2 import sigstore
 from freezer.utils import compress
 from freezer.utils import crypt
+from freezer.utils import scanner
+from freezer.utils import streaming
 from freezer.utils import winutils
 
 LOG = log.getLogger(__name__)
 
 # Version of the meta data structure format
-RSYNC_DATA_STRUCT_VERSION = 2
+RSYNC_DATA_STRUCT_VERSION = 3
+
+# Files whose headers are written together, followed by their data
+HEADER_BATCH_SIZE = 1000
+
+# Size of the largest header read on restore
+MAX_HEADER_SIZE = 2 ** 32 - 1
+
+# Size of the data of the files written by the restore threads, the larger
+# ones are written while read from the backup data
+MAX_BUFFERED_FILE_SIZE = 1024 * 1024
+
+# Writes of the restore run together by a thread
+APPLY_BATCH_SIZE = 64
+
+# Batches of writes submitted to every restore thread ahead of the restore
+RESTORE_QUEUE_DEPTH = 4
+
+# Computations submitted to every worker process ahead of the backup
+WORKER_QUEUE_DEPTH = 4
+
+# The worker processes are started while the storage and the scanner
+# threads are running, a forked worker could inherit a lock held by one of
+# them
+WORKER_START_METHOD = ('forkserver' if 'forkserver' in
+                       multiprocessing.get_all_start_methods() else 'spawn')
+
+# Size of the reads of the previous version of a file rebuilt on restore
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Seconds between two distinct mtimes of a directory, on any file system
+TIMESTAMP_GRANULARITY = 2
+
+
+def _file_deltas(file_name, old_signature, rsync_bs, old_size=None):
+    """Compare a file with the signature of its previous version.
+
+    The blocks are first compared with the block at the same offset in the
+    previous version. If some differ, the data following the first one is
+    searched for blocks moved since the previous version and the file is
+    rebuilt from them if fewer bytes have to be backed up.
+
+    Runs in the worker processes, the arguments and the result are pickled.
+
+    :return: key of the deltas in the file header ('deltas' for blocks
+             patched in place, 'patch' for a file rebuilt from moved
+             blocks), the deltas, count of modified and unchanged blocks
+             and the new signature of the file
+    """
+    modified_blocks, len_deltas, signature = pyrsync.blockdeltas_packed(
+        file_name, old_signature, rsync_bs)
+    blocks = len(signature[0]) // 4
+
+    if modified_blocks and old_signature[0]:
+        start = modified_blocks[0] * rsync_bs
+        ops, len_literal = pyrsync.rollingdelta_packed(
+            file_name, old_signature, rsync_bs, old_size, start)
+        if len_literal < len_deltas:
+            if start:
+                ops.insert(0, [0, start])
+            literal_blocks = sum(-(-length // rsync_bs)
+                                 for offset, length in ops if offset < 0)
+            return ('patch', (len_literal, ops), literal_blocks,
+                    blocks - literal_blocks, signature)
+
+    return ('deltas', (len_deltas, modified_blocks), len(modified_blocks),
+            blocks - len(modified_blocks), signature)
+
+
+def _data_extents(file_name, size):
+    """Find the data of a sparse file, the holes read as zeros.
+
+    :return: [offset, length] of each range of data of the file
+    """
+    extents = []
+    fd = os.open(file_name, os.O_RDONLY)
+    try:
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as error:
+                if error.errno == errno.ENXIO:
+                    # A hole up to the end of the file
+                    break
+                raise
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            if start >= end:
+                break
+            extents.append([start, end - start])
+            offset = end
+    finally:
+        os.close(fd)
+    return extents
+
+
+def _is_sparse(os_stat):
+    """
+    :return: True if the file may have holes
+    """
+    blocks = getattr(os_stat, 'st_blocks', None)
+    return (hasattr(os, 'SEEK_DATA') and blocks is not None and
+            blocks * 512 < os_stat.st_size)
+
+
+class OldFilesIndex(object):
+    """Index of the files of the previous backup to detect renames.
+
+    A new path is the new name of a regular file of the previous backup
+    which no longer exists if it has the same device and inode number,
+    otherwise the same size and modification time, otherwise the same
+    base name, provided a single file matches.
+    """
+
+    def __init__(self, old_fs_meta_struct):
+        self._by_inode = {}
+        self._by_size_mtime = collections.defaultdict(list)
+        self._by_name = collections.defaultdict(list)
+        self._renamed = set()
+        for path, file_meta in old_fs_meta_struct.items():
+            if not stat.S_ISREG(file_meta['mode']):
+                continue
+            # Metadata written by previous versions has no inode numbers
+            if 'ino' in file_meta:
+                self._by_inode[(file_meta['dev'], file_meta['ino'])] = path
+            if 'size' in file_meta:
+                self._by_size_mtime[(file_meta['size'],
+                                     file_meta['mtime'])].append(path)
+            self._by_name[os.path.basename(path)].append(path)
+
+    def _is_renamed(self, path):
+        return path not in self._renamed and not os.path.lexists(path)
+
+    def _find_one(self, paths):
+        paths = [p for p in paths if self._is_renamed(p)]
+        return paths[0] if len(paths) == 1 else None
+
+    def find_renamed(self, file_path, file_meta):
+        """Find the previous name of a new path.
+
+        :param file_path: new path, relative to the backup path
+        :param file_meta: incremental meta data of the file
+        :return: the previous name of the file or None
+        """
+        if not stat.S_ISREG(file_meta['mode']):
+            return None
+
+        prev_name = self._by_inode.get((file_meta['dev'], file_meta['ino']))
+        if not (prev_name and self._is_renamed(prev_name)):
+            base_name = os.path.basename(file_path)
+            same_data = self._by_size_mtime.get(
+                (file_meta['size'], file_meta['mtime']), [])
+            prev_name = (
+                self._find_one(p for p in same_data
+                               if os.path.basename(p) == base_name) or
+                self._find_one(same_data) or
+                self._find_one(self._by_name.get(base_name, [])))
+
+        if prev_name:
+            self._renamed.add(prev_name)
+        return prev_name
+
+
+class FilesMeta(object):
+    """Meta data of the files of a backup.
+
+    The meta data of a file is written to the signature store as soon as it
+    is final: the directories once listed, the regular files once their
+    signature is known. Only the paths of the others are kept.
+    """
+
+    def __init__(self, signatures):
+        self._signatures = signatures
+        self._pending = {}
+        self._paths = set()
+
+    def add(self, path, file_meta):
+        self._paths.add(path)
+        mode = file_meta['mode']
+        if stat.S_ISDIR(mode) or (stat.S_ISREG(mode) and
+                                  'signature' not in file_meta):
+            self._pending[path] = file_meta
+        else:
+            self._signatures.add_record(path, file_meta)
+
+    def get(self, path):
+        """Meta data of a file not written yet, None otherwise."""
+        return self._pending.get(path)
+
+    def done(self, path):
+        """Write the meta data of a file."""
+        file_meta = self._pending.pop(path, None)
+        if file_meta is not None:
+            self._signatures.add_record(path, file_meta)
+
+    def close(self):
+        for path, file_meta in self._pending.items():
+            self._signatures.add_record(path, file_meta)
+        self._pending.clear()
+
+    def __contains__(self, path):
+        return path in self._paths
+
+    def __len__(self):
+        return len(self._paths)
+
+
+class DirChangeTracker(object):
+    """Find the directories unchanged since the previous backup.
+
+    The previous backup records when it listed each directory and the
+    number of its entries. A directory whose mtime and ctime did not change
+    since then, and was not reported by the change log, has the same
+    entries and is not listed again. The metadata of its files is copied
+    from the previous backup, except for the files reported by the change
+    log, so files modified in place are only backed up if the change log is
+    used.
+    """
+
+    def __init__(self, fs_path, old_fs_meta_struct, exclude, changes):
+        self._fs_path = fs_path
+        self._old_files = old_fs_meta_struct
+        self._exclude = exclude
+        self._changes = changes
+        self._children = collections.defaultdict(list)
+        for path in old_fs_meta_struct:
+            self._children[os.path.dirname(path) or os.curdir].append(path)
+
+    def is_changed(self, rel_path):
+        return rel_path in self._changes
+
+    def children(self, rel_path):
+        """Paths of the entries of a directory in the previous backup."""
+        return self._children.get(rel_path, [])
+
+    def unchanged_subdirs(self, dir_path):
+        """Skip function of scanner.walk.
+
+        :return: the paths of the subdirectories of an unchanged directory,
+                 None if the directory has to be listed
+        """
+        rel_path = os.path.relpath(dir_path, self._fs_path)
+        old_meta = self._old_files.get(rel_path)
+        if (not old_meta or 'listed' not in old_meta or
+                old_meta['exclude'] != self._exclude or
+                rel_path in self._changes):
+            return None
+        # A change within the timestamp granularity of the listing would
+        # not change the mtime
+        if (max(old_meta['mtime'], old_meta['ctime']) >
+                old_meta['listed'] - TIMESTAMP_GRANULARITY):
+            return None
+        try:
+            os_stat = os.lstat(dir_path)
+        except (OSError, IOError):
+            return None
+        children = self.children(rel_path)
+        if (not stat.S_ISDIR(os_stat.st_mode) or
+                os_stat.st_mtime != old_meta['mtime'] or
+                os_stat.st_ctime != old_meta['ctime'] or
+                len(children) != old_meta['entries']):
+            return None
+
+        return [os.path.join(self._fs_path, path) for path in children
+                if stat.S_ISDIR(self._old_files[path]['mode'])]
 
 
 class Rsyncv2Engine(engine.BackupEngine):
     def __init__(self, **kwargs):
         self.compression_algo = kwargs.get('compression')
+        self.compression_level = kwargs.get('compression_level')
+        self.compression_threads = kwargs.get('compression_threads', 0)
+        self.adaptive_compression = kwargs.get('adaptive_compression', False)
+        # the backup data is compressed by frames, see
+        # compress.FrameCompressor
+        self.compression_frames = (self.adaptive_compression or
+                                   self.compression_threads > 0)
         self.encrypt_pass_file = kwargs.get('encrypt_key', None)
         self.dereference_symlink = kwargs.get('symlinks')
         self.exclude = kwargs.get('exclude')
@@ -54,9 +335,36 @@ class Rsyncv2Engine(engine.BackupEngine):
         self.dry_run = kwargs.get('dry_run', False)
         self.max_segment_size = kwargs.get('max_segment_size')
         self.rsync_block_size = kwargs.get('rsync_block_size')
+        self.rsync_workers = kwargs.get('rsync_workers', 1)
+        self.scan_workers = kwargs.get('scan_workers', 1)
+        self.restore_workers = kwargs.get('restore_workers', 1)
+        self.dir_change_tracking = kwargs.get('dir_change_tracking', False)
+        self.change_log = kwargs.get('change_log')
+        if self.rsync_workers == 0:
+            self.rsync_workers = os.cpu_count() or 1
         self.fixed_blocks = 0
         self.modified_blocks = 0
-        super(Rsyncv2Engine, self).__init__(storage=kwargs.get('storage'))
+        self._owner_names = scanner.OwnerNames()
+        # signature stores of the previous and of the current backup
+        self._old_signatures = None
+        self._signatures = None
+        # index of the files of the previous backup to find the renamed ones
+        self._old_files = None
+        # pool of the deltas and signatures computations, None when they
+        # are done by the thread reading the files
+        self._executor = None
+        self._in_flight = collections.deque()
+        self._sign_delta_error = None
+        # pool of the restore threads writing the files, None when they are
+        # written by the thread reading the backup data
+        self._restore_executor = None
+        self._restore_in_flight = collections.deque()
+        # directories restored and their inode, set at the end of a level
+        self._restored_dirs = []
+        # writes of the restore not submitted yet and the size of their data
+        self._apply_batch = []
+        self._apply_batch_size = 0
+        super(Rsyncv2Engine, self).__init__(**kwargs)
 
     @property
     def name(self):
@@ -66,12 +374,19 @@ class Rsyncv2Engine(engine.BackupEngine):
         return {
             "engine_name": self.name,
             "compression": self.compression_algo,
+            "compression_frames": self.compression_frames,
             "rsync_block_size": self.rsync_block_size,
             # the encrypt_pass_file might be key content so we need to convert
             # to boolean
             "encryption": bool(self.encrypt_pass_file)
         }
 
+    def post_backup(self, backup_resource):
+        # The changes are kept until the backup is stored, the next backup
+        # reads them again otherwise
+        if self.change_log:
+            changelog.commit(self.change_log)
+
     def backup_data(self, backup_path, manifest_path):
         """Execute backup using rsync algorithm.
 
@@ -86,12 +401,17 @@ class Rsyncv2Engine(engine.BackupEngine):
         LOG.info('Recursively archiving and compressing files '
                  'from {}'.format(os.getcwd()))
 
-        file_read_limit = 0
-        data_chunk = b''
+        segment = streaming.SegmentAssembler()
         max_seg_size = self.max_segment_size
 
         # Initialize objects for compressing and encrypting data
-        compressor = compress.Compressor(self.compression_algo)
+        if self.compression_frames:
+            compressor = compress.FrameCompressor(
+                self.compression_algo, self.compression_level,
+                self.compression_threads, self.adaptive_compression)
+        else:
+            compressor = compress.Compressor(self.compression_algo,
+                                             self.compression_level)
         cipher = None
         if self.encrypt_pass_file:
             cipher = crypt.AESEncrypt(self.encrypt_pass_file)
@@ -118,22 +438,25 @@ class Rsyncv2Engine(engine.BackupEngine):
             if block_len == 0:
                 continue
 
-            data_chunk += file_block
-            file_read_limit += block_len
-            if file_read_limit >= max_seg_size:
-                yield self._process_backup_data(data_chunk, compressor, cipher)
-                data_chunk = b''
-                file_read_limit = 0
+            segment.append(file_block)
+            if len(segment) >= max_seg_size:
+                yield self._process_backup_data(segment.take(), compressor,
+                                                cipher)
 
-        flushed_data = self._flush_backup_data(data_chunk, compressor, cipher)
+        flushed_data = self._flush_backup_data(segment.take(), compressor,
+                                               cipher)
 
-        # Upload segments smaller then max_seg_size
-        if len(flushed_data) < max_seg_size:
-            yield flushed_data
+        # Upload the last segment, whatever its size
+        yield flushed_data
 
         # Rejoining thread
         t_get_sign_delta.join()
+        if self._sign_delta_error:
+            raise self._sign_delta_error
 
+        if self.adaptive_compression:
+            LOG.info('{0} of {1} compression frames stored uncompressed'
+                     .format(compressor.stored_frames, compressor.frames))
         LOG.info("Rsync engine backup stream completed")
 
     @staticmethod
@@ -152,7 +475,16 @@ class Rsyncv2Engine(engine.BackupEngine):
         """Restore the provided backup into restore_abs_path.
 
         Decrypt backup content if encrypted.
-        Freezer rsync header data structure::
+        Freezer rsync data stream::
+
+            {'rsync_struct_ver': 3}
+            header of a batch of files
+            data of the regular files of the batch
+            ...
+            [] (end of the stream)
+
+        The streams of version 2 and before hold a single header with all
+        the files, followed by their data. Header data structure::
 
             [ {
                 'path': '' (path to file),
@@ -166,10 +498,16 @@ class Rsyncv2Engine(engine.BackupEngine):
                     'size': st_size
                 } (optional if file removed),
                'lname': 'link_name' (optional if symlink),
-               'prev_name': '' (optional if renamed),
+               'prev_name': '' (optional if renamed, the data is only
+                            backed up with new_level),
                'new_level': True (optional if incremental),
                'deleted': True (optional if removed),
                'deltas': len_of_blocks, [modified blocks] (if patch)
+               'extents': [[offset, length], ...] (if sparse, the data
+                          of the ranges, the rest of the file is a hole)
+               'patch': len_of_data, [[offset, length], ...] (if rebuilt
+                        from the data of the previous version at offset,
+                        or from the backup data if offset is -1)
               },
               ...
             ]
@@ -188,6 +526,8 @@ class Rsyncv2Engine(engine.BackupEngine):
 
             self.compression_algo = metadata.get('compression',
                                                  self.compression_algo)
+            self.compression_frames = metadata.get('compression_frames',
+                                                   False)
 
             if not os.path.exists(restore_path):
                 raise ValueError(
@@ -198,38 +538,126 @@ class Rsyncv2Engine(engine.BackupEngine):
                 restore_path = '/dev/null'
 
             data_gen = self._restore_data(read_pipe)
+            data_stream = streaming.ChunkReader(data_gen)
 
+            # The backup data is read by this thread, the small files
+            # written and the inodes set by the pool
+            if self.restore_workers > 1:
+                self._restore_executor = futures.ThreadPoolExecutor(
+                    max_workers=self.restore_workers)
             try:
-                data_stream = data_gen.next()
-                files_meta, data_stream = self._load_files_meta(data_stream,
-                                                                data_gen)
-
-                for fm in files_meta:
-                    data_stream = self._restore_file(
-                        fm, restore_path, data_stream, data_gen, backup.level)
-            except StopIteration:
-                LOG.info('Rsync restore process completed')
+                self._restore_files(restore_path, data_gen, data_stream,
+                                    backup.level)
+            finally:
+                if self._restore_executor:
+                    self._restore_executor.shutdown(wait=True,
+                                                    cancel_futures=True)
+                    self._restore_executor = None
+                self._restore_in_flight.clear()
+                self._restored_dirs = []
+                self._apply_batch = []
+                self._apply_batch_size = 0
         except Exception as e:
             LOG.exception(e)
             except_queue.put(e)
             raise
 
+    def _restore_files(self, restore_path, data_gen, data_stream,
+                       backup_level):
+        try:
+            files_meta = self._load_files_meta(data_stream)
+            batched = isinstance(files_meta, dict)
+            if batched:
+                files_meta = self._load_files_meta(data_stream)
+
+            while files_meta:
+                for fm in files_meta:
+                    self._restore_file(fm, restore_path, data_stream,
+                                       backup_level)
+                if not batched:
+                    break
+                files_meta = self._load_files_meta(data_stream)
+            # Read the stream up to the end of the backup data
+            for _ in data_gen:
+                pass
+        except StopIteration:
+            pass
+
+        self._wait_applied()
+        # The mtime of a directory changes with its entries, the deepest
+        # directories are set first as their parent may not be searchable
+        for dir_path, inode in reversed(self._restored_dirs):
+            self._set_inode(dir_path, inode)
+        LOG.info('Rsync restore process completed')
+
+    def _apply(self, func, *args, size=0):
+        """Run a write of the restore, by the pool of threads if any.
+
+        :param size: size of the data held by the arguments
+        """
+        if not self._restore_executor:
+            func(*args)
+            return
+
+        # The writes are submitted by batches, most take less time than a
+        # submission
+        self._apply_batch.append((func, args))
+        self._apply_batch_size += size
+        if (len(self._apply_batch) >= APPLY_BATCH_SIZE or
+                self._apply_batch_size >= MAX_BUFFERED_FILE_SIZE):
+            self._submit_applied()
+
     @staticmethod
-    def _load_files_meta(data_stream, data_gen):
-        files_meta = []
+    def _run_applied(batch):
+        for func, args in batch:
+            func(*args)
+
+    def _submit_applied(self):
+        if not self._apply_batch:
+            return
+        # Bound the writes waiting for a thread, with their data
+        while (len(self._restore_in_flight) >=
+               self.restore_workers * RESTORE_QUEUE_DEPTH):
+            self._restore_in_flight.popleft().result()
+        self._restore_in_flight.append(self._restore_executor.submit(
+            self._run_applied, self._apply_batch))
+        self._apply_batch = []
+        self._apply_batch_size = 0
+
+    def _wait_applied(self):
+        if self._restore_executor:
+            self._submit_applied()
+        while self._restore_in_flight:
+            self._restore_in_flight.popleft().result()
+
+    def _restore_inode(self, file_abs_path, inode):
+        """Set the inode fields of a file once restored."""
+        if stat.S_ISDIR(inode['mode']):
+            self._restored_dirs.append((file_abs_path, inode))
+        else:
+            self._apply(self._set_inode, file_abs_path, inode)
+
+    @staticmethod
+    def _load_files_meta(data_stream):
+        """Read a header from the data stream.
+
+        :param data_stream: streaming.ChunkReader of the backup data
+        :return: the header
+        """
+        # The headers of version 2 list all the files of the backup
+        unpacker = msgpack.Unpacker(max_buffer_size=MAX_HEADER_SIZE)
+        fed = 0
         while True:
+            data = data_stream.read()
+            unpacker.feed(data)
+            fed += len(data)
             try:
-                files_meta = msgpack.load(data_stream)
-            except msgpack.ExtraData as e:
-                files_meta = e.unpacked
-                data_stream = io.BytesIO(e.extra)
-                break
+                files_meta = unpacker.unpack()
             except msgpack.OutOfData:
-                data_stream.write(data_gen.next().read())
-                data_stream.seek(0)
-            else:
-                break
-        return files_meta, data_stream
+                continue
+            # The data following the header is read with the files
+            data_stream.unread(data[len(data) - (fed - unpacker.tell()):])
+            return files_meta
 
     @staticmethod
     def _remove_file(file_abs_path):
@@ -241,12 +669,25 @@ class Rsyncv2Engine(engine.BackupEngine):
         except Exception as e:
             LOG.warning('[*] File or directory unlink error {}'.format(e))
 
-    def _restore_file(self, file_meta, restore_path, data_stream, data_gen,
+    @staticmethod
+    def _rename_file(prev_abs_path, file_abs_path):
+        try:
+            os.replace(prev_abs_path, file_abs_path)
+        except (OSError, IOError) as error:
+            LOG.warning('[*] File {0} rename error: {1}'.format(
+                prev_abs_path, error))
+
+    def _restore_file(self, file_meta, restore_path, data_stream,
                       backup_level):
         file_abs_path = os.path.join(restore_path, file_meta['path'])
 
         inode = file_meta.get('inode', {})
         file_mode = inode.get('mode')
+        prev_name = file_meta.get('prev_name')
+
+        if prev_name and backup_level:
+            self._rename_file(os.path.join(restore_path, prev_name),
+                              file_abs_path)
 
         if os.path.exists(file_abs_path):
             if backup_level == 0:
@@ -254,18 +695,30 @@ class Rsyncv2Engine(engine.BackupEngine):
             else:
                 if file_meta.get('deleted'):
                     self._remove_file(file_abs_path)
-                    return data_stream
+                    return
                 elif file_meta.get('new_level') and not stat.S_ISREG(
                         file_mode):
-                    self._set_inode(file_abs_path, inode)
-                    return data_stream
+                    self._restore_inode(file_abs_path, inode)
+                    return
+                elif prev_name and not file_meta.get('new_level'):
+                    self._restore_inode(file_abs_path, inode)
+                    return
+        elif prev_name and not file_meta.get('new_level'):
+            # The data of the file is in the level of its previous name
+            return
 
         if not file_mode:
-            return data_stream
+            return
 
         if stat.S_ISREG(file_mode):
-            data_stream = self._restore_reg_file(file_abs_path, file_meta,
-                                                 data_gen, data_stream)
+            size = self._data_size(file_meta)
+            if self._restore_executor and size <= MAX_BUFFERED_FILE_SIZE:
+                data = io.BytesIO()
+                self._write_data(data, size, data_stream)
+                self._apply(self._restore_small_file, file_abs_path,
+                            file_meta, data.getvalue(), size=size)
+                return
+            self._restore_reg_file(file_abs_path, file_meta, data_stream)
 
         elif stat.S_ISDIR(file_mode):
             try:
@@ -307,9 +760,23 @@ class Rsyncv2Engine(engine.BackupEngine):
                     file_abs_path, error))
 
         if not stat.S_ISLNK(file_mode):
-            self._set_inode(file_abs_path, inode)
+            self._restore_inode(file_abs_path, inode)
 
-        return data_stream
+    def _restore_small_file(self, file_abs_path, file_meta, data):
+        self._restore_reg_file(file_abs_path, file_meta,
+                               streaming.ChunkReader([data]))
+        self._set_inode(file_abs_path, file_meta['inode'])
+
+    @staticmethod
+    def _data_size(file_meta):
+        """Size of the backup data of a regular file."""
+        if file_meta.get('new_level'):
+            for key in ('patch', 'deltas'):
+                if file_meta.get(key):
+                    return file_meta[key][0]
+        if 'extents' in file_meta:
+            return sum(length for _, length in file_meta['extents'])
+        return file_meta['inode']['size']
 
     @staticmethod
     def _make_dev_file(file_abs_path, dev, mode):
@@ -319,21 +786,62 @@ class Rsyncv2Engine(engine.BackupEngine):
         os.mknod(file_abs_path, mode, new_dev)
 
     @staticmethod
-    def _create_reg_file(path, size, data_gen, data_stream):
+    def _write_data(fd, size, data_stream):
+        while size:
+            data = data_stream.read(size)
+            fd.write(data)
+            size -= len(data)
+
+    def _create_reg_file(self, path, size, data_stream):
         with open(path, 'wb') as fd:
-            while fd.tell() < size:
-                data = data_stream.read(size - fd.tell())
-                if not data:
-                    data_stream = data_gen.next()
-                    continue
-                fd.write(data)
+            self._write_data(fd, size, data_stream)
+
+    def _create_sparse_file(self, path, size, extents, data_stream):
+        with open(path, 'wb') as fd:
+            for offset, length in extents:
+                fd.seek(offset)
+                self._write_data(fd, length, data_stream)
+            # The parts of the file not written are holes
+            fd.truncate(size)
 
-        return data_stream
+    def _rebuild_reg_file(self, path, patch, data_stream):
+        """Rebuild a file from its previous version and the backup data.
+
+        The file is written next to the previous version, which replaces
+        it once complete.
+        """
+        _, ops = patch
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path),
+            prefix='.{0}.'.format(os.path.basename(path)))
+        try:
+            with os.fdopen(fd, 'wb') as new_fd, open(path, 'rb') as old_fd:
+                for offset, length in ops:
+                    if offset < 0:
+                        self._write_data(new_fd, length, data_stream)
+                        continue
+                    old_fd.seek(offset)
+                    while length:
+                        data = old_fd.read(min(length, COPY_BUFFER_SIZE))
+                        if not data:
+                            raise IOError(
+                                '{0} is shorter than its previous '
+                                'version'.format(path))
+                        new_fd.write(data)
+                        length -= len(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
 
     def _restore_data(self, read_pipe):
         try:
             data_chunk = read_pipe.recv_bytes()
-            decompressor = compress.Decompressor(self.compression_algo)
+            if self.compression_frames:
+                decompressor = compress.FrameDecompressor(
+                    self.compression_algo, self.compression_threads)
+            else:
+                decompressor = compress.Decompressor(self.compression_algo)
             decryptor = None
 
             if self.encrypt_pass_file:
@@ -349,14 +857,14 @@ class Rsyncv2Engine(engine.BackupEngine):
                     data_chunk += read_pipe.recv_bytes()
                     continue
                 if data_chunk:
-                    yield io.BytesIO(data_chunk)
+                    yield data_chunk
                 data_chunk = read_pipe.recv_bytes()
 
         except EOFError:
             LOG.info("[*] EOF from pipe. Flushing buffer.")
             data_chunk = decompressor.flush()
             if data_chunk:
-                yield io.BytesIO(data_chunk)
+                yield data_chunk
 
     @staticmethod
     def _process_backup_data(data, compressor, encryptor, do_compress=True):
@@ -380,41 +888,93 @@ class Rsyncv2Engine(engine.BackupEngine):
         return data
 
     def _get_deltas_info(self, file_name, old_file_meta):
-        len_deltas = 0
-        old_signature = old_file_meta['signature']
-        rsync_bs = self.rsync_block_size
+        return self._submit(_file_deltas, file_name,
+                            self._old_signature(old_file_meta),
+                            self.rsync_block_size,
+                            old_file_meta.get('size'))
 
-        # Get changed blocks index only
-        index = 0
-        modified_blocks = []
-        with open(file_name, 'rb') as fd:
-            for block_index in pyrsync.rsyncdelta_fast(
-                    fd,
-                    (old_signature[0], old_signature[1]),
-                    rsync_bs):
+    def _submit(self, func, *args):
+        """Run a deltas or signature computation.
 
-                if not isinstance(block_index, int):
-                    block_len = len(block_index)
-                    if block_len > 0:
-                        len_deltas += block_len
-                        modified_blocks.append(index)
-                        self.modified_blocks += 1
-                else:
-                    self.fixed_blocks += 1
+        :return: future of the result, already done if there is no pool
+        """
+        if not self._executor:
+            future = futures.Future()
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        # Bound the files waiting for a worker, their arguments are held
+        # in memory until then
+        while (len(self._in_flight) >=
+               self.rsync_workers * WORKER_QUEUE_DEPTH):
+            futures.wait([self._in_flight.popleft()])
+        future = self._executor.submit(func, *args)
+        self._in_flight.append(future)
+        return future
 
-                index += 1
+    @staticmethod
+    def _read_exactly(fd, length, file_path):
+        """Read length bytes, completed with zeros past the end of file.
 
-        return len_deltas, modified_blocks
+        The size of the data is set in the file header, the data of a file
+        truncated since its deltas were computed is completed with zeros so
+        that the next files of the stream are restored from their own data.
+        """
+        data = fd.read(length)
+        if len(data) < length:
+            LOG.warning('[*] {} was truncated during the backup, its '
+                        'missing data is backed up as zeros'.format(
+                            file_path))
+            data += bytes(length - len(data))
+        return data
 
     def _backup_deltas(self, file_header, write_queue):
-        _, modified_blocks = file_header['deltas']
+        len_deltas, modified_blocks = file_header['deltas']
         rsync_bs = self.rsync_block_size
+        # Consecutive modified blocks are read at once
+        max_run = max(1, self.max_segment_size // rsync_bs)
         with open(file_header['path'], 'rb') as fd:
-            for block_index in modified_blocks:
-                offset = block_index * rsync_bs
-                fd.seek(offset)
-                data_block = fd.read(rsync_bs)
-                write_queue.put(data_block)
+            index = 0
+            while index < len(modified_blocks):
+                first_block = modified_blocks[index]
+                run = 1
+                while (run < max_run and
+                       index + run < len(modified_blocks) and
+                       modified_blocks[index + run] == first_block + run):
+                    run += 1
+                fd.seek(first_block * rsync_bs)
+                # Only the last modified block may be shorter than a block
+                length = min(run * rsync_bs, len_deltas)
+                write_queue.put(self._read_exactly(fd, length,
+                                                   file_header['path']))
+                len_deltas -= length
+                index += run
+
+    def _backup_patch(self, file_header, write_queue):
+        _, ops = file_header['patch']
+        max_seg_size = self.max_segment_size
+        position = 0
+        with open(file_header['path'], 'rb') as fd:
+            for offset, length in ops:
+                if offset < 0:
+                    fd.seek(position)
+                    remaining = length
+                    while remaining:
+                        data_block = self._read_exactly(
+                            fd, min(remaining, max_seg_size),
+                            file_header['path'])
+                        write_queue.put(data_block)
+                        remaining -= len(data_block)
+                position += length
+
+    @staticmethod
+    def _is_same_inode(old_inode, inode):
+        # Metadata written by previous versions has no inode numbers
+        return (old_inode.get('dev') == inode['dev'] and
+                old_inode.get('ino') == inode['ino'])
 
     @staticmethod
     def _is_file_modified(old_inode, inode):
@@ -434,8 +994,7 @@ class Rsyncv2Engine(engine.BackupEngine):
 
         return file_change_flag
 
-    def _patch_reg_file(self, file_path, size, data_stream, data_gen,
-                        deltas_info):
+    def _patch_reg_file(self, file_path, size, data_stream, deltas_info):
         len_deltas, modified_blocks = deltas_info
         rsync_bs = self.rsync_block_size
         if len_deltas:
@@ -444,52 +1003,40 @@ class Rsyncv2Engine(engine.BackupEngine):
             # Get all the block index offset from
             with open(file_path, 'rb+') as fd:
                 for block_index in modified_blocks:
-                    data_stream = self._patch_block(
-                        fd, block_index, data_stream, data_gen,
-                        rsync_bs, rsync_bs)
+                    self._patch_block(fd, block_index, data_stream,
+                                      rsync_bs, rsync_bs)
 
-                data_stream = self._patch_block(
-                    fd, last_block, data_stream, data_gen,
-                    reminder if reminder else rsync_bs, rsync_bs)
+                self._patch_block(fd, last_block, data_stream,
+                                  reminder if reminder else rsync_bs,
+                                  rsync_bs)
 
                 fd.truncate(size)
 
-        return data_stream
+    def _patch_block(self, fd, block_index, data_stream, size, bs):
+        fd.seek(block_index * bs)
+        self._write_data(fd, size, data_stream)
 
-    @staticmethod
-    def _patch_block(fd, block_index, data_stream, data_gen, size, bs):
-        offset = block_index * bs
-        fd.seek(offset)
-
-        data_stream_pos = data_stream.tell()
-        while (data_stream.len - data_stream.tell()) < size:
-            data_stream.write(data_gen.next().read())
-            data_stream.flush()
-            data_stream.seek(data_stream_pos)
-
-        fd.write(data_stream.read(size))
-        return data_stream
-
-    def _restore_reg_file(self, file_path, file_meta, data_gen, data_chunk):
+    def _restore_reg_file(self, file_path, file_meta, data_stream):
         """Create the regular file and write data on it.
 
-        :param size:
         :param file_path:
         :param file_meta:
-        :param data_gen:
-        :param data_chunk:
-        :return:
+        :param data_stream: streaming.ChunkReader of the backup data
         """
 
         new_level = file_meta.get('new_level', False)
         deltas = file_meta.get('deltas')
         size = file_meta['inode']['size']
-        if new_level and deltas:
-            return self._patch_reg_file(file_path, size, data_chunk,
-                                        data_gen, deltas)
+        if new_level and file_meta.get('patch'):
+            self._rebuild_reg_file(file_path, file_meta['patch'],
+                                   data_stream)
+        elif new_level and deltas:
+            self._patch_reg_file(file_path, size, data_stream, deltas)
+        elif 'extents' in file_meta:
+            self._create_sparse_file(file_path, size, file_meta['extents'],
+                                     data_stream)
         else:
-            return self._create_reg_file(file_path, size,
-                                         data_gen, data_chunk)
+            self._create_reg_file(file_path, size, data_stream)
 
     @staticmethod
     def _set_inode(file_path, inode):
@@ -517,13 +1064,12 @@ class Rsyncv2Engine(engine.BackupEngine):
             LOG.warning(
                 '[*] Unable to set inode info for {}'.format(file_path))
 
-    @staticmethod
-    def _parse_file_stat(os_stat):
+    def _parse_file_stat(self, os_stat):
         header_meta = {
             'mode': os_stat.st_mode,
             'dev': os_stat.st_dev,
-            'uname': pwd.getpwuid(os_stat.st_uid).pw_name,
-            'gname': grp.getgrgid(os_stat.st_gid).gr_name,
+            'uname': self._owner_names.user(os_stat.st_uid),
+            'gname': self._owner_names.group(os_stat.st_gid),
             'atime': os_stat.st_atime,
             'mtime': os_stat.st_mtime,
             'size': os_stat.st_size
@@ -532,56 +1078,76 @@ class Rsyncv2Engine(engine.BackupEngine):
         incremental_meta = {
             'mode': os_stat.st_mode,
             'ctime': os_stat.st_ctime,
-            'mtime': os_stat.st_mtime
+            'mtime': os_stat.st_mtime,
+            'size': os_stat.st_size,
+            'dev': os_stat.st_dev,
+            'ino': os_stat.st_ino
         }
 
         return header_meta, incremental_meta
 
-    def _get_file_stat(self, rel_path):
+    @staticmethod
+    def _lstat(rel_path):
+        try:
+            return os.lstat(rel_path)
+        except (OSError, IOError) as error:
+            raise Exception('[*] Error on file stat: {}'.format(error))
+
+    def _get_file_stat(self, rel_path, os_stat=None):
         """Generate file meta data from file path.
 
         Return the meta data as a two dicts: header and incremental
 
         :param rel_path: related file path
+        :param os_stat: stat of the file if already known
         :return: file meta as a two dicts
         """
 
         # Get file inode information
-        try:
-            os_stat = os.lstat(rel_path)
-        except (OSError, IOError) as error:
-            raise Exception('[*] Error on file stat: {}'.format(error))
+        if os_stat is None:
+            os_stat = self._lstat(rel_path)
 
         return self._parse_file_stat(os_stat)
 
-    def _backup_file(self, file_path, write_queue):
+    def _backup_file(self, file_path, write_queue, checksums=None):
         max_seg_size = self.max_segment_size
         with open(file_path, 'rb') as file_path_fd:
             data_block = file_path_fd.read(max_seg_size)
 
             while data_block:
+                if checksums:
+                    checksums.update(data_block)
                 write_queue.put(data_block)
                 data_block = file_path_fd.read(max_seg_size)
 
-    @staticmethod
-    def _find_same_inode(file_path, old_files):
-        """Find same file meta data for given file name.
+    def _backup_sparse_file(self, backup_meta, write_queue, checksums):
+        """Read the extents of data of a sparse file.
 
-        Return the same file name in incremental info if file was removed.
-
-        :param file_path: related file path
-        :return: the same file name
+        Exactly the length of the extents is backed up, the data of a file
+        truncated since is completed with zeros.
+        """
+        max_seg_size = self.max_segment_size
+        position = 0
+        with open(backup_meta['path'], 'rb') as fd:
+            for offset, length in backup_meta['extents']:
+                checksums.update_zeros(offset - position)
+                fd.seek(offset)
+                position = offset + length
+                while length:
+                    data_block = (fd.read(min(length, max_seg_size)) or
+                                  bytes(min(length, max_seg_size)))
+                    checksums.update(data_block)
+                    write_queue.put(data_block)
+                    length -= len(data_block)
+        checksums.update_zeros(backup_meta['inode']['size'] - position)
+
+    def _get_old_file_meta(self, file_path, file_stat, file_meta,
+                           old_fs_meta_struct):
+        """Find the meta data of the previous version of a file.
+
+        :return: the old meta data and the previous name of the file if it
+                 was renamed or moved since the previous backup
         """
-
-        file_name = os.path.basename(file_path)
-        for fn in iter(old_files.keys()):
-            base_name = os.path.basename(fn)
-            if fnmatch.fnmatch(base_name, '*' + file_name + '*'):
-                return base_name
-        return None
-
-    @staticmethod
-    def _get_old_file_meta(file_path, file_stat, old_fs_meta_struct):
         old_file_meta = None
         prev_name = None
         if old_fs_meta_struct:
@@ -592,12 +1158,15 @@ class Rsyncv2Engine(engine.BackupEngine):
                 if new_mode != old_mode:
                     old_file_meta = None
             except KeyError:
-                pass
+                prev_name = self._old_files.find_renamed(file_path, file_meta)
+                if prev_name:
+                    old_file_meta = old_fs_meta_struct[prev_name]
 
         return old_file_meta, prev_name
 
-    def _prepare_file_info(self, file_path, old_fs_meta_struct):
-        file_stat, file_meta = self._get_file_stat(file_path)
+    def _prepare_file_info(self, file_path, old_fs_meta_struct,
+                           os_stat=None):
+        file_stat, file_meta = self._get_file_stat(file_path, os_stat)
         file_mode = file_stat['mode']
 
         if stat.S_ISSOCK(file_mode):
@@ -609,43 +1178,108 @@ class Rsyncv2Engine(engine.BackupEngine):
             file_header['lname'] = os.readlink(file_path)
 
         old_file_meta, old_name = self._get_old_file_meta(
-            file_path, file_stat, old_fs_meta_struct)
+            file_path, file_stat, file_meta, old_fs_meta_struct)
         if old_name:
             file_header['prev_name'] = old_name
-
-        if old_file_meta:
+            # Only the same inode left unchanged is known to hold the same
+            # data. A file matched by size and time or by name may be
+            # another file, and most file systems change the ctime of a
+            # renamed file, so the others are compared with the previous
+            # version and only their modified blocks are backed up.
+            if (self._is_same_inode(old_file_meta, file_meta) and
+                    not self._is_file_modified(old_file_meta, file_meta)):
+                return (self._update_old_file_meta(old_file_meta, file_meta),
+                        file_header)
+            file_header['new_level'] = True
+        elif old_file_meta:
             if self._is_file_modified(old_file_meta, file_meta):
                 file_header['new_level'] = True
             else:
-                return old_file_meta, None
+                return (self._update_old_file_meta(old_file_meta, file_meta),
+                        None)
 
         if not stat.S_ISREG(file_mode):
             return file_meta, file_header
 
         if old_file_meta:
-            len_deltas, mod_blocks = self._get_deltas_info(file_path,
-                                                           old_file_meta)
-            if len_deltas:
-                file_header['deltas'] = (len_deltas, mod_blocks)
+            # Resolved once all the files are walked
+            file_header['deltas'] = self._get_deltas_info(file_path,
+                                                          old_file_meta)
 
         return file_meta, file_header
 
     def _get_file_meta(self, fn, fs_path, old_fs_meta_struct, files_meta,
-                       files_header, counts):
+                       files_header, counts, os_stat=None):
         file_path = os.path.relpath(fn, fs_path)
         header_append = files_header.append
-        counts['backup_size_on_disk'] += os.path.getsize(file_path)
-        meta, header = self._prepare_file_info(file_path, old_fs_meta_struct)
+        if os_stat is None:
+            os_stat = self._lstat(file_path)
+        counts['backup_size_on_disk'] += os_stat.st_size
+        meta, header = self._prepare_file_info(file_path, old_fs_meta_struct,
+                                               os_stat)
+        # The data of a file compared with its previous version is read by
+        # blocks, the holes are only skipped when it is backed up in full
+        if (header and stat.S_ISREG(os_stat.st_mode) and
+                'deltas' not in header and
+                ('new_level' in header or 'prev_name' not in header) and
+                _is_sparse(os_stat)):
+            extents = _data_extents(file_path, os_stat.st_size)
+            if extents != [[0, os_stat.st_size]]:
+                header['extents'] = extents
         if meta:
-            files_meta['files'][file_path] = meta
+            files_meta['files'].add(file_path, meta)
         if header:
             header_append(header)
 
-    def _backup_reg_file(self, backup_meta, write_queue):
+    def _copy_unchanged_dir(self, dir_path, fs_path, tracker,
+                            old_fs_meta_struct, files_meta, files_header,
+                            counts):
+        """Copy the meta data of the files of an unchanged directory.
+
+        The subdirectories and the files reported by the change log are
+        checked like in a listed directory.
+        """
+        dir_rel_path = os.path.relpath(dir_path, fs_path)
+        for file_path in tracker.children(dir_rel_path):
+            old_file_meta = old_fs_meta_struct[file_path]
+            is_dir = stat.S_ISDIR(old_file_meta['mode'])
+            if is_dir or tracker.is_changed(file_path):
+                abs_path = os.path.join(fs_path, file_path)
+                # A removed file is reported as deleted
+                if not os.path.lexists(abs_path):
+                    continue
+                self._get_file_meta(abs_path, fs_path, old_fs_meta_struct,
+                                    files_meta, files_header, counts)
+            else:
+                files_meta['files'].add(
+                    file_path, self._copy_old_signature(old_file_meta))
+                counts['backup_size_on_disk'] += old_file_meta.get('size',
+                                                                   0)
+            counts['total_dirs' if is_dir else 'total_files'] += 1
+        files_meta['files'].done(dir_rel_path)
+
+    def _backup_reg_file(self, backup_meta, file_meta, write_queue):
+        """Read the data of a file to back up.
+
+        The signature of the file is computed from the same read, unless
+        it is already known from the comparison with the previous version.
+        """
         if backup_meta.get('deltas'):
             self._backup_deltas(backup_meta, write_queue)
-        else:
+        elif backup_meta.get('patch'):
+            self._backup_patch(backup_meta, write_queue)
+        elif 'extents' in backup_meta:
+            checksums = pyrsync.BlockChecksums(self.rsync_block_size)
+            self._backup_sparse_file(backup_meta, write_queue, checksums)
+            file_meta['signature'] = self._signatures.add(
+                *checksums.digest())
+        elif 'signature' in file_meta:
             self._backup_file(backup_meta['path'], write_queue)
+        else:
+            checksums = pyrsync.BlockChecksums(self.rsync_block_size)
+            self._backup_file(backup_meta['path'], write_queue, checksums)
+            file_meta['signature'] = self._signatures.add(
+                *checksums.digest())
 
     def get_sign_delta(self, fs_path, manifest_path, write_queue):
         """Compute the file or fs tree path signatures.
@@ -659,7 +1293,6 @@ class Rsyncv2Engine(engine.BackupEngine):
         """
 
         files_meta = {
-            'files': {},
             'platform': sys.platform,
             'abs_backup_path': os.getcwd(),
             'rsync_struct_ver': RSYNC_DATA_STRUCT_VERSION,
@@ -671,86 +1304,254 @@ class Rsyncv2Engine(engine.BackupEngine):
             'backup_size_on_disk': 0,
         }
 
-        # Get old file meta structure or an empty dict if not available
-        old_fs_meta_struct, rsync_bs = self.get_fs_meta_struct(manifest_path)
+        try:
+            # Get old file meta structure or an empty dict if not available
+            old_fs_meta_struct, rsync_bs, self._old_signatures = (
+                self.get_fs_meta_struct(manifest_path))
+            self._old_files = OldFilesIndex(old_fs_meta_struct)
+            # The previous metadata is read while the new one is written
+            self._signatures = sigstore.SignatureWriter(
+                manifest_path + '.new', self.compression_algo)
+            files_meta['files'] = FilesMeta(self._signatures)
+            if self.rsync_workers > 1:
+                self._executor = futures.ProcessPoolExecutor(
+                    max_workers=self.rsync_workers,
+                    mp_context=multiprocessing.get_context(
+                        WORKER_START_METHOD))
+            try:
+                self._get_sign_delta(fs_path, write_queue, files_meta,
+                                     counts, old_fs_meta_struct, rsync_bs)
+            finally:
+                self._signatures.abort()
+                self._signatures = None
+                self._old_files = None
+                if self._old_signatures:
+                    self._old_signatures.close()
+                    self._old_signatures = None
+                if self._executor:
+                    self._executor.shutdown(wait=True, cancel_futures=True)
+                    self._executor = None
+                self._in_flight.clear()
+            os.replace(manifest_path + '.new', manifest_path)
+        except Exception as e:
+            LOG.exception(e)
+            self._sign_delta_error = e
+        finally:
+            # Put False on the queue so it will be terminated on the
+            # other side:
+            write_queue.put(False)
+
+    def _get_sign_delta(self, fs_path, write_queue, files_meta, counts,
+                        old_fs_meta_struct, rsync_bs):
         if rsync_bs and rsync_bs != self.rsync_block_size:
             LOG.warning('[*] Incremental backup will be performed '
                         'with rsync_block_size={}'.format(rsync_bs))
             self.rsync_block_size = rsync_bs
+            files_meta['rsync_block_size'] = rsync_bs
 
-        backup_header = []
+        # The headers of the files walked, by batch, written once the
+        # deltas of the next batch are submitted
+        batches = [[]]
+        renamed = set()
+        write_queue.put(msgpack.dumps(
+            {'rsync_struct_ver': RSYNC_DATA_STRUCT_VERSION}))
+
+        # Without the change log, the files modified in place in an
+        # unchanged directory would not be seen
+        changes = None
+        if self.change_log:
+            changes = changelog.take(self.change_log)
 
         # Grab list of all files and directories
         exclude = self.exclude
         if os.path.isdir(fs_path):
-            for dn, dl, fl in os.walk(fs_path):
-                for dir_name in dl:
-                    self._get_file_meta(os.path.join(dn, dir_name),
-                                        fs_path, old_fs_meta_struct,
-                                        files_meta, backup_header, counts)
+            tracker = None
+            if self.dir_change_tracking and changes is not None:
+                tracker = DirChangeTracker(fs_path, old_fs_meta_struct,
+                                           exclude, changes)
+            scan_time = time.time()
+            for dn, dl, fl in scanner.walk(
+                    fs_path, self.scan_workers,
+                    tracker.unchanged_subdirs if tracker else None):
+                if dl is None:
+                    self._copy_unchanged_dir(dn, fs_path, tracker,
+                                             old_fs_meta_struct, files_meta,
+                                             batches[-1], counts)
+                    self._rotate_batches(batches, files_meta, renamed,
+                                         write_queue)
+                    continue
+
+                entries = len(files_meta['files'])
+                for entry in dl:
+                    self._get_file_meta(entry.path, fs_path,
+                                        old_fs_meta_struct, files_meta,
+                                        batches[-1], counts,
+                                        entry.stat(follow_symlinks=False))
                     counts['total_dirs'] += 1
+                    self._rotate_batches(batches, files_meta, renamed,
+                                         write_queue)
 
                 if exclude:
-                    fl = (fn for fn in fl if not fnmatch.fnmatch(fn, exclude))
+                    fl = (entry for entry in fl
+                          if not fnmatch.fnmatch(entry.name, exclude))
 
-                for fn in fl:
-                    self._get_file_meta(os.path.join(dn, fn), fs_path,
+                for entry in fl:
+                    self._get_file_meta(entry.path, fs_path,
                                         old_fs_meta_struct, files_meta,
-                                        backup_header, counts)
+                                        batches[-1], counts,
+                                        entry.stat(follow_symlinks=False))
                     counts['total_files'] += 1
+                    self._rotate_batches(batches, files_meta, renamed,
+                                         write_queue)
+
+                # Recorded for the directory change tracking
+                dir_rel_path = os.path.relpath(dn, fs_path)
+                dir_meta = files_meta['files'].get(dir_rel_path)
+                if dir_meta is not None:
+                    dir_meta['entries'] = len(files_meta['files']) - entries
+                    dir_meta['listed'] = scan_time
+                    dir_meta['exclude'] = exclude
+                    files_meta['files'].done(dir_rel_path)
         else:
             self._get_file_meta(fs_path, os.getcwd(), old_fs_meta_struct,
-                                files_meta, backup_header, counts)
+                                files_meta, batches[-1], counts)
             counts['total_files'] += 1
 
-        # Check for deleted files
+        for backup_header in batches:
+            self._backup_batch(backup_header, files_meta, renamed,
+                               write_queue)
+
+        # Check for deleted files, known once all the files are walked
+        backup_header = []
         for del_file in (f for f in iter(old_fs_meta_struct.keys()) if
-                         f not in files_meta['files']):
+                         f not in files_meta['files'] and f not in renamed):
             backup_header.append({'path': del_file, 'deleted': True})
+            if len(backup_header) >= HEADER_BATCH_SIZE:
+                self._backup_batch(backup_header, files_meta, renamed,
+                                   write_queue)
+                backup_header = []
+        self._backup_batch(backup_header, files_meta, renamed, write_queue)
+
+        # End of the stream
+        write_queue.put(msgpack.dumps([]))
+
+        LOG.info("Backup session metrics: {0}".format(counts))
+        LOG.info("Count of modified blocks %s, count of fixed blocks %s" % (
+            self.modified_blocks, self.fixed_blocks))
+
+        self.write_engine_meta(files_meta)
+
+    def _rotate_batches(self, batches, files_meta, renamed, write_queue):
+        """Start a new batch of headers once the current one is full.
+
+        The previous batch is backed up first: the deltas of its files are
+        computed while the next batch is walked.
+        """
+        if len(batches[-1]) < HEADER_BATCH_SIZE:
+            return
+        if len(batches) > 1:
+            self._backup_batch(batches.pop(0), files_meta, renamed,
+                               write_queue)
+        batches.append([])
+
+    def _backup_batch(self, backup_header, files_meta, renamed, write_queue):
+        """Write the header of a batch of files followed by their data.
+
+        :param renamed: previous names of the files renamed, updated
+        """
+        if not backup_header:
+            # An empty header ends the stream
+            return
+
+        # Wait for the deltas of the modified files
+        for file_header in backup_header:
+            if 'prev_name' in file_header:
+                renamed.add(file_header['prev_name'])
+            if 'deltas' not in file_header:
+                continue
+            key, deltas, modified_blocks, fixed_blocks, signature = (
+                file_header.pop('deltas').result())
+            self.modified_blocks += modified_blocks
+            self.fixed_blocks += fixed_blocks
+            files_meta['files'].get(file_header['path'])['signature'] = (
+                self._signatures.add(*signature))
+            # A patch may rebuild a file without any new data
+            if deltas[0] or key == 'patch':
+                file_header[key] = deltas
+            elif 'prev_name' in file_header:
+                del file_header['new_level']
 
         # Write backup header
         write_queue.put(msgpack.dumps(backup_header))
 
         # Backup reg files
+        # The data of the files only renamed is in the previous backup
         reg_files = (f for f in backup_header if f.get('inode') and
-                     stat.S_ISREG(f['inode']['mode']))
+                     stat.S_ISREG(f['inode']['mode']) and
+                     ('new_level' in f or 'prev_name' not in f))
 
         for reg_file in reg_files:
-            self._backup_reg_file(reg_file, write_queue)
-            self._compute_checksums(reg_file['path'],
-                                    files_meta['files'][reg_file['path']])
-
-        LOG.info("Backup session metrics: {0}".format(counts))
-        LOG.info("Count of modified blocks %s, count of fixed blocks %s" % (
-            self.modified_blocks, self.fixed_blocks))
-
-        self.write_engine_meta(manifest_path, files_meta)
-
-        # Put False on the queue so it will be terminated on the other side:
-        write_queue.put(False)
+            self._backup_reg_file(
+                reg_file, files_meta['files'].get(reg_file['path']),
+                write_queue)
+            files_meta['files'].done(reg_file['path'])
 
-    def write_engine_meta(self, manifest_path, files_meta):
-        # Compress meta data file
-        # Write meta data to disk as JSON
-        with open(manifest_path, 'wb') as manifest_file:
-            cmp_meta = compress.one_shot_compress(
-                self.compression_algo, msgpack.dumps(files_meta))
-            manifest_file.write(cmp_meta)
+    def write_engine_meta(self, files_meta):
+        # The files meta data are stored with the signatures
+        files_meta['files'].close()
+        self._signatures.close(
+            dict((k, v) for k, v in files_meta.items() if k != 'files'))
 
     def get_fs_meta_struct(self, fs_meta_path):
+        """Load the engine metadata of the previous backup.
+
+        :return: files meta data, rsync block size and the signature store
+                 of the files, None if the signatures are embedded in the
+                 files meta data as done by previous versions
+        """
         old_files_meta = {}
+        old_fs_meta_struct = {}
+        old_signatures = None
 
         if os.path.isfile(fs_meta_path):
-            with open(fs_meta_path) as meta_file:
-                old_files_meta = msgpack.loads(compress.one_shot_decompress(
-                    self.compression_algo, meta_file.read()))
+            if sigstore.is_signature_store(fs_meta_path):
+                old_signatures = sigstore.SignatureReader(fs_meta_path)
+                old_files_meta, old_fs_meta_struct = (
+                    old_signatures.files_meta(self.compression_algo))
+            else:
+                with open(fs_meta_path, 'rb') as meta_file:
+                    old_files_meta = msgpack.loads(
+                        compress.one_shot_decompress(self.compression_algo,
+                                                     meta_file.read()))
+                old_fs_meta_struct = old_files_meta.get('files', {})
 
-        old_fs_meta_struct = old_files_meta.get('files', {})
         rsync_bs = old_files_meta.get('rsync_block_size')
 
-        return old_fs_meta_struct, rsync_bs
+        return old_fs_meta_struct, rsync_bs, old_signatures
+
+    def _old_signature(self, old_file_meta):
+        signature = old_file_meta['signature']
+        if self._old_signatures:
+            return self._old_signatures.signature(signature)
+        return sigstore.pack_signature(signature)
 
-    def _compute_checksums(self, rel_path, file_meta):
-        # Files type where the file content can be backed up
-        args = (rel_path, self.rsync_block_size)
-        file_meta['signature'] = pyrsync.blockchecksums(args)
+    def _update_old_file_meta(self, old_file_meta, file_meta):
+        """Meta data of a file whose data did not change since the previous
+        backup.
+        """
+        new_file_meta = dict(self._copy_old_signature(old_file_meta))
+        new_file_meta.update(file_meta)
+        return new_file_meta
+
+    def _copy_old_signature(self, old_file_meta):
+        """Store the signature of an unchanged file in the new metadata."""
+        if 'signature' not in old_file_meta:
+            return old_file_meta
+        file_meta = dict(old_file_meta)
+        if self._old_signatures:
+            file_meta['signature'] = self._signatures.add_raw(
+                self._old_signatures.raw(old_file_meta['signature']))
+        else:
+            file_meta['signature'] = self._signatures.add(
+                *sigstore.pack_signature(old_file_meta['signature']))
+        return file_meta
@@ -0,0 +1,274 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Binary signature store of the rsyncv2 engine metadata.
+
+The engine metadata file is laid out as::
+
+    MAGIC
+    signatures of the files: weak hashes then strong hashes, packed, and
+    frames of file records: compressed length (little endian uint32),
+        compressed msgpack [path, file meta data] records
+    header: msgpack of the backup meta data and of the frames offsets
+    footer: header offset and length (little endian uint64), MAGIC
+
+The meta data of a regular file references its signature as
+[offset, block count] instead of embedding it. The signatures are read
+from a memory map only for the files that changed, the others are copied
+as they are to the new metadata file. The records of the files are written
+as soon as they are known and are read back one frame at a time.
+
+The files written by previous versions (MAGIC_V1) end with the compressed
+msgpack of the whole meta data instead of the records and the header.
+"""
+
+import collections
+from collections import abc
+import mmap
+import struct
+
+import msgpack
+
+from freezer.engine.rsyncv2 import pyrsync
+from freezer.utils import compress
+
+MAGIC = b'FRZRSIG2'
+MAGIC_V1 = b'FRZRSIG1'
+_FOOTER = struct.Struct('<QQ')
+_FRAME_LENGTH = struct.Struct('<I')
+_WEAK_SIZE = 4
+_BLOCK_SIGNATURE_SIZE = _WEAK_SIZE + pyrsync.STRONG_SIZE
+
+# Size of the packed records compressed together
+FRAME_SIZE = 256 * 1024
+
+# Decoded frames kept by a reader for the lookups of the next files
+FRAME_CACHE_SIZE = 4
+
+
+def is_signature_store(path):
+    """
+    :return: True if the file at path is a signature store, False if it
+             is engine metadata written by a previous version
+    """
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) in (MAGIC, MAGIC_V1)
+
+
+def pack_signature(signature):
+    """
+    Packed form of a signature embedded in the metadata of previous versions.
+
+    :param signature: (weak hashes, strong hashes) as lists of ints and hex
+                      digests or already packed
+    :return: tuple of bytes (weak hashes, strong hashes)
+    """
+    weak, strong = signature
+    if isinstance(weak, (bytes, bytearray)):
+        return bytes(weak), bytes(strong)
+    return (struct.pack('<%dI' % len(weak), *weak),
+            b''.join(bytes.fromhex(digest) for digest in strong))
+
+
+class SignatureWriter(object):
+    """Writes an engine metadata file, as the files are processed."""
+
+    def __init__(self, path, compression_algo):
+        self._compression_algo = compression_algo
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._offset = len(MAGIC)
+        self._packer = msgpack.Packer()
+        self._records = []
+        self._records_size = 0
+        # [offset, record count] of each frame
+        self._frames = []
+
+    def add(self, weak, strong):
+        """
+        :param weak: packed weak hashes
+        :param strong: packed strong hashes
+        :return: reference of the signature to store in the file meta data
+        """
+        return self.add_raw(weak + strong)
+
+    def add_raw(self, data):
+        """
+        :param data: weak and strong hashes as stored by the writer
+        :return: reference of the signature to store in the file meta data
+        """
+        ref = [self._offset, len(data) // _BLOCK_SIGNATURE_SIZE]
+        self._write(data)
+        return ref
+
+    def add_record(self, path, file_meta):
+        """Store the meta data of a file."""
+        record = self._packer.pack([path, file_meta])
+        self._records.append(record)
+        self._records_size += len(record)
+        if self._records_size >= FRAME_SIZE:
+            self._flush_records()
+
+    def _write(self, data):
+        self._file.write(data)
+        self._offset += len(data)
+
+    def _flush_records(self):
+        if not self._records:
+            return
+        frame = compress.one_shot_compress(self._compression_algo,
+                                           b''.join(self._records))
+        self._frames.append([self._offset, len(self._records)])
+        self._write(_FRAME_LENGTH.pack(len(frame)))
+        self._write(frame)
+        self._records = []
+        self._records_size = 0
+
+    def close(self, metadata):
+        """
+        Write the header and the footer and close the file.
+
+        :param metadata: meta data of the backup, without the files
+        """
+        self._flush_records()
+        header = msgpack.dumps({'metadata': metadata,
+                                'compression': self._compression_algo,
+                                'frames': self._frames})
+        header_offset = self._offset
+        self._write(header)
+        self._write(_FOOTER.pack(header_offset, len(header)))
+        self._file.write(MAGIC)
+        self._file.close()
+
+    def abort(self):
+        self._file.close()
+
+
+class SignatureReader(object):
+    """Reads a signature store, the signatures are memory mapped."""
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        footer_offset = len(self._map) - _FOOTER.size - len(MAGIC)
+        self.magic = self._map[:len(MAGIC)]
+        if (self.magic not in (MAGIC, MAGIC_V1) or
+                self._map[footer_offset + _FOOTER.size:] != self.magic):
+            self.close()
+            raise ValueError('{0} is not a signature store'.format(path))
+        self._header_offset, self._header_len = _FOOTER.unpack_from(
+            self._map, footer_offset)
+
+    def _header_data(self):
+        return self._map[self._header_offset:
+                         self._header_offset + self._header_len]
+
+    def files_meta(self, compression_algo):
+        """
+        :param compression_algo: compression of the stores written by
+                                 previous versions
+        :return: meta data of the backup and a read only mapping of the
+                 files meta data
+        """
+        if self.magic == MAGIC_V1:
+            files_meta = msgpack.loads(compress.one_shot_decompress(
+                compression_algo, self._header_data()))
+            return files_meta, files_meta.pop('files', {})
+
+        header = msgpack.loads(self._header_data())
+        return header['metadata'], FileRecords(
+            self._map, header['compression'], header['frames'])
+
+    def raw(self, ref):
+        """
+        :param ref: signature reference from the file meta data
+        :return: weak and strong hashes as stored
+        """
+        offset, count = ref
+        return self._map[offset:offset + count * _BLOCK_SIGNATURE_SIZE]
+
+    def signature(self, ref):
+        """
+        :param ref: signature reference from the file meta data
+        :return: tuple of bytes (weak hashes, strong hashes)
+        """
+        offset, count = ref
+        weak_end = offset + count * _WEAK_SIZE
+        return (self._map[offset:weak_end],
+                self._map[weak_end:weak_end + count * pyrsync.STRONG_SIZE])
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class FileRecords(abc.Mapping):
+    """Files meta data of a signature store, by path.
+
+    Only the paths are held in memory, with the number of the frame holding
+    their record. The records are decoded one frame at a time.
+    """
+
+    def __init__(self, data, compression_algo, frames):
+        self._data = data
+        self._compression_algo = compression_algo
+        self._frames = frames
+        self._cache = collections.OrderedDict()
+        self._index = {}
+        for frame_no in range(len(frames)):
+            for path, _ in self._records(frame_no):
+                self._index[path] = frame_no
+
+    def _records(self, frame_no):
+        offset, _ = self._frames[frame_no]
+        length, = _FRAME_LENGTH.unpack_from(self._data, offset)
+        offset += _FRAME_LENGTH.size
+        unpacker = msgpack.Unpacker()
+        unpacker.feed(compress.one_shot_decompress(
+            self._compression_algo, self._data[offset:offset + length]))
+        return unpacker
+
+    def _frame(self, frame_no):
+        try:
+            self._cache.move_to_end(frame_no)
+            return self._cache[frame_no]
+        except KeyError:
+            pass
+        frame = dict(self._records(frame_no))
+        self._cache[frame_no] = frame
+        if len(self._cache) > FRAME_CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return frame
+
+    def __getitem__(self, path):
+        return self._frame(self._index[path])[path]
+
+    def __contains__(self, path):
+        return path in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def items(self):
+        """Iterate the records in the order they were written."""
+        for frame_no in range(len(self._frames)):
+            for path, file_meta in self._records(frame_no):
+                yield path, file_meta
@@ -47,7 +47,7 @@ class TarEngine(engine.BackupEngine):
         self.is_windows = winutils.is_windows()
         self.dry_run = dry_run
         self.max_segment_size = max_segment_size
-        super(TarEngine, self).__init__(storage=storage)
+        super(TarEngine, self).__init__(storage=storage, **kwargs)
 
     @property
     def name(self):
@@ -160,6 +160,8 @@ def get_tar_flag_from_algo(compression):
         'gzip': '-z',
         'bzip2': '-j',
         'xz': '-J',
+        'zstd': '--zstd',
+        'lz4': '--use-compress-program=lz4',
     }
     compression_exec = utils.get_executable_path(compression)
     if not compression_exec:
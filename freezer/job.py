@@ -197,6 +197,8 @@ class BackupJob(Job):
                                               self.conf.always_level):
                 raise Exception(
                     'backup-level options require the incremental option')
+            if self.conf.dir_change_tracking and not self.conf.change_log:
+                raise ValueError('--dir-change-tracking requires --change-log')
         elif self.conf.mode == 'nova':
             if self.conf.incremental:
                 raise ValueError("Incremental nova backup is not supported")
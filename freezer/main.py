@@ -88,21 +88,33 @@ def freezer_main(backup_args):
         # pylint: disable=abstract-class-instantiated
         storage = multiple.MultipleStorage(
             [storage_from_dict(x, max_segment_size)
-             for x in backup_args.storages])
+             for x in backup_args.storages],
+            queue_max_bytes=backup_args.queue_max_bytes)
     else:
         storage = storage_from_dict(backup_args.__dict__, max_segment_size)
 
     engine_loader = engine_manager.EngineManager()
     backup_args.engine = engine_loader.load_engine(
         compression=backup_args.compression,
+        compression_level=backup_args.compression_level,
+        compression_threads=backup_args.compression_threads,
+        adaptive_compression=backup_args.adaptive_compression,
         symlinks=backup_args.dereference_symlink,
         exclude=backup_args.exclude,
         storage=storage,
         max_segment_size=backup_args.max_segment_size,
+        queue_max_bytes=backup_args.queue_max_bytes,
         rsync_block_size=backup_args.rsync_block_size,
+        rsync_workers=backup_args.rsync_workers,
+        scan_workers=backup_args.scan_workers,
+        restore_workers=backup_args.restore_workers,
+        dir_change_tracking=backup_args.dir_change_tracking,
+        change_log=backup_args.change_log,
         encrypt_key=backup_args.encrypt_pass_file,
         temp_resource_prefix=backup_args.temp_resource_prefix,
-        dry_run=backup_args.dry_run
+        dry_run=backup_args.dry_run,
+        restore_prefetch_depth=backup_args.restore_prefetch_depth,
+        restore_spill_dir=backup_args.restore_spill_dir
     )
 
     if hasattr(backup_args, 'trickle_command'):
@@ -194,6 +206,22 @@ def fail(exit_code, e, quiet, do_log=True):
     return exit_code
 
 
+def transfer_options_from_dict(backup_args):
+    """
+    :param backup_args: agent arguments or a storage section of the config
+                        file, missing options fall back to the defaults
+    :return: keyword arguments for the parallel transfers of object storages
+    """
+    options = {}
+    for name in ('upload_concurrency', 'upload_buffer_size',
+                 'download_concurrency', 'download_buffer_size'):
+        value = backup_args.get(name)
+        if value is None:
+            value = freezer_config.DEFAULT_PARAMS[name]
+        options[name] = int(value)
+    return options
+
+
 def storage_from_dict(backup_args, max_segment_size):
     storage_name = backup_args['storage']
     container = backup_args['container']
@@ -202,14 +230,18 @@ def storage_from_dict(backup_args, max_segment_size):
         client_manager = backup_args['client_manager']
 
         storage = swift.SwiftStorage(
-            client_manager, container, max_segment_size)
+            client_manager, container, max_segment_size,
+            **transfer_options_from_dict(backup_args))
     elif storage_name == "s3":
         storage = s3.S3Storage(
             backup_args['access_key'],
             backup_args['secret_key'],
             backup_args['endpoint'],
             container,
-            max_segment_size
+            max_segment_size,
+            max_pool_connections=int(
+                backup_args.get('s3_max_pool_connections') or 0),
+            **transfer_options_from_dict(backup_args)
         )
     elif storage_name == "local":
         storage = local.LocalStorage(
@@ -26,21 +26,25 @@ LOG = log.getLogger(__name__)
 class MultipleStorage(base.Storage):
     _type = 'multiple'
 
-    def __init__(self, storages):
+    def __init__(self, storages, queue_max_bytes=None):
         """
         :param storages:
         :type storages: list[freezer.storage.base.Storage]
+        :param queue_max_bytes: maximum number of bytes queued for each
+                                storage, no limit if not set
         :return:
         """
         super(MultipleStorage, self).__init__()
         self.storages = storages
+        self.queue_max_bytes = queue_max_bytes or None
 
     def info(self):
         for s in self.storages:
             s.info()
 
     def write_backup(self, rich_queue, backup):
-        output_queues = [streaming.RichQueue() for x in self.storages]
+        output_queues = [streaming.RichQueue(max_bytes=self.queue_max_bytes)
+                         for x in self.storages]
         except_queues = [queue.Queue() for x in self.storages]
         threads = ([streaming.QueuedThread(storage.write_backup, output_queue,
                     except_queue, kwargs={"backup": backup}) for
@@ -56,6 +60,14 @@ class MultipleStorage(base.Storage):
         for thread in threads:
             thread.join()
 
+        for storage, output_queue in zip(self.storages, output_queues):
+            stats = output_queue.stats()
+            LOG.info('Storage {0} stream: {1} bytes in {2} messages, the '
+                     'backup waited {3:.2f}s for the storage and the storage '
+                     'waited {4:.2f}s for the backup'.format(
+                         storage.type, stats['bytes'], stats['messages'],
+                         stats['put_wait_time'], stats['get_wait_time']))
+
         def handle_exception_queue(except_queue):
             if not except_queue.empty:
                 while not except_queue.empty():
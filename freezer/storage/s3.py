@@ -13,34 +13,81 @@
 # limitations under the License.
 
 import botocore
+import botocore.config
 import botocore.session
 import logging
+import os
 import requests
+import threading
 
 from oslo_log import log
 from oslo_serialization import jsonutils as json
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
+from freezer.storage import exceptions
 from freezer.storage import physical
+from freezer.storage import transfer
 from freezer.utils import utils
 
 LOG = log.getLogger(__name__)
 logging.getLogger('botocore').setLevel(logging.WARNING)
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+# botocore default size of the client connection pool
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+# Serializes the creation of the S3 clients, the process id is checked under
+# it so that the first threads of a forked process share a single client
+_client_lock = threading.Lock()
+
+
+def _reset_client_lock():
+    # The lock may have been held by another thread at fork time
+    global _client_lock
+    _client_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_client_lock)
+
 
 class S3Storage(physical.PhysicalStorage):
 
     _type = 's3'
 
     def __init__(self, access_key, secret_key, endpoint, container,
-                 max_segment_size, skip_prepare=False):
+                 max_segment_size, skip_prepare=False, upload_concurrency=1,
+                 upload_buffer_size=None, download_concurrency=1,
+                 download_buffer_size=None, max_pool_connections=None):
         """
         :type container: str
+        :param upload_concurrency: number of parts uploaded in parallel
+        :type upload_concurrency: int
+        :param upload_buffer_size: maximum bytes of parts in flight
+        :type upload_buffer_size: int
+        :param download_concurrency: number of byte ranges downloaded in
+                                     parallel on restore
+        :type download_concurrency: int
+        :param download_buffer_size: maximum bytes downloaded ahead of the
+                                     restore
+        :type download_buffer_size: int
+        :param max_pool_connections: size of the HTTP connection pool of the
+                                     S3 client, by default big enough for
+                                     the parallel transfers
+        :type max_pool_connections: int
         """
         self.access_key = access_key
         self.secret_key = secret_key
         self.endpoint = endpoint
+        self.upload_concurrency = upload_concurrency
+        self.upload_buffer_size = upload_buffer_size
+        self.download_concurrency = download_concurrency
+        self.download_buffer_size = download_buffer_size
+        self.max_pool_connections = max_pool_connections or max(
+            upload_concurrency or 1, download_concurrency or 1,
+            DEFAULT_MAX_POOL_CONNECTIONS)
+        self._s3_client = None
+        self._s3_client_pid = None
         super(S3Storage, self).__init__(
             storage_path=container,
             max_segment_size=max_segment_size,
@@ -80,15 +127,29 @@ class S3Storage(physical.PhysicalStorage):
 
     def get_s3_connection(self):
         """
+        Return the S3 client of this storage, creating it on first use.
+
+        botocore clients are thread safe, so a single client (and its
+        connection pool) is shared by all the threads using the storage.
+        A forked process, as the ones reading the backup blocks on restore,
+        can not reuse the sockets of its parent and gets a new client.
+
         :rtype: s3client.Connection
         :return:
         """
-        return botocore.session.get_session().create_client(
-            's3',
-            aws_access_key_id=self.access_key,
-            aws_secret_access_key=self.secret_key,
-            endpoint_url=self.endpoint
-        )
+        with _client_lock:
+            pid = os.getpid()
+            if self._s3_client_pid != pid:
+                self._s3_client = botocore.session.get_session().create_client(
+                    's3',
+                    aws_access_key_id=self.access_key,
+                    aws_secret_access_key=self.secret_key,
+                    endpoint_url=self.endpoint,
+                    config=botocore.config.Config(
+                        max_pool_connections=self.max_pool_connections)
+                )
+                self._s3_client_pid = pid
+            return self._s3_client
 
     def prepare(self):
         """
@@ -148,41 +209,57 @@ class S3Storage(physical.PhysicalStorage):
             ContentLength=len(json.dumps(headers)),
         )
 
+    @staticmethod
+    def _parts_body(stream):
+        for index, el in enumerate(stream):
+            if isinstance(el, str):
+                yield el.encode('utf-8')
+            elif isinstance(el, bytes):
+                yield el
+            else:
+                LOG.error(f"Stream yielded unexpected type {type(el)} "
+                          f"for part {index + 1}. Skipping.")
+
     def upload_stream(self, backup_basepath, stream):
-        upload_id = self.get_s3_connection().create_multipart_upload(
+        """
+        Upload the stream as a multipart upload, several parts at the same
+        time. A failing part is retried on its own, the whole upload is
+        aborted only when a part can not be uploaded at all.
+
+        :param backup_basepath: object key
+        :param stream: iterable of parts content
+        """
+        s3_client = self.get_s3_connection()
+        upload_id = s3_client.create_multipart_upload(
             Bucket=self.get_bucket_name(),
             Key=backup_basepath
         )['UploadId']
-        upload_part_index = 1
-        uploaded_parts = []
-        try:
-            for el in stream:
-                if isinstance(el, str):
-                    body_bytes = el.encode('utf-8')
-                elif isinstance(el, bytes):
-                    body_bytes = el
-                else:
-                    LOG.error(f"Stream yielded unexpected type {type(el)} "
-                              "for part {upload_part_index}. Skipping.")
-                    continue
-                response = self.get_s3_connection().upload_part(
+
+        def upload_part(index, body_bytes):
+            part_number = index + 1
+            response = transfer.retry_with_backoff(
+                lambda: s3_client.upload_part(
                     Body=body_bytes,
                     Bucket=self.get_bucket_name(),
                     Key=backup_basepath,
-                    PartNumber=upload_part_index,
+                    PartNumber=part_number,
                     UploadId=upload_id,
                     ContentLength=len(body_bytes),
-                )
-                uploaded_parts.append({
-                    'PartNumber': upload_part_index,
-                    'ETag': response['ETag']
-                })
-                upload_part_index += 1
-            # Complete the upload, which requires info on all of the parts
-            part_info = {
-                'Parts': uploaded_parts
+                ),
+                'upload of part {0} of {1}'.format(part_number,
+                                                   backup_basepath))
+            return {
+                'PartNumber': part_number,
+                'ETag': response['ETag']
             }
 
+        try:
+            uploaded_parts = transfer.ParallelUploader(
+                upload_part,
+                concurrency=self.upload_concurrency,
+                max_buffer_size=self.upload_buffer_size).upload(
+                self._parts_body(stream))
+
             if not uploaded_parts:
                 # currently, not support volume boot instance
                 LOG.error(
@@ -192,7 +269,11 @@ class S3Storage(physical.PhysicalStorage):
                     'No part uploaded(not support volume boot instance)'
                 )
 
-            self.get_s3_connection().complete_multipart_upload(
+            # Complete the upload, which requires info on all of the parts
+            part_info = {
+                'Parts': uploaded_parts
+            }
+            s3_client.complete_multipart_upload(
                 Bucket=self.get_bucket_name(),
                 Key=backup_basepath,
                 MultipartUpload=part_info,
@@ -201,11 +282,33 @@ class S3Storage(physical.PhysicalStorage):
         except Exception as e:
             LOG.error("Upload stream to S3 error, so abort it. "
                       "Exception: {0}".format(e))
-            self.get_s3_connection().abort_multipart_upload(
+            s3_client.abort_multipart_upload(
                 Bucket=self.get_bucket_name(),
                 Key=backup_basepath,
                 UploadId=upload_id
             )
+            raise exceptions.StorageException(
+                "Upload stream to S3 failed: {0}".format(e))
+
+    def get_object_range(self, bucket_name, key, start, end):
+        """
+        Download the bytes start to end (inclusive) of an object, retrying
+        with exponential backoff.
+        """
+        def get_range():
+            return self.get_s3_connection().get_object(
+                Bucket=bucket_name,
+                Key=key,
+                Range='bytes={0}-{1}'.format(start, end)
+            )['Body'].read()
+
+        try:
+            return transfer.retry_with_backoff(
+                get_range, 'download of bytes {0}-{1} of {2}'.format(
+                    start, end, key))
+        except Exception as e:
+            raise exceptions.StorageException(
+                "Download from S3 failed: {0}".format(e))
 
     def backup_blocks(self, backup):
         """
@@ -214,6 +317,21 @@ class S3Storage(physical.PhysicalStorage):
         :return:
         """
         split = backup.data_path.split('/', 1)
+        if self.download_concurrency > 1:
+            size = self.get_s3_connection().head_object(
+                Bucket=split[0],
+                Key=split[1]
+            )['ContentLength']
+            ranges = [((offset, min(offset + self.max_segment_size, size) - 1),
+                       min(self.max_segment_size, size - offset))
+                      for offset in range(0, size, self.max_segment_size)]
+            downloader = transfer.ParallelDownloader(
+                lambda byte_range: self.get_object_range(
+                    split[0], split[1], *byte_range),
+                concurrency=self.download_concurrency,
+                max_buffer_size=self.download_buffer_size)
+            return downloader.download(ranges)
+
         s3_object = self.get_s3_connection().get_object(
             Bucket=split[0],
             Key=split[1]
@@ -14,13 +14,15 @@
 
 
 import os
-import time
+import threading
 
 from oslo_log import log
 import requests
 from requests.packages import urllib3
 
+from freezer.storage import exceptions
 from freezer.storage import physical
+from freezer.storage import transfer
 
 LOG = log.getLogger(__name__)
 
@@ -51,12 +53,29 @@ class SwiftStorage(physical.PhysicalStorage):
                                     content_length=file_size)
 
     def __init__(self, client_manager, container, max_segment_size,
-                 skip_prepare=False):
+                 skip_prepare=False, upload_concurrency=1,
+                 upload_buffer_size=None, download_concurrency=1,
+                 download_buffer_size=None):
         """
         :type client_manager: freezer.osclients.OSClientManager
         :type container: str
+        :param upload_concurrency: number of segments uploaded in parallel
+        :type upload_concurrency: int
+        :param upload_buffer_size: maximum bytes of segments in flight
+        :type upload_buffer_size: int
+        :param download_concurrency: number of segments downloaded in
+                                     parallel on restore
+        :type download_concurrency: int
+        :param download_buffer_size: maximum bytes of segments downloaded
+                                     ahead of the restore
+        :type download_buffer_size: int
         """
         self.client_manager = client_manager
+        self.upload_concurrency = upload_concurrency
+        self.upload_buffer_size = upload_buffer_size
+        self.download_concurrency = download_concurrency
+        self.download_buffer_size = download_buffer_size
+        self._worker_connections = threading.local()
         super(SwiftStorage, self).__init__(
             storage_path=container,
             max_segment_size=max_segment_size,
@@ -71,37 +90,67 @@ class SwiftStorage(physical.PhysicalStorage):
         """
         return self.client_manager.create_swift()
 
+    def _worker_connection(self):
+        """
+        Swift client used by the current transfer worker. swiftclient
+        connections are not thread safe, so every worker keeps its own one
+        and re-uses it (and its auth token) for all the segments it uploads
+        or downloads.
+
+        :rtype: swiftclient.Connection
+        """
+        connection = getattr(self._worker_connections, 'connection', None)
+        if connection is None:
+            connection = self.swift()
+            self._worker_connections.connection = connection
+        return connection
+
+    def _reset_worker_connection(self, error=None):
+        self._worker_connections.connection = None
+
     def upload_chunk(self, content, path):
         """
+        Upload a single object, retrying with exponential backoff.
         """
         # If for some reason the swift client object is not available anymore
-        # an exception is generated and a new client object is initialized/
-        # If the exception happens for 10 consecutive times for a total of
-        # 1 hour, then the program will exit with an Exception.
-
-        count = 0
-        success = False
+        # an exception is generated and a new client object is initialized.
+        # If the exception happens for MAX_RETRIES consecutive times, then the
+        # program will exit with an Exception.
         split = path.rsplit('/', 1)
-        while not success:
-            try:
-                LOG.debug(
-                    'Uploading file chunk index: {0}'.format(path))
-                self.swift().put_object(
-                    split[0], split[1], content,
-                    content_type='application/octet-stream',
-                    content_length=len(content))
-                LOG.debug('Data successfully uploaded!')
-                success = True
-            except Exception as error:
-                LOG.info(
-                    'Retrying to upload file chunk index: {0}'.format(
-                        path))
-                time.sleep(60)
-                count += 1
-                if count == 10:
-                    LOG.critical('Error: add_object: {0}'
-                                 .format(error))
-                    raise Exception("cannot add object to storage")
+
+        def put_chunk():
+            LOG.debug(
+                'Uploading file chunk index: {0}'.format(path))
+            self._worker_connection().put_object(
+                split[0], split[1], content,
+                content_type='application/octet-stream',
+                content_length=len(content))
+            LOG.debug('Data successfully uploaded!')
+
+        try:
+            transfer.retry_with_backoff(
+                put_chunk, 'upload of file chunk {0}'.format(path),
+                on_error=self._reset_worker_connection)
+        except Exception:
+            raise exceptions.StorageException(
+                "cannot add object to storage")
+
+    def upload_segments(self, stream, segments_path):
+        """
+        Upload the stream as numbered segments, several of them at the same
+        time. Returns only when every segment is stored.
+
+        :param stream: iterable of segments content
+        :param segments_path: container/prefix of the segments
+        """
+        def upload_segment(index, content):
+            self.upload_chunk(
+                content, '{0}/{1}'.format(segments_path, "%08d" % index))
+
+        transfer.ParallelUploader(
+            upload_segment,
+            concurrency=self.upload_concurrency,
+            max_buffer_size=self.upload_buffer_size).upload(stream)
 
     def upload_manifest(self, backup):
         """
@@ -158,14 +207,9 @@ class SwiftStorage(physical.PhysicalStorage):
                 obj_fd.write(obj_chunk)
 
     def add_stream(self, stream, package_name, headers=None):
-        i = 0
         backup_basepath = "{0}/{1}".format(self.container, self.segments)
-        for el in stream:
-            upload_path = "{0}/{1}/segments/{2}".format(backup_basepath,
-                                                        package_name,
-                                                        "%08d" % i)
-            self.upload_chunk(el, upload_path)
-            i += 1
+        self.upload_segments(stream, "{0}/{1}/segments".format(
+            backup_basepath, package_name))
         if not headers:
             headers = {}
 
@@ -178,6 +222,35 @@ class SwiftStorage(physical.PhysicalStorage):
         self.swift().put_object(container=full_path, obj=objname, contents='',
                                 content_length=len(''), headers=headers)
 
+    def download_segment(self, path):
+        """
+        Download a single object, retrying with exponential backoff.
+        """
+        split = path.split('/', 1)
+
+        def get_segment():
+            return self._worker_connection().get_object(
+                split[0], split[1])[1]
+
+        try:
+            return transfer.retry_with_backoff(
+                get_segment, 'download of segment {0}'.format(path),
+                on_error=self._reset_worker_connection)
+        except Exception:
+            raise exceptions.StorageException(
+                "cannot get object from storage")
+
+    def list_segments(self, segments_path):
+        """
+        :param segments_path: container/prefix of the segments
+        :return: list of (path, size) of the segments, in upload order
+        """
+        split = segments_path.split('/', 1)
+        objects = self.swift().get_container(
+            split[0], prefix="{0}/".format(split[1]), full_listing=True)[1]
+        return sorted(("{0}/{1}".format(split[0], obj['name']), obj['bytes'])
+                      for obj in objects)
+
     def backup_blocks(self, backup):
         """
 
@@ -185,6 +258,17 @@ class SwiftStorage(physical.PhysicalStorage):
         :type backup: freezer.storage.base.Backup
         :return:
         """
+        if self.download_concurrency > 1:
+            segments = self.list_segments(backup.segments_path)
+            if segments:
+                downloader = transfer.ParallelDownloader(
+                    self.download_segment,
+                    concurrency=self.download_concurrency,
+                    max_buffer_size=self.download_buffer_size)
+                for chunk in downloader.download(segments):
+                    yield chunk
+                return
+
         split = backup.data_path.split('/', 1)
         try:
             chunks = self.swift().get_object(
@@ -206,10 +290,9 @@ class SwiftStorage(physical.PhysicalStorage):
         :type backup: freezer.storage.base.Backup
         """
         backup = backup.copy(storage=self)
-        for block_index, message in enumerate(rich_queue.get_messages()):
-            segment_package_name = '{0}/{1}'.format(
-                backup.segments_path, "%08d" % block_index)
-            self.upload_chunk(message, segment_package_name)
+        # The manifest makes the segments visible as a single object, so it
+        # is uploaded only once all of them have been confirmed.
+        self.upload_segments(rich_queue.get_messages(), backup.segments_path)
         self.upload_manifest(backup)
 
     def listdir(self, path):
@@ -0,0 +1,192 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Helpers to move backup data between freezer and object storages
+"""
+
+import collections
+from concurrent import futures
+import threading
+import time
+
+from oslo_log import log
+
+LOG = log.getLogger(__name__)
+
+# Number of attempts made for every single segment/part before giving up
+MAX_RETRIES = 10
+# Exponential backoff between attempts: 1, 2, 4, ... seconds, capped
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 60
+
+
+def retry_with_backoff(func, description, max_retries=MAX_RETRIES,
+                       on_error=None):
+    """Call func until it succeeds or max_retries attempts are exhausted.
+
+    :param func: callable without arguments
+    :param description: what is being retried, used for logging
+    :param max_retries: total number of attempts
+    :param on_error: optional callable invoked with the exception after each
+                     failed attempt, e.g. to drop a broken connection
+    :return: whatever func returns
+    """
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as error:
+            attempt += 1
+            if on_error:
+                on_error(error)
+            if attempt >= max_retries:
+                LOG.critical('Error: {0} failed after {1} attempts: {2}'
+                             .format(description, attempt, error))
+                raise
+            delay = min(RETRY_BASE_DELAY * 2 ** (attempt - 1),
+                        RETRY_MAX_DELAY)
+            LOG.info('Retrying {0} in {1} seconds (attempt {2}/{3}): {4}'
+                     .format(description, delay, attempt + 1, max_retries,
+                             error))
+            time.sleep(delay)
+
+
+class ParallelUploader(object):
+    """
+    Uploads numbered chunks of a stream concurrently.
+
+    At most ``concurrency`` chunks are in flight at the same time and, when
+    ``max_buffer_size`` is set, the total size of the chunks in flight never
+    exceeds it (a single chunk bigger than the budget is still uploaded, on
+    its own). Consuming the input stream blocks while the limits are reached,
+    so the producer is throttled to the speed of the storage.
+    """
+
+    def __init__(self, upload_func, concurrency=1, max_buffer_size=None):
+        """
+        :param upload_func: callable(index, chunk) uploading a single chunk
+        :type concurrency: int
+        :type max_buffer_size: int
+        """
+        self.upload_func = upload_func
+        self.concurrency = max(1, int(concurrency or 1))
+        self.max_buffer_size = max_buffer_size
+        self._cond = threading.Condition()
+        self._inflight_count = 0
+        self._inflight_bytes = 0
+        self._error = None
+
+    def _acquire(self, size):
+        with self._cond:
+            while self._error is None and self._inflight_count and (
+                    self._inflight_count >= self.concurrency or (
+                        self.max_buffer_size and
+                        self._inflight_bytes + size > self.max_buffer_size)):
+                self._cond.wait()
+            self._inflight_count += 1
+            self._inflight_bytes += size
+            return self._error is None
+
+    def _release(self, size, error=None):
+        with self._cond:
+            self._inflight_count -= 1
+            self._inflight_bytes -= size
+            if error is not None and self._error is None:
+                self._error = error
+            self._cond.notify_all()
+
+    def _upload(self, index, chunk):
+        try:
+            result = self.upload_func(index, chunk)
+        except Exception as e:
+            self._release(len(chunk), e)
+            raise
+        self._release(len(chunk))
+        return result
+
+    def upload(self, chunks):
+        """Upload every chunk of the iterable.
+
+        :param chunks: iterable of bytes
+        :return: list of upload_func results, in chunk order
+        :raise: the first error raised by upload_func
+        """
+        uploads = []
+        executor = futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            for index, chunk in enumerate(chunks):
+                if not self._acquire(len(chunk)):
+                    self._release(len(chunk))
+                    break
+                uploads.append(executor.submit(self._upload, index, chunk))
+        finally:
+            executor.shutdown(wait=True)
+
+        if self._error is not None:
+            raise self._error
+        return [upload.result() for upload in uploads]
+
+
+class ParallelDownloader(object):
+    """
+    Downloads the parts of an object concurrently and yields them in order.
+
+    Parts are fetched ahead of the consumer: at most ``concurrency`` of them
+    are downloading or waiting to be consumed and, when ``max_buffer_size``
+    is set, their total size never exceeds it (a single part bigger than
+    the budget is still fetched, on its own). A part is released as soon as
+    it is yielded, so the memory used is bounded whatever the object size.
+    """
+
+    def __init__(self, download_func, concurrency=1, max_buffer_size=None):
+        """
+        :param download_func: callable(part) returning the part content
+        :type concurrency: int
+        :type max_buffer_size: int
+        """
+        self.download_func = download_func
+        self.concurrency = max(1, int(concurrency or 1))
+        self.max_buffer_size = max_buffer_size
+
+    def download(self, parts):
+        """Generator downloading every part of the iterable.
+
+        :param parts: iterable of (part, size) tuples, part is given to
+                      download_func and size is the expected content length
+        :return: generator of download_func results, in parts order
+        :raise: the error raised by download_func for the first failed part
+        """
+        parts = iter(parts)
+        pending = collections.deque()
+        pending_bytes = 0
+        executor = futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            next_part = next(parts, None)
+            while next_part is not None or pending:
+                while next_part is not None and (not pending or (
+                        len(pending) < self.concurrency and (
+                            not self.max_buffer_size or
+                            pending_bytes + next_part[1] <=
+                            self.max_buffer_size))):
+                    part, size = next_part
+                    pending.append(
+                        (executor.submit(self.download_func, part), size))
+                    pending_bytes += size
+                    next_part = next(parts, None)
+                download, size = pending.popleft()
+                pending_bytes -= size
+                yield download.result()
+        finally:
+            for download, size in pending:
+                download.cancel()
+            executor.shutdown(wait=True)
@@ -0,0 +1,89 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compare the packed signatures of the rsyncv2 engine to the per block
+signatures of the previous versions.
+
+Usage: python -m freezer.tests.benchmarks.rsyncv2_signatures [size_mb]
+       [block_size] [file]
+
+Without a file, a file of random data of size_mb MB is generated.
+"""
+
+import hashlib
+import os
+import sys
+import tempfile
+import time
+import zlib
+
+import msgpack
+
+from freezer.engine.rsyncv2 import pyrsync
+
+
+def _per_block_checksums(path, block_size):
+    """Signature of the previous versions, hashed block by block."""
+    weak = []
+    strong = []
+    with open(path, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            weak.append(zlib.adler32(block) & 0xffffffff)
+            strong.append(hashlib.sha1(block).hexdigest())
+            block = f.read(block_size)
+    return weak, strong
+
+
+def _measure(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def main(argv):
+    size_mb = int(argv[1]) if len(argv) > 1 else 256
+    block_size = int(argv[2]) if len(argv) > 2 else 4096
+    path = argv[3] if len(argv) > 3 else None
+
+    tmp_path = None
+    if not path:
+        fd, tmp_path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            for i in range(size_mb):
+                f.write(os.urandom(1024 * 1024))
+        path = tmp_path
+
+    try:
+        size = os.path.getsize(path)
+        print('File: {0} bytes, block size {1}'.format(size, block_size))
+
+        paths = (
+            ('per block',
+             lambda: _per_block_checksums(path, block_size)),
+            ('packed',
+             lambda: pyrsync.blockchecksums_packed(path, block_size)))
+
+        for name, func in paths:
+            elapsed, signature = _measure(func)
+            print('{0:>10}: {1:8.3f}s {2:10.1f} MB/s {3:12d} bytes of '
+                  'manifest'.format(name, elapsed,
+                                    size / elapsed / 1024 / 1024,
+                                    len(msgpack.dumps(signature))))
+    finally:
+        if tmp_path:
+            os.unlink(tmp_path)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,69 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compare the assembly of an engine output segment by bytes concatenation
+and with streaming.SegmentAssembler.
+
+Usage: python -m freezer.tests.benchmarks.segment_assembly [segment_mb]
+       [block_size ...]
+
+The copy volume is the number of bytes copied to build one segment.
+"""
+
+import sys
+import time
+
+from freezer.utils import streaming
+
+
+def _concatenate(blocks, segment_size):
+    data_chunk = b''
+    copied = 0
+    for block in blocks:
+        data_chunk += block
+        copied += len(data_chunk)
+        if len(data_chunk) >= segment_size:
+            break
+    return data_chunk, copied
+
+
+def _assemble(blocks, segment_size):
+    segment = streaming.SegmentAssembler()
+    for block in blocks:
+        segment.append(block)
+        if len(segment) >= segment_size:
+            break
+    size = len(segment)
+    return segment.take(), size
+
+
+def main(argv):
+    segment_size = (int(argv[1]) if len(argv) > 1 else 32) * 1024 * 1024
+    block_sizes = [int(b) for b in argv[2:]] or [4096, 65536, 1048576]
+
+    print('Segment: {0} bytes'.format(segment_size))
+    for block_size in block_sizes:
+        block = b'\0' * block_size
+        blocks = [block] * (-(-segment_size // block_size))
+        for name, func in (('concat', _concatenate),
+                           ('assembler', _assemble)):
+            start = time.perf_counter()
+            segment, copied = func(blocks, segment_size)
+            elapsed = time.perf_counter() - start
+            print('{0:>8} B blocks {1:>10}: {2:8.3f}s {3:10.1f} MB copied '
+                  'per segment'.format(block_size, name, elapsed,
+                                       copied / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -427,6 +427,8 @@ class BackupOpt1(object):
         self.tar_path = 'true'
         self.incremental = False
         self.exclude = 'true'
+        self.dir_change_tracking = False
+        self.change_log = None
         self.encrypt_pass_file = 'true'
         self.openssl_path = 'true'
         self.always_level = '0'
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import unittest
+from unittest import mock
 
 import io
 
@@ -54,3 +55,36 @@ class TestPyrsync(unittest.TestCase):
             cur_index += 1
         exp_changed_indexes = [0, 2]
         self.assertEqual(changed_indexes[:-1], exp_changed_indexes)
+
+    def test_weakchecksum(self):
+        data = b'\x01\x02\xff\x00\x10'
+        a = sum(data)
+        b = sum((len(data) - i) * byte for i, byte in enumerate(data))
+        self.assertEqual(((b << 16) | a, a, b), pyrsync.weakchecksum(data))
+        self.assertEqual((0, 0, 0), pyrsync.weakchecksum(b''))
+
+    def _delta(self, old, new, blocksize):
+        signature = pyrsync.blockchecksums(io.BytesIO(old), blocksize)
+        return list(pyrsync.rsyncdelta(io.BytesIO(new), signature,
+                                       blocksize))
+
+    def test_rsyncdelta_shifted(self):
+        old = b''.join(bytes([i]) * 4 for i in range(1, 9))
+        self.assertEqual([b'x', 0, 1, 2, 3, 4, 5, 6, 7, b''],
+                         self._delta(old, b'x' + old, 4))
+        self.assertEqual([0, 1, b'\x03\x03', 3, 4, 5, 6, 7, b''],
+                         self._delta(old, old[:10] + old[12:], 4))
+
+    def test_rsyncdelta_read_buffer(self):
+        old = bytes(range(100)) * 3
+        new = old[:50] + b'abc' + old[50:250] + old[260:]
+        expected = self._delta(old, new, 16)
+        for size in (1, 7, 100):
+            with mock.patch.object(pyrsync, 'READ_BUFFER_SIZE', size):
+                self.assertEqual(expected, self._delta(old, new, 16))
+
+    def test_rsyncdelta_match_after_end(self):
+        # the shrinking window at the end of the data matches a block
+        self.assertEqual([b'\x01', 1, b''],
+                         self._delta(b'\x02\x00\x00\x00\x00\x00',
+                                     b'\x01\x00\x00\x00\x00\x00', 3))
@@ -183,6 +183,7 @@ class TestRsyncEngine(unittest.TestCase):
         expect = {
             "engine_name": self.name,
             "compression": self.compression_algo,
+            "compression_frames": False,
             "encryption": bool(self.encrypt_file)
         }
         self.assertEqual(ret, expect)
@@ -1715,7 +1716,7 @@ class TestRsyncEngine(unittest.TestCase):
 
         mock_os_path_relpath.assert_called_with(file_path, fs_path)
         mock_get_old_file_meta.assert_called_with(old_fsmetastruct, rel_path)
-        mock_get_file_struct.assert_called_with(rel_path, True)
+        mock_get_file_struct.assert_called_with(rel_path, True, None)
         mock_os_path_isdir.assert_called_with(file_path)
         mock_os_path_getsize.assert_called_with(rel_path)
         mock_gen_file_header.assert_called_with(rel_path, inode_str_struct)
@@ -1772,7 +1773,7 @@ class TestRsyncEngine(unittest.TestCase):
 
         mock_os_path_relpath.assert_called_with(file_path, fs_path)
         mock_get_old_file_meta.assert_called_with(old_fsmetastruct, rel_path)
-        mock_get_file_struct.assert_called_with(rel_path, True)
+        mock_get_file_struct.assert_called_with(rel_path, True, None)
         mock_os_path_isdir.assert_called_with(file_path)
         mock_compute_incrementals.assert_called_with(rel_path,
                                                      inode_str_struct,
@@ -1796,7 +1797,7 @@ class TestRsyncEngine(unittest.TestCase):
     @patch('freezer.engine.rsync.rsync.RsyncEngine.'
            'process_backup_data')
     @patch('freezer.engine.rsync.rsync.RsyncEngine.process_file')
-    @patch('os.walk')
+    @patch('freezer.utils.scanner.walk')
     @patch('os.getcwd')
     @patch('freezer.engine.rsync.rsync.RsyncEngine.'
            'get_fs_meta_struct')
@@ -1808,7 +1809,7 @@ class TestRsyncEngine(unittest.TestCase):
                                       mock_flush,
                                       mock_get_fs_meta_struct,
                                       mock_os_getcwd,
-                                      mock_os_walk,
+                                      mock_walk,
                                       mock_process_file,
                                       mock_process_backup_data,
                                       mock_one_shot_compress,
@@ -1866,7 +1867,7 @@ class TestRsyncEngine(unittest.TestCase):
     @patch('freezer.engine.rsync.rsync.RsyncEngine.'
            'process_backup_data')
     @patch('freezer.engine.rsync.rsync.RsyncEngine.process_file')
-    @patch('os.walk')
+    @patch('freezer.utils.scanner.walk')
     @patch('os.getcwd')
     @patch('freezer.engine.rsync.rsync.RsyncEngine.'
            'get_fs_meta_struct')
@@ -1878,7 +1879,7 @@ class TestRsyncEngine(unittest.TestCase):
                                    mock_flush,
                                    mock_get_fs_meta_struct,
                                    mock_os_getcwd,
-                                   mock_os_walk,
+                                   mock_walk,
                                    mock_process_file,
                                    mock_process_backup_data,
                                    mock_one_shot_compress,
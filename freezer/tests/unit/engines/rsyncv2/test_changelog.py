@@ -0,0 +1,126 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from freezer.engine.rsyncv2 import changelog
+
+
+class TestChangeLog(unittest.TestCase):
+
+    def setUp(self):
+        super(TestChangeLog, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.tmpdir, 'changes')
+
+    def tearDown(self):
+        super(TestChangeLog, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def _log(self, data):
+        with open(self.log_path, 'ab') as f:
+            f.write(data)
+
+    @mock.patch.object(changelog, '_request_flush', return_value=True)
+    def test_take_commit(self, mock_request_flush):
+        self._log(b'a\ndir/b\na\n')
+        self.assertEqual({'a', 'dir/b'}, changelog.take(self.log_path))
+        self.assertFalse(os.path.exists(self.log_path))
+
+        # the changes of a failed backup are taken again
+        self._log(b'c\n')
+        self.assertEqual({'a', 'dir/b', 'c'}, changelog.take(self.log_path))
+        changelog.commit(self.log_path)
+
+        self._log(b'')
+        self.assertEqual(set(), changelog.take(self.log_path))
+
+    @mock.patch.object(changelog, '_request_flush', return_value=True)
+    def test_all_changed(self, mock_request_flush):
+        self._log(b'a\n.\n')
+        self.assertIsNone(changelog.take(self.log_path))
+
+    def test_no_agent(self):
+        self.assertIsNone(changelog.take(self.log_path))
+
+        # the log of an agent which stopped
+        self._log(b'a\n')
+        self.assertIsNone(changelog.take(self.log_path, timeout=0.2))
+        self.assertFalse(os.path.exists(
+            self.log_path + changelog.FLUSH_REQUEST_SUFFIX))
+
+
+class TestInotifyWatcher(unittest.TestCase):
+
+    def setUp(self):
+        super(TestInotifyWatcher, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'src')
+        os.makedirs(os.path.join(self.path, 'dir'))
+        with open(os.path.join(self.path, 'dir', 'a'), 'wb') as f:
+            f.write(b'data')
+        try:
+            self.watcher = changelog.InotifyWatcher(self.path)
+        except (OSError, AttributeError) as e:
+            shutil.rmtree(self.tmpdir)
+            self.skipTest('inotify not available: {}'.format(e))
+
+    def tearDown(self):
+        super(TestInotifyWatcher, self).tearDown()
+        self.watcher.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _read_events(self):
+        for _ in range(10):
+            self.watcher.read_events(0.1)
+
+    def test_changes(self):
+        with open(os.path.join(self.path, 'dir', 'a'), 'r+b') as f:
+            f.write(b'x')
+        os.makedirs(os.path.join(self.path, 'new', 'sub'))
+        self._read_events()
+        with open(os.path.join(self.path, 'new', 'sub', 'b'), 'wb') as f:
+            f.write(b'data')
+        self._read_events()
+        self.assertEqual({'dir/a', 'new', 'new/sub', 'new/sub/b'},
+                         self.watcher.changes)
+
+        log_path = os.path.join(self.tmpdir, 'changes')
+        self.watcher.flush(log_path)
+        self.assertEqual(set(), self.watcher.changes)
+        self.watcher.flush(log_path)
+        with mock.patch.object(changelog, '_request_flush',
+                               return_value=True):
+            self.assertEqual({'dir/a', 'new', 'new/sub', 'new/sub/b'},
+                             changelog.take(log_path))
+
+    def test_flush_request(self):
+        log_path = os.path.join(self.tmpdir, 'changes')
+        self.watcher.flush(log_path)
+        agent = threading.Thread(target=self.watcher.run_once,
+                                 args=(log_path, 60))
+        agent.start()
+        try:
+            with open(os.path.join(self.path, 'dir', 'a'), 'r+b') as f:
+                f.write(b'x')
+            start = time.monotonic()
+            # the change is logged at once, not after the flush interval
+            self.assertEqual({'dir/a'}, changelog.take(log_path))
+            self.assertLess(time.monotonic() - start, 5)
+        finally:
+            agent.join()
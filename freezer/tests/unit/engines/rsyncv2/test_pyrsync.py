@@ -0,0 +1,234 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+from unittest import mock
+import zlib
+
+from freezer.engine.rsyncv2 import pyrsync
+
+
+def _signature(data, blocksize):
+    """Hash the blocks of data one by one."""
+    blocks = [data[i:i + blocksize] for i in range(0, len(data), blocksize)]
+    return ([zlib.adler32(block) for block in blocks],
+            [hashlib.sha1(block).digest() for block in blocks])
+
+
+class TestBlockchecksumsPacked(unittest.TestCase):
+
+    def setUp(self):
+        super(TestBlockchecksumsPacked, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.rnd = random.Random(0)
+
+    def tearDown(self):
+        super(TestBlockchecksumsPacked, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, data):
+        path = os.path.join(self.tmpdir, 'file')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _assert_same_as_per_block(self, data, blocksize):
+        path = self._write(data)
+        weak, strong = pyrsync.blockchecksums_packed(path, blocksize)
+        exp_weak, exp_strong = _signature(data, blocksize)
+
+        self.assertEqual(
+            exp_weak, list(struct.unpack('<%dI' % len(exp_weak), weak)))
+        self.assertEqual(b''.join(exp_strong), strong)
+
+    def test_same_as_per_block(self):
+        for size, blocksize in ((1, 4096), (4096, 4096), (10000, 4096),
+                                (100000, 7), (70000, 65536)):
+            self._assert_same_as_per_block(self.rnd.randbytes(size),
+                                           blocksize)
+
+    def test_no_overflow(self):
+        # adler32 sums of blocks of 0xff are the largest ones
+        self._assert_same_as_per_block(b'\xff' * (3 << 20), 1 << 20)
+
+    def test_empty_file(self):
+        self.assertEqual((b'', b''), pyrsync.blockchecksums_packed(
+            self._write(b''), 4096))
+
+    def test_read_chunks(self):
+        data = self.rnd.randbytes(100)
+        path = self._write(data)
+        for chunk_size, blocksize in ((32, 16), (40, 16), (1, 16),
+                                      (100, 10)):
+            with mock.patch.object(pyrsync, 'READ_CHUNK_SIZE', chunk_size):
+                chunks = [bytes(chunk) for chunk in
+                          pyrsync._read_chunks(path, blocksize)]
+            self.assertEqual(data, b''.join(chunks))
+            # the chunks hold whole blocks
+            self.assertEqual([0] * (len(chunks) - 1),
+                             [len(chunk) % blocksize
+                              for chunk in chunks[:-1]])
+
+    @mock.patch.object(pyrsync, 'READ_CHUNK_SIZE', 32)
+    def test_truncated_while_read(self):
+        path = self._write(self.rnd.randbytes(100))
+        chunks = pyrsync._read_chunks(path, 16)
+        self.assertEqual(32, len(next(chunks)))
+        os.truncate(path, 40)
+        self.assertEqual([8], [len(chunk) for chunk in chunks])
+
+    def test_chunks(self):
+        data = self.rnd.randbytes(10000)
+        path = self._write(data)
+        for chunk_size in (1, 100, 4096, 5000, 10000):
+            checksums = pyrsync.BlockChecksums(4096)
+            for offset in range(0, len(data), chunk_size):
+                checksums.update(data[offset:offset + chunk_size])
+            self.assertEqual(pyrsync.blockchecksums_packed(path, 4096),
+                             checksums.digest())
+
+    def test_zeros(self):
+        data = self.rnd.randbytes(100)
+        for length in (0, 10, 4096, 4000, 20000):
+            path = self._write(data + bytes(length) + data)
+            checksums = pyrsync.BlockChecksums(4096)
+            checksums.update(data)
+            checksums.update_zeros(length)
+            checksums.update(data)
+            self.assertEqual(pyrsync.blockchecksums_packed(path, 4096),
+                             checksums.digest())
+
+
+class TestBlockdeltasPacked(unittest.TestCase):
+
+    def test_same_as_per_block(self):
+        rnd = random.Random(1)
+        old = rnd.randbytes(4 * 16 + 5)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        old_path = os.path.join(tmpdir, 'old')
+        new_path = os.path.join(tmpdir, 'new')
+        with open(old_path, 'wb') as f:
+            f.write(old)
+        old_signature = pyrsync.blockchecksums_packed(old_path, 16)
+
+        for new in (old, old[:40], old[:20] + b'x' + old[21:] + b'more',
+                    b''):
+            with open(new_path, 'wb') as f:
+                f.write(new)
+            modified_blocks, len_deltas, signature = (
+                pyrsync.blockdeltas_packed(new_path, old_signature, 16))
+
+            # the blocks differing from the block at the same position
+            old_weak, old_strong = _signature(old, 16)
+            new_weak, new_strong = _signature(new, 16)
+            expected = [i for i in range(len(new_weak))
+                        if i >= len(old_weak) or
+                        (new_weak[i], new_strong[i]) !=
+                        (old_weak[i], old_strong[i])]
+            self.assertEqual(expected, modified_blocks)
+            self.assertEqual(sum(len(new[i * 16:(i + 1) * 16])
+                                 for i in expected), len_deltas)
+            self.assertEqual(pyrsync.blockchecksums_packed(new_path, 16),
+                             signature)
+
+            # read by chunks of several blocks
+            with mock.patch.object(pyrsync, 'READ_CHUNK_SIZE', 32):
+                self.assertEqual(
+                    (modified_blocks, len_deltas, signature),
+                    pyrsync.blockdeltas_packed(new_path, old_signature, 16))
+
+
+class TestRollingdeltaPacked(unittest.TestCase):
+
+    def setUp(self):
+        super(TestRollingdeltaPacked, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.old = random.Random(2).randbytes(16 * 10 + 5)
+
+    def _delta(self, new, remotesize=-1, start=0):
+        old_path = os.path.join(self.tmpdir, 'old')
+        new_path = os.path.join(self.tmpdir, 'new')
+        with open(old_path, 'wb') as f:
+            f.write(self.old)
+        with open(new_path, 'wb') as f:
+            f.write(new)
+        if remotesize == -1:
+            remotesize = len(self.old)
+        ops, len_literal = pyrsync.rollingdelta_packed(
+            new_path, pyrsync.blockchecksums_packed(old_path, 16), 16,
+            remotesize, start)
+        # read by windows of a few blocks
+        for window_size in (33, 40):
+            with mock.patch.object(pyrsync, 'READ_CHUNK_SIZE', window_size):
+                self.assertEqual((ops, len_literal),
+                                 pyrsync.rollingdelta_packed(
+                                     new_path, pyrsync.blockchecksums_packed(
+                                         old_path, 16), 16, remotesize,
+                                     start))
+
+        rebuilt = new[:start]
+        for offset, length in ops:
+            if offset < 0:
+                rebuilt += new[len(rebuilt):len(rebuilt) + length]
+            else:
+                rebuilt += self.old[offset:offset + length]
+        self.assertEqual(new, rebuilt)
+        self.assertEqual(sum(length for offset, length in ops
+                             if offset < 0), len_literal)
+        return ops
+
+    def test_shifted(self):
+        self.assertEqual([[-1, 3], [0, 165]], self._delta(b'abc' + self.old))
+        self.assertEqual([[0, 32], [-1, 1], [32, 133]],
+                         self._delta(self.old[:32] + b'x' + self.old[32:]))
+
+    def test_removed(self):
+        self.assertEqual([[0, 32], [-1, 11], [48, 117]],
+                         self._delta(self.old[:32] + self.old[37:]))
+
+    def test_moved(self):
+        # the short last block is only matched at the end of the file
+        self.assertEqual([[64, 96], [-1, 5], [0, 64]],
+                         self._delta(self.old[64:] + self.old[:64]))
+
+    def test_last_block(self):
+        # the short last block matches only if the remote size is known
+        self.assertEqual([[-1, 1], [0, 165]],
+                         self._delta(b'x' + self.old))
+        self.assertEqual([[-1, 1], [0, 160], [-1, 5]],
+                         self._delta(b'x' + self.old, remotesize=None))
+
+    def test_new_data(self):
+        self.assertEqual([[-1, 100]], self._delta(b'\0' * 100))
+        self.assertEqual([], self._delta(b''))
+
+    def test_start(self):
+        new = self.old[:32] + b'x' + self.old[32:]
+        self.assertEqual([[-1, 1], [32, 133]], self._delta(new, start=32))
+
+    @mock.patch.object(pyrsync, 'ROLLING_PROBE_INTERVAL', 4)
+    @mock.patch.object(pyrsync, 'ROLLING_SEARCH_LIMIT', 32)
+    def test_search_limit(self):
+        # after the limit, one block out of 4 is searched: the old data
+        # is found again at the next block searched
+        self.assertEqual([[-1, 132], [32, 133]],
+                         self._delta(b'\0' * 100 + self.old))
+        self.assertEqual([[-1, 20], [0, 165]],
+                         self._delta(b'\0' * 20 + self.old))
@@ -0,0 +1,586 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import queue
+import random
+import shutil
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+import msgpack
+
+from freezer.engine.rsyncv2 import rsyncv2
+from freezer.exceptions import engine as engine_exceptions
+from freezer.utils import compress
+from freezer.utils import streaming
+
+
+class TestRsyncv2Backup(unittest.TestCase):
+
+    def setUp(self):
+        super(TestRsyncv2Backup, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'src')
+        os.makedirs(os.path.join(self.src, 'dir'))
+        self.cwd = os.getcwd()
+        os.chdir(self.src)
+
+    def tearDown(self):
+        super(TestRsyncv2Backup, self).tearDown()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, data, offset=0):
+        with open(os.path.join(self.src, name), 'r+b' if offset else 'wb') \
+                as f:
+            f.seek(offset)
+            f.write(data)
+            # make sure the file is seen as modified
+            os.utime(f.fileno(), (1, offset + 1))
+
+    def _engine(self, **kwargs):
+        return rsyncv2.Rsyncv2Engine(
+            compression='gzip', storage=None, max_segment_size=4096,
+            rsync_block_size=4096, **kwargs)
+
+    @staticmethod
+    def _unpack(stream):
+        try:
+            return msgpack.unpackb(stream), b''
+        except msgpack.ExtraData as e:
+            return e.unpacked, e.extra
+
+    @staticmethod
+    def _data_size(file_header):
+        if (not stat.S_ISREG(file_header.get('inode', {}).get('mode', 0)) or
+                ('prev_name' in file_header and
+                 'new_level' not in file_header)):
+            return 0
+        for key in ('deltas', 'patch'):
+            if key in file_header:
+                return file_header[key][0]
+        if 'extents' in file_header:
+            return sum(length for _, length in file_header['extents'])
+        return file_header['inode']['size']
+
+    def _sign_delta(self, engine, manifest_path):
+        """Backup the current directory.
+
+        :return: headers of all the batches and data of the files
+        """
+        write_queue = queue.Queue()
+        engine.get_sign_delta('.', manifest_path, write_queue)
+        stream = b''.join(iter(write_queue.get, False))
+        version, stream = self._unpack(stream)
+        self.assertEqual({'rsync_struct_ver': 3}, version)
+        header = []
+        data = []
+        while True:
+            batch, stream = self._unpack(stream)
+            if not batch:
+                break
+            # the data of the files follows the header of their batch
+            size = sum(self._data_size(h) for h in batch)
+            header.extend(batch)
+            data.append(stream[:size])
+            stream = stream[size:]
+        self.assertEqual(b'', stream)
+        return header, b''.join(data)
+
+    def _backup_levels(self, **kwargs):
+        """Backup a level 0 and a level 1 of the same changes.
+
+        :return: paths, deltas and data of each level and the engine of
+                 the level 1
+        """
+        rnd = random.Random(0)
+        for name, size in (('a', 100000), ('dir/b', 20000), ('c', 0)):
+            self._write(name, rnd.randbytes(size))
+        manifest_path = os.path.join(self.tmpdir, 'manifest')
+        if os.path.exists(manifest_path):
+            os.unlink(manifest_path)
+
+        levels = []
+        for level in range(2):
+            if level:
+                self._write('a', b'x' * 100, offset=8192)
+                self._write('dir/b', b'y' + b'z' * 30000)
+            engine = self._engine(**kwargs)
+            header, data = self._sign_delta(engine, manifest_path)
+            levels.append((sorted((h['path'], h.get('deltas'))
+                                  for h in header), data))
+        return levels, engine
+
+    def test_incremental(self):
+        levels, engine = self._backup_levels()
+        header, data = levels[1]
+
+        deltas = dict(header)
+        self.assertEqual([4096, [2]], deltas['a'])
+        self.assertEqual([30001, [0, 1, 2, 3, 4, 5, 6, 7]],
+                         deltas['dir/b'])
+        self.assertEqual(34097, len(data))
+        self.assertEqual(9, engine.modified_blocks)
+        self.assertEqual(24, engine.fixed_blocks)
+
+    def test_incremental_shifted(self):
+        old = random.Random(0).randbytes(100000)
+        self._write('a', old)
+        manifest_path = os.path.join(self.tmpdir, 'manifest')
+        self._sign_delta(self._engine(), manifest_path)
+        self._write('a', b'header' + old[:50000] + old[50004:])
+        engine = self._engine()
+        header, data = self._sign_delta(engine, manifest_path)
+
+        # only the header and the block with the removed bytes are new
+        patch = header[0]['patch']
+        self.assertEqual([4098, [[-1, 6], [0, 49152], [-1, 4092],
+                                 [53248, 46752]]], patch)
+        self.assertEqual(b'header' + old[49152:50000] + old[50004:53248],
+                         data)
+        self.assertEqual(2, engine.modified_blocks)
+
+        # the file is rebuilt from its previous version
+        restored = os.path.join(self.tmpdir, 'restored')
+        with open(restored, 'wb') as f:
+            f.write(old)
+        engine._rebuild_reg_file(restored, patch,
+                                 streaming.ChunkReader([data]))
+        with open(restored, 'rb') as f:
+            restored_data = f.read()
+        with open('a', 'rb') as f:
+            self.assertEqual(f.read(), restored_data)
+        self.assertEqual(['a', 'dir', 'manifest', 'restored', 'src'],
+                         sorted(os.listdir(self.tmpdir) +
+                                os.listdir(self.src)))
+
+    def test_renamed(self):
+        rnd = random.Random(0)
+        self._write('a', rnd.randbytes(10000))
+        self._write('dir/b', rnd.randbytes(10000))
+        manifest_path = os.path.join(self.tmpdir, 'manifest')
+        self._sign_delta(self._engine(), manifest_path)
+        os.rename('a', 'dir/a')
+        os.rename('dir/b', 'b')
+        self._write('b', b'x', offset=100)
+        header, data = self._sign_delta(self._engine(), manifest_path)
+
+        # renamed files are not backed up again, nor deleted
+        header = dict((h['path'], h) for h in header)
+        self.assertEqual(['b', 'dir', 'dir/a'], sorted(header))
+        self.assertEqual('a', header['dir/a']['prev_name'])
+        self.assertEqual(0, self._data_size(header['dir/a']))
+        self.assertEqual('dir/b', header['b']['prev_name'])
+        self.assertEqual([4096, [0]], header['b']['deltas'])
+        self.assertEqual(4096, len(data))
+
+        # and the next backup does not see them as renamed
+        header, data = self._sign_delta(self._engine(), manifest_path)
+        self.assertEqual([], header)
+
+    def test_renamed_data(self):
+        mode = 0o100644
+        old_files = {'a': {'mode': mode, 'size': 4, 'mtime': 1, 'ctime': 1,
+                           'dev': 1, 'ino': 2}}
+        engine = self._engine()
+        engine._old_files = mock.Mock()
+        engine._old_files.find_renamed.return_value = 'a'
+
+        def prepare(ctime, ino):
+            file_meta = {'mode': mode, 'size': 4, 'mtime': 1,
+                         'ctime': ctime, 'dev': 1, 'ino': ino}
+            with mock.patch.object(engine, '_get_file_stat',
+                                   return_value=({'mode': mode}, file_meta)), \
+                    mock.patch.object(engine, '_get_deltas_info',
+                                      return_value='deltas'):
+                return engine._prepare_file_info('b', old_files)[1]
+
+        # the same inode left unchanged is not read again
+        self.assertEqual({'path': 'b', 'inode': {'mode': mode},
+                          'prev_name': 'a'}, prepare(1, 2))
+        # the data of the same inode changed since, or of another file with
+        # the same size and time, is compared with the previous version
+        for ctime, ino in ((2, 2), (1, 3)):
+            self.assertEqual({'path': 'b', 'inode': {'mode': mode},
+                              'prev_name': 'a', 'new_level': True,
+                              'deltas': 'deltas'}, prepare(ctime, ino))
+
+    def test_renamed_other_file(self):
+        rnd = random.Random(0)
+        self._write('a', rnd.randbytes(10000))
+        manifest_path = os.path.join(self.tmpdir, 'manifest')
+        self._sign_delta(self._engine(), manifest_path)
+        # another file with the same size and time replaces it
+        self._write('b', b'x' * 10000)
+        os.unlink('a')
+        header, data = self._sign_delta(self._engine(), manifest_path)
+
+        self.assertEqual('a', header[0]['prev_name'])
+        self.assertEqual([10000, [0, 1, 2]], header[0]['deltas'])
+        self.assertEqual(b'x' * 10000, data)
+
+    def test_restore_renamed(self):
+        restore_path = os.path.join(self.tmpdir, 'restore')
+        os.mkdir(restore_path)
+        with open(os.path.join(restore_path, 'a'), 'wb') as f:
+            f.write(b'data')
+        file_meta = {'path': 'b', 'prev_name': 'a',
+                     'inode': self._engine()._get_file_stat('dir')[0]}
+        file_meta['inode']['mode'] = 0o100600
+        engine = self._engine()
+        data_stream = streaming.ChunkReader([b'next'])
+        with mock.patch.object(engine, '_set_inode'):
+            engine._restore_file(file_meta, restore_path, data_stream, 1)
+        self.assertEqual(['b'], os.listdir(restore_path))
+        self.assertEqual(b'next', data_stream.read())
+
+    def test_patch_block(self):
+        data_stream = streaming.ChunkReader([b'abcde', b'ghi'])
+        data_stream.read(2)
+        fd = io.BytesIO(b'0' * 8)
+        self._engine()._patch_block(fd, 1, data_stream, 4, 4)
+        self.assertEqual(b'0000cdeg', fd.getvalue())
+        self.assertEqual(b'hi', data_stream.read())
+
+    def test_backup_truncated_file(self):
+        engine = self._engine()
+        engine.max_segment_size = 4096
+        # the file is truncated in its second modified block after its
+        # deltas were computed
+        self._write('a', b'x' * 6000)
+        write_queue = queue.Queue()
+        engine._backup_deltas({'path': 'a', 'deltas': (10000, [0, 1, 2])},
+                              write_queue)
+        self.assertEqual([b'x' * 4096, b'x' * 1904 + bytes(2192),
+                          bytes(1808)], list(write_queue.queue))
+
+        write_queue = queue.Queue()
+        engine._backup_patch(
+            {'path': 'a', 'patch': (7000, [[-1, 3000], [0, 4096],
+                                           [-1, 4000]])}, write_queue)
+        self.assertEqual(b'x' * 3000 + bytes(4000),
+                         b''.join(write_queue.queue))
+
+    def test_old_files_index(self):
+        mode = 0o100644
+        old_files = {
+            'a': {'mode': mode, 'size': 1, 'mtime': 1, 'dev': 1, 'ino': 1},
+            'b': {'mode': mode, 'size': 2, 'mtime': 1, 'dev': 1, 'ino': 2},
+            'c': {'mode': mode, 'size': 2, 'mtime': 1, 'dev': 1, 'ino': 3},
+            'd/e': {'mode': mode, 'mtime': 1},
+            'f': {'mode': 0o40755, 'mtime': 1}}
+        index = rsyncv2.OldFilesIndex(old_files)
+
+        def meta(size, ino):
+            return {'mode': mode, 'size': size, 'mtime': 1, 'dev': 1,
+                    'ino': ino}
+
+        self.assertEqual('b', index.find_renamed('x', meta(5, 2)))
+        # b is already renamed, c has the same size and time
+        self.assertEqual('c', index.find_renamed('y', meta(2, 9)))
+        self.assertIsNone(index.find_renamed('z', meta(2, 9)))
+        self.assertEqual('d/e', index.find_renamed('e', meta(3, 9)))
+        self.assertIsNone(index.find_renamed('f', meta(3, 9)))
+        # a still exists
+        self._write('a', b'a')
+        self.assertIsNone(index.find_renamed('g', meta(1, 1)))
+
+    @mock.patch.object(rsyncv2.changelog, '_request_flush', return_value=True)
+    @mock.patch.object(rsyncv2, 'TIMESTAMP_GRANULARITY', -60)
+    def test_dir_change_tracking(self, mock_request_flush):
+        os.makedirs(os.path.join(self.src, 'dir', 'sub'))
+        for name in ('a', 'dir/b', 'dir/sub/c'):
+            self._write(name, b'data')
+        manifest_path = os.path.join(self.tmpdir, 'manifest')
+        change_log = os.path.join(self.tmpdir, 'changes')
+        self._sign_delta(self._engine(dir_change_tracking=True,
+                                      change_log=change_log),
+                         manifest_path)
+
+        # without change log, the directories are listed and the files
+        # modified in place are seen
+        self._write('dir/b', b'new', offset=1)
+        self._write('a', b'new', offset=1)
+        header, data = self._sign_delta(
+            self._engine(dir_change_tracking=True), manifest_path)
+        self.assertEqual(['a', 'dir/b'], sorted(h['path'] for h in header))
+
+        # with a change log, only the files reported in the unchanged
+        # directories are seen
+        self._write('dir/b', b'x', offset=2)
+        self._write('dir/sub/c', b'x', offset=2)
+        with open(change_log, 'wb') as f:
+            f.write(b'dir/b\n')
+        engine = self._engine(dir_change_tracking=True,
+                              change_log=change_log)
+        with mock.patch('os.scandir', wraps=os.scandir) as mock_scandir:
+            header, data = self._sign_delta(engine, manifest_path)
+        self.assertEqual(['dir/b'], [h['path'] for h in header])
+        self.assertEqual(b'dnxw', data)
+        # only the backup path is listed
+        self.assertEqual(1, mock_scandir.call_count)
+        # the changes are removed once the backup is stored
+        self.assertTrue(os.path.exists(change_log + '.taken'))
+        engine.post_backup('.')
+        self.assertFalse(os.path.exists(change_log + '.taken'))
+
+        # new files change the mtime of their directory, which is listed
+        # again
+        self._write('dir/sub/d', b'data')
+        with open(change_log, 'wb') as f:
+            f.write(b'')
+        header, data = self._sign_delta(
+            self._engine(dir_change_tracking=True, change_log=change_log),
+            manifest_path)
+        self.assertEqual(['dir/sub', 'dir/sub/c', 'dir/sub/d'],
+                         sorted(h['path'] for h in header))
+        files, _, signatures = self._engine().get_fs_meta_struct(
+            manifest_path)
+        signatures.close()
+        self.assertEqual(['a', 'dir', 'dir/b', 'dir/sub', 'dir/sub/c',
+                          'dir/sub/d'], sorted(files))
+
+    @mock.patch.object(rsyncv2.changelog, '_request_flush', return_value=True)
+    def test_change_log_kept_on_failed_backup(self, mock_request_flush):
+        self._write('a', b'data')
+        change_log = os.path.join(self.tmpdir, 'changes')
+        with open(change_log, 'wb') as f:
+            f.write(b'a\n')
+        storage = mock.Mock()
+        storage.previous_backup.return_value = None
+
+        def write_backup(rich_queue, backup):
+            list(rich_queue.get_messages())
+            raise IOError('upload failed')
+
+        storage.write_backup.side_effect = write_backup
+        engine = rsyncv2.Rsyncv2Engine(
+            compression='gzip', storage=storage, max_segment_size=4096,
+            rsync_block_size=4096, dir_change_tracking=True,
+            change_log=change_log)
+        self.assertRaises(engine_exceptions.EngineException, engine.backup,
+                          '.', 'backup', False, 0, False, False)
+        self.assertFalse(storage.put_metadata.called)
+        # the next backup reads the changes again
+        with open(change_log + '.taken', 'rb') as f:
+            self.assertEqual(b'a\n', f.read())
+
+        storage.write_backup.side_effect = (
+            lambda rich_queue, backup: list(rich_queue.get_messages()))
+        engine.backup('.', 'backup', False, 0, False, False)
+        self.assertTrue(storage.put_metadata.called)
+        self.assertFalse(os.path.exists(change_log + '.taken'))
+
+    @mock.patch.object(rsyncv2, 'HEADER_BATCH_SIZE', 2)
+    def test_batches(self):
+        levels, _ = self._backup_levels()
+        os.unlink('a')
+        header, data = self._sign_delta(self._engine(), os.path.join(
+            self.tmpdir, 'manifest'))
+        self.assertEqual([{'path': 'a', 'deleted': True}], header)
+
+        batch_levels, engine = self._backup_levels()
+        self.assertEqual(levels, batch_levels)
+        self.assertEqual(9, engine.modified_blocks)
+
+    def _restore(self, chunks, level=0, set_inode=False, metadata=None,
+                 **kwargs):
+        """Restore a backup stream compressed by chunks."""
+        restore_path = os.path.join(self.tmpdir, 'restore')
+        if not os.path.exists(restore_path):
+            os.mkdir(restore_path)
+        chunks = list(chunks)
+        read_pipe = mock.Mock()
+        read_pipe.recv_bytes.side_effect = chunks + [EOFError()]
+        backup = mock.Mock(level=level)
+        backup.metadata.return_value = metadata or {}
+        engine = self._engine(**kwargs)
+        with mock.patch.object(engine, '_set_inode',
+                               wraps=engine._set_inode if set_inode else None):
+            engine.restore_level(restore_path, read_pipe, backup,
+                                 queue.Queue())
+        # the stream is read up to its end
+        self.assertEqual(len(chunks) + 1, read_pipe.recv_bytes.call_count)
+        return restore_path
+
+    def _compress(self, data, size=1000):
+        compressor = compress.Compressor('gzip')
+        chunks = [compressor.compress(data[i:i + size])
+                  for i in range(0, len(data), size)]
+        return chunks + [compressor.flush()]
+
+    @mock.patch.object(rsyncv2, 'HEADER_BATCH_SIZE', 2)
+    def test_restore(self):
+        rnd = random.Random(0)
+        for name, size in (('a', 10000), ('dir/b', 2000), ('c', 0),
+                           ('d', 3000)):
+            self._write(name, rnd.randbytes(size))
+        engine = self._engine()
+        chunks = list(engine.backup_data('.', os.path.join(self.tmpdir,
+                                                           'manifest')))
+
+        restore_path = self._restore(chunks)
+        for name in ('a', 'dir/b', 'c', 'd'):
+            with open(name, 'rb') as f, \
+                    open(os.path.join(restore_path, name), 'rb') as r:
+                self.assertEqual(f.read(), r.read())
+
+    @mock.patch.object(compress, 'FRAME_SIZE', 4096)
+    def test_adaptive_compression(self):
+        rnd = random.Random(0)
+        self._write('a', rnd.randbytes(10000))
+        self._write('b', b'text' * 5000)
+        engine = self._engine(adaptive_compression=True)
+        chunks = list(engine.backup_data('.', os.path.join(self.tmpdir,
+                                                           'manifest')))
+        metadata = engine.metadata()
+        self.assertTrue(metadata['compression_frames'])
+        # the frames of a are stored
+        self.assertLess(sum(len(c) for c in chunks), 10000 + 4096)
+
+        restore_path = self._restore(chunks, metadata=metadata)
+        for name in ('a', 'b'):
+            with open(name, 'rb') as f, \
+                    open(os.path.join(restore_path, name), 'rb') as r:
+                self.assertEqual(f.read(), r.read())
+
+    @mock.patch.object(compress, 'FRAME_SIZE', 4096)
+    def test_compression_threads(self):
+        rnd = random.Random(0)
+        self._write('a', rnd.randbytes(10000))
+        self._write('b', b'text' * 5000)
+        engine = self._engine(compression_threads=2)
+        chunks = list(engine.backup_data('.', os.path.join(self.tmpdir,
+                                                           'manifest')))
+        metadata = engine.metadata()
+        self.assertTrue(metadata['compression_frames'])
+
+        restore_path = self._restore(chunks, metadata=metadata,
+                                     compression_threads=2)
+        for name in ('a', 'b'):
+            with open(name, 'rb') as f, \
+                    open(os.path.join(restore_path, name), 'rb') as r:
+                self.assertEqual(f.read(), r.read())
+
+    @mock.patch.object(rsyncv2, 'APPLY_BATCH_SIZE', 2)
+    @mock.patch.object(rsyncv2, 'MAX_BUFFERED_FILE_SIZE', 5000)
+    def test_restore_workers(self):
+        rnd = random.Random(0)
+        os.mkdir(os.path.join(self.src, 'dir', 'sub'))
+        names = ['dir/sub/a', 'dir/b', 'c', 'd', 'e']
+        for name, size in zip(names, (10000, 2000, 0, 3000, 6000)):
+            self._write(name, rnd.randbytes(size))
+        for name in ('dir/sub', 'dir'):
+            os.utime(name, (1, 2))
+        chunks = list(self._engine().backup_data(
+            '.', os.path.join(self.tmpdir, 'manifest')))
+
+        restore_path = self._restore(chunks, set_inode=True,
+                                     restore_workers=3)
+        for name in names:
+            with open(name, 'rb') as f, \
+                    open(os.path.join(restore_path, name), 'rb') as r:
+                self.assertEqual(f.read(), r.read())
+        # the directories are set once their files are written
+        for name in names + ['dir/sub', 'dir']:
+            self.assertEqual(
+                os.lstat(name).st_mtime,
+                os.lstat(os.path.join(restore_path, name)).st_mtime)
+
+    def test_sparse(self):
+        block = 64 * 1024
+        data = random.Random(0).randbytes(block)
+        with open('sparse', 'wb') as f:
+            f.seek(block)
+            f.write(data)
+            f.truncate(4 * block)
+        if os.stat('sparse').st_blocks * 512 >= 4 * block:
+            self.skipTest('sparse files not supported')
+        self._write('dense', data)
+        engine = self._engine()
+        header, backup_data = self._sign_delta(engine, os.path.join(
+            self.tmpdir, 'manifest'))
+
+        header = dict((h['path'], h) for h in header)
+        self.assertEqual([[block, block]], header['sparse']['extents'])
+        self.assertNotIn('extents', header['dense'])
+        self.assertEqual(data + data, backup_data)
+        # the signature covers the holes
+        files, _, signatures = engine.get_fs_meta_struct(os.path.join(
+            self.tmpdir, 'manifest'))
+        try:
+            self.assertEqual(4 * block // 4096,
+                             files['sparse']['signature'][1])
+        finally:
+            signatures.close()
+
+        restore_path = os.path.join(self.tmpdir, 'restore')
+        os.mkdir(restore_path)
+        restored = os.path.join(restore_path, 'sparse')
+        data_stream = streaming.ChunkReader([data, b'next'])
+        engine._restore_reg_file(restored, header['sparse'], data_stream)
+        self.assertEqual(b'next', data_stream.read())
+        with open('sparse', 'rb') as f, open(restored, 'rb') as r:
+            self.assertEqual(f.read(), r.read())
+        self.assertEqual(os.stat('sparse').st_blocks,
+                         os.stat(restored).st_blocks)
+
+    def test_restore_v2(self):
+        header = [{'path': 'dir', 'inode': {'mode': 0o40755}},
+                  {'path': 'dir/a', 'inode': {'mode': 0o100644, 'size': 3}},
+                  {'path': 'b', 'inode': {'mode': 0o100644, 'size': 2000}}]
+        data = b'abc' + b'b' * 2000
+        restore_path = self._restore(self._compress(
+            msgpack.dumps(header) + data))
+        with open(os.path.join(restore_path, 'dir', 'a'), 'rb') as f:
+            self.assertEqual(b'abc', f.read())
+        with open(os.path.join(restore_path, 'b'), 'rb') as f:
+            self.assertEqual(b'b' * 2000, f.read())
+
+    def test_load_files_meta(self):
+        header = msgpack.dumps([{'path': 'x' * 100}])
+        data_stream = streaming.ChunkReader([
+            b'skipped' + header[:50], header[50:60], header[60:] + b'data'])
+        data_stream.read(7)
+        self.assertEqual([{'path': 'x' * 100}],
+                         rsyncv2.Rsyncv2Engine._load_files_meta(data_stream))
+        self.assertEqual(b'data', data_stream.read())
+
+    def test_workers(self):
+        levels, _ = self._backup_levels()
+        with mock.patch.object(rsyncv2.futures, 'ProcessPoolExecutor',
+                               wraps=rsyncv2.futures.ProcessPoolExecutor) \
+                as mock_executor:
+            workers_levels, engine = self._backup_levels(rsync_workers=2)
+
+        self.assertEqual(levels, workers_levels)
+        self.assertEqual(9, engine.modified_blocks)
+        self.assertIsNone(engine._executor)
+        # the workers are not forked from the threads of the backup
+        mp_context = mock_executor.call_args[1]['mp_context']
+        self.assertNotEqual('fork', mp_context.get_start_method())
+
+    def test_one_worker_per_cpu(self):
+        with mock.patch('os.cpu_count', return_value=16):
+            self.assertEqual(16, self._engine(rsync_workers=0).rsync_workers)
+
+    def test_backup_error(self):
+        engine = self._engine()
+        with mock.patch.object(engine, '_get_sign_delta',
+                               side_effect=IOError('vanished')):
+            self.assertRaises(IOError, list,
+                              engine.backup_data('.', os.path.join(
+                                  self.tmpdir, 'manifest')))
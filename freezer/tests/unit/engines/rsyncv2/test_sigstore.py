@@ -0,0 +1,223 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import queue
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import zlib
+
+import msgpack
+
+from freezer.engine.rsyncv2 import pyrsync
+from freezer.engine.rsyncv2 import rsyncv2
+from freezer.engine.rsyncv2 import sigstore
+from freezer.utils import compress
+
+
+def _legacy_signature(path, blocksize):
+    """Signature of the manifests of the previous versions.
+
+    :return: lists of the weak hashes and of the hex strong hashes
+    """
+    with open(path, 'rb') as f:
+        blocks = list(iter(lambda: f.read(blocksize), b''))
+    return ([zlib.adler32(block) for block in blocks],
+            [hashlib.sha1(block).hexdigest() for block in blocks])
+
+
+class TestSignatureStore(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSignatureStore, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'engine_meta')
+
+    def tearDown(self):
+        super(TestSignatureStore, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        first = (b'\x01\x00\x00\x00' * 2, b'a' * 20 + b'b' * 20)
+        second = (b'', b'')
+        writer = sigstore.SignatureWriter(self.path, 'gzip')
+        first_ref = writer.add(*first)
+        writer.add_record('a', {'signature': first_ref})
+        second_ref = writer.add(*second)
+        third_ref = writer.add_raw(first[0] + first[1])
+        writer.close({'rsync_block_size': 4096})
+
+        self.assertTrue(sigstore.is_signature_store(self.path))
+        reader = sigstore.SignatureReader(self.path)
+        try:
+            metadata, files = reader.files_meta('bzip2')
+            self.assertEqual({'rsync_block_size': 4096}, metadata)
+            self.assertEqual({'a': {'signature': first_ref}}, dict(files))
+            self.assertEqual(2, first_ref[1])
+            self.assertEqual(first, reader.signature(first_ref))
+            self.assertEqual(second, reader.signature(second_ref))
+            self.assertEqual(first, reader.signature(third_ref))
+            self.assertEqual(first[0] + first[1], reader.raw(first_ref))
+        finally:
+            reader.close()
+
+    @mock.patch.object(sigstore, 'FRAME_CACHE_SIZE', 2)
+    @mock.patch.object(sigstore, 'FRAME_SIZE', 100)
+    def test_records(self):
+        writer = sigstore.SignatureWriter(self.path, 'bzip2')
+        records = [('file{}'.format(i), {'size': i, 'name': 'x' * 20})
+                   for i in range(50)]
+        for path, file_meta in records:
+            writer.add_record(path, file_meta)
+        writer.close({})
+
+        reader = sigstore.SignatureReader(self.path)
+        try:
+            _, files = reader.files_meta('gzip')
+            self.assertLess(1, len(files._frames))
+            self.assertEqual(records, list(files.items()))
+            self.assertEqual(50, len(files))
+            for path, file_meta in reversed(records):
+                self.assertIn(path, files)
+                self.assertEqual(file_meta, files[path])
+                self.assertEqual(file_meta, files.get(path))
+            self.assertNotIn('missing', files)
+            self.assertIsNone(files.get('missing'))
+            self.assertEqual(2, len(files._cache))
+        finally:
+            reader.close()
+
+    def test_v1_store(self):
+        signature = (b'\x01\x00\x00\x00', b'a' * 20)
+        files_meta = {'files': {'a': {'signature': [8, 1]}},
+                      'rsync_block_size': 4096}
+        cmp_meta = compress.one_shot_compress('gzip',
+                                              msgpack.dumps(files_meta))
+        with open(self.path, 'wb') as f:
+            f.write(sigstore.MAGIC_V1)
+            f.write(b''.join(signature))
+            f.write(cmp_meta)
+            f.write(sigstore._FOOTER.pack(32, len(cmp_meta)))
+            f.write(sigstore.MAGIC_V1)
+
+        self.assertTrue(sigstore.is_signature_store(self.path))
+        reader = sigstore.SignatureReader(self.path)
+        try:
+            metadata, files = reader.files_meta('gzip')
+            self.assertEqual({'rsync_block_size': 4096}, metadata)
+            self.assertEqual({'a': {'signature': [8, 1]}}, files)
+            self.assertEqual(signature, reader.signature([8, 1]))
+        finally:
+            reader.close()
+
+    def test_not_a_store(self):
+        with open(self.path, 'wb') as f:
+            f.write(compress.one_shot_compress('gzip', msgpack.dumps({})))
+        self.assertFalse(sigstore.is_signature_store(self.path))
+        self.assertRaises(ValueError, sigstore.SignatureReader, self.path)
+
+    def test_pack_signature(self):
+        data_path = os.path.join(self.tmpdir, 'data')
+        with open(data_path, 'wb') as f:
+            f.write(os.urandom(10000))
+        packed = pyrsync.blockchecksums_packed(data_path, 4096)
+        self.assertEqual(packed, sigstore.pack_signature(
+            _legacy_signature(data_path, 4096)))
+        self.assertEqual(packed, sigstore.pack_signature(packed))
+
+
+class TestRsyncv2EngineMetadata(unittest.TestCase):
+
+    def setUp(self):
+        super(TestRsyncv2EngineMetadata, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.manifest_path = os.path.join(self.tmpdir, 'engine_meta')
+        self.data_path = os.path.join(self.tmpdir, 'data')
+        with open(self.data_path, 'wb') as f:
+            f.write(os.urandom(10000))
+        self.engine = rsyncv2.Rsyncv2Engine(
+            compression='gzip', storage=None, max_segment_size=1024,
+            rsync_block_size=4096)
+
+    def tearDown(self):
+        super(TestRsyncv2EngineMetadata, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_legacy_metadata(self):
+        signature = _legacy_signature(self.data_path, 4096)
+        files_meta = {'files': {'data': {'mode': 0o100644,
+                                         'signature': signature}},
+                      'rsync_block_size': 4096}
+        with open(self.manifest_path, 'wb') as f:
+            f.write(compress.one_shot_compress(
+                'gzip', msgpack.dumps(files_meta)))
+
+        files, rsync_bs, old_signatures = self.engine.get_fs_meta_struct(
+            self.manifest_path)
+
+        self.assertIsNone(old_signatures)
+        self.assertEqual(4096, rsync_bs)
+        self.assertEqual(sigstore.pack_signature(signature),
+                         self.engine._old_signature(files['data']))
+
+        # unchanged files are stored packed in the new metadata
+        self.engine._signatures = sigstore.SignatureWriter(
+            self.manifest_path + '.new', 'gzip')
+        files_meta = {'files': rsyncv2.FilesMeta(self.engine._signatures)}
+        files_meta['files'].add(
+            'data', self.engine._copy_old_signature(files['data']))
+        self.engine.write_engine_meta(files_meta)
+
+        reader = sigstore.SignatureReader(self.manifest_path + '.new')
+        try:
+            _, new_files = reader.files_meta('gzip')
+            self.assertEqual(
+                pyrsync.blockchecksums_packed(self.data_path, 4096),
+                reader.signature(new_files['data']['signature']))
+        finally:
+            reader.close()
+
+    def test_signature_store(self):
+        self.engine._signatures = sigstore.SignatureWriter(
+            self.manifest_path, 'gzip')
+        files_meta = {'files': rsyncv2.FilesMeta(self.engine._signatures),
+                      'rsync_block_size': 4096}
+        # the meta data of a regular file is written with its signature
+        files_meta['files'].add('data', {'mode': 0o100644})
+        files_meta['files'].add('dir', {'mode': 0o40755})
+        files_meta['files'].add('link', {'mode': 0o120777})
+        self.assertEqual(3, len(files_meta['files']))
+        self.assertIn('dir', files_meta['files'])
+        self.assertIsNone(files_meta['files'].get('link'))
+        write_queue = queue.Queue()
+        self.engine._backup_reg_file({'path': self.data_path},
+                                     files_meta['files'].get('data'),
+                                     write_queue)
+        files_meta['files'].done('data')
+        self.assertIsNone(files_meta['files'].get('data'))
+        self.engine.write_engine_meta(files_meta)
+
+        files, rsync_bs, old_signatures = self.engine.get_fs_meta_struct(
+            self.manifest_path)
+        self.engine._old_signatures = old_signatures
+        try:
+            self.assertEqual(4096, rsync_bs)
+            self.assertEqual(['link', 'data', 'dir'],
+                             [path for path, _ in files.items()])
+            self.assertEqual(
+                pyrsync.blockchecksums_packed(self.data_path, 4096),
+                self.engine._old_signature(files['data']))
+        finally:
+            old_signatures.close()
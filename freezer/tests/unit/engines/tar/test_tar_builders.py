@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import unittest
+from unittest import mock
 
 from freezer.engine.tar import tar_builders
 from freezer.utils import utils
@@ -109,3 +110,12 @@ class TestTarCommandRestoreBuilder(unittest.TestCase):
         assert tar_builders.get_tar_flag_from_algo('bzip2') == '-j'
         if not utils.is_bsd():
             assert tar_builders.get_tar_flag_from_algo('xz') == '-J'
+
+    @mock.patch('freezer.utils.utils.get_executable_path',
+                return_value='/usr/bin/zstd')
+    def test_get_tar_flag_from_algo_zstd_lz4(self, mock_get_path):
+        self.assertEqual('--zstd',
+                         tar_builders.get_tar_flag_from_algo('zstd'))
+        self.assertEqual('--use-compress-program=lz4',
+                         tar_builders.get_tar_flag_from_algo('lz4'))
+        mock_get_path.assert_called_with('lz4')
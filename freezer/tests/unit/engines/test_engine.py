@@ -0,0 +1,196 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from freezer.engine import engine
+from freezer.exceptions import engine as engine_exceptions
+
+
+class FakeEngine(engine.BackupEngine):
+    """Writes the data of every level to a file of the restore path."""
+
+    def __init__(self, storage, read_partially=False, **kwargs):
+        super(FakeEngine, self).__init__(storage, **kwargs)
+        self.read_partially = read_partially
+
+    @property
+    def name(self):
+        return 'fake'
+
+    def restore_level(self, restore_path, read_pipe, backup, except_queue):
+        path = os.path.join(restore_path, 'level_{0}'.format(backup.level))
+        with open(path, 'wb') as level_file:
+            try:
+                while True:
+                    level_file.write(read_pipe.recv_bytes())
+                    if self.read_partially:
+                        break
+            except EOFError:
+                pass
+
+    def backup_data(self, backup_path, manifest_path):
+        pass
+
+    def metadata(self, backup_resource):
+        pass
+
+
+class TestBackupEngine(unittest.TestCase):
+
+    def test_backup_queue_max_bytes(self):
+        storage = mock.Mock()
+        storage.previous_backup.return_value = None
+        written = []
+        storage.write_backup.side_effect = (
+            lambda rich_queue, backup: written.extend(
+                rich_queue.get_messages()))
+        backup_engine = FakeEngine(storage, queue_max_bytes=1024)
+        with mock.patch.object(backup_engine, 'backup_data',
+                               return_value=iter([b'a', b'bc'])), \
+                mock.patch('freezer.utils.streaming.RichQueue',
+                           wraps=engine.streaming.RichQueue) as mock_queue:
+            backup_engine.backup('/tmp', 'backup_name', False, None, None,
+                                 False)
+        mock_queue.assert_called_once_with(2, 1024)
+        self.assertEqual([b'a', b'bc'], written)
+
+
+class TestBackupEngineRestore(unittest.TestCase):
+
+    def setUp(self):
+        super(TestBackupEngineRestore, self).setUp()
+        self.restore_path = tempfile.mkdtemp()
+        self.storage = mock.Mock()
+        self.levels = {0: [b'a', b'', b'bc'], 1: [], 2: [b'd', b'e']}
+        backups = {}
+        for level in self.levels:
+            backup = mock.Mock()
+            backup.level = level
+            backup.storage = self.storage
+            backups[level] = backup
+        self.storage.get_latest_level_zero_increments.return_value = backups
+        self.storage.backup_blocks.side_effect = (
+            lambda backup: iter(self.levels[backup.level]))
+
+    def tearDown(self):
+        super(TestBackupEngineRestore, self).tearDown()
+        shutil.rmtree(self.restore_path)
+
+    def _restored(self):
+        restored = {}
+        for level in self.levels:
+            path = os.path.join(self.restore_path,
+                                'level_{0}'.format(level))
+            with open(path, 'rb') as level_file:
+                restored[level] = level_file.read()
+        return restored
+
+    def test_restore_all_levels(self):
+        FakeEngine(self.storage).restore('backup', self.restore_path,
+                                         True, None)
+        self.assertEqual({0: b'abc', 1: b'', 2: b'de'}, self._restored())
+
+    def test_restore_level_not_fully_read(self):
+        FakeEngine(self.storage, read_partially=True).restore(
+            'backup', self.restore_path, True, None)
+        # the rest of each level is discarded and does not leak into the
+        # next one
+        self.assertEqual({0: b'a', 1: b'', 2: b'd'}, self._restored())
+
+    def test_restore_prefetch(self):
+        spill_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spill_dir)
+        FakeEngine(self.storage, restore_prefetch_depth=2,
+                   restore_spill_dir=spill_dir).restore(
+            'backup', self.restore_path, True, None)
+        self.assertEqual({0: b'abc', 1: b'', 2: b'de'}, self._restored())
+
+    def test_levels_blocks_prefetch(self):
+        requested = dict((level, threading.Event()) for level in self.levels)
+
+        def backup_blocks(backup):
+            requested[backup.level].set()
+            return iter(self.levels[backup.level])
+
+        self.storage.backup_blocks.side_effect = backup_blocks
+        backups = self.storage.get_latest_level_zero_increments()
+        fake_engine = FakeEngine(self.storage, restore_prefetch_depth=1)
+        levels = fake_engine.levels_blocks([backups[0], backups[1],
+                                            backups[2]])
+
+        blocks = next(levels)
+        # the next level is downloaded while the current one is consumed
+        self.assertTrue(requested[1].wait(5))
+        self.assertFalse(requested[2].is_set())
+        self.assertEqual([b'a', b'', b'bc'], list(blocks))
+        self.assertEqual([], list(next(levels)))
+        # block boundaries are preserved and empty blocks are dropped
+        self.assertEqual([b'd', b'e'], list(next(levels)))
+        self.assertRaises(StopIteration, next, levels)
+
+    def test_levels_blocks_prefetch_stopped(self):
+        started = threading.Event()
+        release = threading.Event()
+        finished = threading.Event()
+        downloaded = []
+
+        def blocks():
+            started.set()
+            release.wait(5)
+            try:
+                for block in [b'x'] * 10:
+                    downloaded.append(block)
+                    yield block
+            finally:
+                finished.set()
+
+        def backup_blocks(backup):
+            if backup.level:
+                return blocks()
+            return iter(self.levels[backup.level])
+
+        self.storage.backup_blocks.side_effect = backup_blocks
+        backups = self.storage.get_latest_level_zero_increments()
+        fake_engine = FakeEngine(self.storage, restore_prefetch_depth=1)
+        levels = fake_engine.levels_blocks([backups[0], backups[1]])
+        next(levels)
+        self.assertTrue(started.wait(5))
+        # the restore ends while the next level is being downloaded
+        levels.close()
+        release.set()
+        self.assertTrue(finished.wait(5))
+        # the running prefetch stops at the next block
+        self.assertEqual([b'x'], downloaded)
+
+    def test_restore_read_error(self):
+        self.storage.backup_blocks.side_effect = IOError('not found')
+        self.assertRaises(engine_exceptions.EngineException,
+                          FakeEngine(self.storage).restore,
+                          'backup', self.restore_path, True, None)
+
+
+class TestLevelPipe(unittest.TestCase):
+
+    def test_truncated_level(self):
+        pipe = mock.Mock()
+        pipe.recv_bytes.side_effect = [b'a', EOFError()]
+        level_pipe = engine.LevelPipe(pipe)
+        self.assertEqual(b'a', level_pipe.recv_bytes())
+        self.assertRaises(EOFError, level_pipe.recv_bytes)
+        self.assertTrue(level_pipe.closed)
+        self.assertRaises(EOFError, level_pipe.recv_bytes)
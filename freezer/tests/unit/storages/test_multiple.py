@@ -0,0 +1,48 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from unittest import mock
+
+from freezer.storage import multiple
+from freezer.utils import streaming
+
+
+class TestMultipleStorage(unittest.TestCase):
+
+    def _storage(self, received):
+        def write_backup(rich_queue, backup):
+            self.assertEqual(5, rich_queue.max_bytes)
+            received.extend(rich_queue.get_messages())
+
+        storage = mock.Mock(type='local')
+        storage.write_backup.side_effect = write_backup
+        return storage
+
+    def test_write_backup(self):
+        received = ([], [])
+        storage = multiple.MultipleStorage(
+            [self._storage(messages) for messages in received],
+            queue_max_bytes=5)
+        input_queue = streaming.RichQueue()
+        input_queue.put(b'abc')
+        input_queue.put(b'defghi')
+        input_queue.finish()
+
+        with mock.patch.object(multiple, 'LOG') as mock_log:
+            storage.write_backup(input_queue, mock.Mock())
+        self.assertEqual(([b'abc', b'defghi'], [b'abc', b'defghi']),
+                         received)
+        # the stream of every storage is logged
+        self.assertEqual(2, mock_log.info.call_count)
+        self.assertIn('9 bytes in 2 messages',
+                      mock_log.info.call_args[0][0])
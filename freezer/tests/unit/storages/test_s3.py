@@ -0,0 +1,170 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from unittest import mock
+
+import threading
+import time
+
+from freezer.storage import exceptions
+from freezer.storage import s3
+
+
+class TestS3Storage(unittest.TestCase):
+
+    def setUp(self):
+        super(TestS3Storage, self).setUp()
+        self.client = mock.MagicMock()
+        self.client.create_multipart_upload.return_value = {
+            'UploadId': 'upload-id'}
+        self.client.upload_part.side_effect = (
+            lambda **kwargs: {'ETag': 'etag-%d' % kwargs['PartNumber']})
+        self.storage = s3.S3Storage(
+            'access', 'secret', 'http://endpoint', 'bucket/prefix', 1024,
+            skip_prepare=True, upload_concurrency=4)
+        self.storage.get_s3_connection = mock.Mock(return_value=self.client)
+
+    def test_upload_stream(self):
+        self.storage.upload_stream('key', iter([b'a', 'b', None, b'c']))
+
+        self.assertEqual(3, self.client.upload_part.call_count)
+        self.client.complete_multipart_upload.assert_called_once_with(
+            Bucket='bucket', Key='key', UploadId='upload-id',
+            MultipartUpload={'Parts': [
+                {'PartNumber': 1, 'ETag': 'etag-1'},
+                {'PartNumber': 2, 'ETag': 'etag-2'},
+                {'PartNumber': 3, 'ETag': 'etag-3'}]})
+        self.client.abort_multipart_upload.assert_not_called()
+
+    @mock.patch('freezer.storage.transfer.time.sleep')
+    def test_upload_stream_retries_part(self, mock_sleep):
+        self.client.upload_part.side_effect = [
+            IOError('timeout'), {'ETag': 'etag-1'}]
+        self.storage.upload_stream('key', iter([b'a']))
+
+        self.assertEqual(2, self.client.upload_part.call_count)
+        self.client.complete_multipart_upload.assert_called_once_with(
+            Bucket='bucket', Key='key', UploadId='upload-id',
+            MultipartUpload={'Parts': [{'PartNumber': 1, 'ETag': 'etag-1'}]})
+        self.client.abort_multipart_upload.assert_not_called()
+
+    @mock.patch('freezer.storage.transfer.time.sleep')
+    def test_upload_stream_aborts(self, mock_sleep):
+        self.client.upload_part.side_effect = IOError('down')
+        self.assertRaises(exceptions.StorageException,
+                          self.storage.upload_stream, 'key', iter([b'a']))
+        self.client.complete_multipart_upload.assert_not_called()
+        self.client.abort_multipart_upload.assert_called_once_with(
+            Bucket='bucket', Key='key', UploadId='upload-id')
+
+    def test_backup_blocks_ranges(self):
+        data = bytes(range(256)) * 10
+        self.client.head_object.return_value = {'ContentLength': len(data)}
+
+        def get_object(Bucket, Key, Range):
+            start, end = map(int, Range[len('bytes='):].split('-'))
+            body = mock.Mock()
+            body.read.return_value = data[start:end + 1]
+            return {'Body': body}
+
+        self.client.get_object.side_effect = get_object
+        self.storage.download_concurrency = 3
+        backup = mock.Mock()
+        backup.data_path = 'bucket/prefix/data'
+
+        blocks = list(self.storage.backup_blocks(backup))
+
+        self.assertEqual([1024, 1024, 512], [len(b) for b in blocks])
+        self.assertEqual(data, b''.join(blocks))
+        self.client.head_object.assert_called_once_with(
+            Bucket='bucket', Key='prefix/data')
+
+
+@mock.patch('freezer.storage.s3.botocore.session.get_session')
+class TestS3Connection(unittest.TestCase):
+
+    def _storage(self, **kwargs):
+        return s3.S3Storage('access', 'secret', 'http://endpoint',
+                            'bucket/prefix', 1024, skip_prepare=True,
+                            **kwargs)
+
+    def test_client_cached(self, mock_get_session):
+        storage = self._storage()
+        clients = []
+        threads = [threading.Thread(
+            target=lambda: clients.append(storage.get_s3_connection()))
+            for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        storage.listdir('bucket/prefix')
+        storage.get_s3_connection()
+
+        create_client = mock_get_session.return_value.create_client
+        create_client.assert_called_once()
+        self.assertEqual(1, len(set(map(id, clients))))
+
+    @mock.patch('freezer.storage.s3.os.getpid')
+    def test_client_recreated_after_fork(self, mock_getpid,
+                                         mock_get_session):
+        create_client = mock_get_session.return_value.create_client
+        create_client.side_effect = lambda *args, **kwargs: mock.Mock()
+        storage = self._storage()
+        mock_getpid.return_value = 100
+        parent_client = storage.get_s3_connection()
+        mock_getpid.return_value = 101
+        child_client = storage.get_s3_connection()
+
+        self.assertIsNot(parent_client, child_client)
+        self.assertIs(child_client, storage.get_s3_connection())
+        self.assertEqual(2, create_client.call_count)
+
+    @mock.patch('freezer.storage.s3.os.getpid')
+    def test_client_created_once_after_fork(self, mock_getpid,
+                                            mock_get_session):
+        create_client = mock_get_session.return_value.create_client
+
+        def new_client(*args, **kwargs):
+            # let the other threads reach the client while it is created
+            time.sleep(0.01)
+            return mock.Mock()
+
+        create_client.side_effect = new_client
+        storage = self._storage()
+        mock_getpid.return_value = 100
+        storage.get_s3_connection()
+        mock_getpid.return_value = 101
+        s3._reset_client_lock()
+        clients = []
+        threads = [threading.Thread(
+            target=lambda: clients.append(storage.get_s3_connection()))
+            for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(2, create_client.call_count)
+        self.assertEqual(1, len(set(map(id, clients))))
+
+    def test_max_pool_connections(self, mock_get_session):
+        create_client = mock_get_session.return_value.create_client
+        for kwargs, expected in (({}, 10),
+                                 ({'upload_concurrency': 32}, 32),
+                                 ({'download_concurrency': 16}, 16),
+                                 ({'max_pool_connections': 5}, 5)):
+            create_client.reset_mock()
+            self._storage(**kwargs).get_s3_connection()
+            config = create_client.call_args[1]['config']
+            self.assertEqual(expected, config.max_pool_connections)
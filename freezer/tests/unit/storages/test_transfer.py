@@ -0,0 +1,249 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import unittest
+from unittest import mock
+
+from freezer.storage import exceptions
+from freezer.storage import swift
+from freezer.storage import transfer
+
+
+class TestRetryWithBackoff(unittest.TestCase):
+
+    @mock.patch('freezer.storage.transfer.time.sleep')
+    def test_retry_until_success(self, mock_sleep):
+        func = mock.Mock(side_effect=[Exception('a'), Exception('b'), 'ok'])
+        on_error = mock.Mock()
+        self.assertEqual('ok', transfer.retry_with_backoff(
+            func, 'test', on_error=on_error))
+        self.assertEqual(3, func.call_count)
+        self.assertEqual(2, on_error.call_count)
+        mock_sleep.assert_has_calls([mock.call(1), mock.call(2)])
+
+    @mock.patch('freezer.storage.transfer.time.sleep')
+    def test_retry_gives_up(self, mock_sleep):
+        func = mock.Mock(side_effect=IOError('boom'))
+        self.assertRaises(IOError, transfer.retry_with_backoff,
+                          func, 'test', max_retries=8)
+        self.assertEqual(8, func.call_count)
+        delays = [c[0][0] for c in mock_sleep.call_args_list]
+        self.assertEqual([1, 2, 4, 8, 16, 32, 60], delays)
+
+
+class TestParallelUploader(unittest.TestCase):
+
+    def test_results_in_order(self):
+        def upload(index, chunk):
+            # later chunks complete first
+            time.sleep(0.01 * (5 - index))
+            return index, chunk
+
+        chunks = [b'%d' % i for i in range(5)]
+        result = transfer.ParallelUploader(upload, concurrency=5).upload(
+            chunks)
+        self.assertEqual(list(enumerate(chunks)), result)
+
+    def test_limits(self):
+        lock = threading.Lock()
+        inflight = {'count': 0, 'bytes': 0, 'max_count': 0, 'max_bytes': 0}
+
+        def upload(index, chunk):
+            with lock:
+                inflight['count'] += 1
+                inflight['bytes'] += len(chunk)
+                inflight['max_count'] = max(inflight['max_count'],
+                                            inflight['count'])
+                inflight['max_bytes'] = max(inflight['max_bytes'],
+                                            inflight['bytes'])
+            time.sleep(0.01)
+            with lock:
+                inflight['count'] -= 1
+                inflight['bytes'] -= len(chunk)
+
+        chunks = [b'x' * 10 for i in range(20)]
+        transfer.ParallelUploader(upload, concurrency=4).upload(chunks)
+        self.assertLessEqual(inflight['max_count'], 4)
+
+        inflight['max_count'] = inflight['max_bytes'] = 0
+        transfer.ParallelUploader(upload, concurrency=4,
+                                  max_buffer_size=25).upload(chunks)
+        self.assertLessEqual(inflight['max_bytes'], 25)
+        self.assertLessEqual(inflight['max_count'], 2)
+
+    def test_error_stops_consuming(self):
+        consumed = []
+
+        def chunks():
+            for i in range(100):
+                consumed.append(i)
+                yield b'x'
+
+        def upload(index, chunk):
+            if index == 2:
+                raise IOError('upload failed')
+
+        uploader = transfer.ParallelUploader(upload, concurrency=1)
+        self.assertRaises(IOError, uploader.upload, chunks())
+        self.assertLess(len(consumed), 100)
+
+
+class TestParallelDownloader(unittest.TestCase):
+
+    def test_results_in_order(self):
+        def download(index):
+            # later parts complete first
+            time.sleep(0.01 * (5 - index))
+            return b'%d' % index
+
+        parts = [(i, 1) for i in range(5)]
+        result = transfer.ParallelDownloader(
+            download, concurrency=5).download(parts)
+        self.assertEqual([b'0', b'1', b'2', b'3', b'4'], list(result))
+
+    def test_limits(self):
+        started = []
+        release = threading.Event()
+
+        def download(index):
+            started.append(index)
+            release.wait(5)
+            return b'x' * 10
+
+        parts = [(i, 10) for i in range(20)]
+        downloader = transfer.ParallelDownloader(download, concurrency=4,
+                                                 max_buffer_size=25)
+        result = downloader.download(parts)
+        first = []
+        thread = threading.Thread(target=lambda: first.append(next(result)))
+        thread.start()
+        time.sleep(0.05)
+        # only the parts fitting in the buffer budget are fetched ahead
+        self.assertEqual([0, 1], sorted(started))
+        release.set()
+        thread.join()
+        self.assertEqual(19, len(list(result)))
+
+    def test_error_raised_in_order(self):
+        def download(index):
+            if index == 2:
+                raise IOError('download failed')
+            return b'x'
+
+        result = transfer.ParallelDownloader(download, concurrency=3).download(
+            (i, 1) for i in range(10))
+        self.assertEqual(b'x', next(result))
+        self.assertEqual(b'x', next(result))
+        self.assertRaises(IOError, next, result)
+
+    def test_close_stops_downloading(self):
+        downloaded = []
+
+        def download(index):
+            downloaded.append(index)
+            return b'x'
+
+        result = transfer.ParallelDownloader(download, concurrency=2).download(
+            (i, 1) for i in range(100))
+        next(result)
+        result.close()
+        self.assertLess(len(downloaded), 100)
+
+
+class TestSwiftParallelUpload(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSwiftParallelUpload, self).setUp()
+        self.connection = mock.MagicMock()
+        self.client_manager = mock.MagicMock()
+        self.client_manager.create_swift.return_value = self.connection
+        self.storage = swift.SwiftStorage(
+            self.client_manager, 'container', 1024, skip_prepare=True,
+            upload_concurrency=3)
+
+    def test_write_backup_manifest_after_segments(self):
+        rich_queue = mock.Mock()
+        rich_queue.get_messages.return_value = iter(
+            [b'a', b'b', b'c', b'd'])
+        backup = mock.Mock()
+        backup.copy.return_value = backup
+        backup.segments_path = 'container/path/segments'
+        backup.data_path = 'container/path/data'
+
+        self.storage.write_backup(rich_queue, backup)
+
+        calls = self.connection.put_object.call_args_list
+        segments = sorted('/'.join(c[0][:2]) for c in calls[:-1])
+        self.assertEqual(
+            ['container/path/segments/%08d' % i for i in range(4)],
+            segments)
+        self.assertEqual({'x-object-manifest': 'container/path/segments'},
+                         calls[-1][1]['headers'])
+
+    @mock.patch('freezer.storage.transfer.time.sleep')
+    def test_upload_chunk_reconnects(self, mock_sleep):
+        self.connection.put_object.side_effect = [Exception('down'), None]
+        self.storage.upload_chunk(b'data', 'container/obj')
+        self.assertEqual(2, self.client_manager.create_swift.call_count)
+
+    @mock.patch('freezer.storage.transfer.time.sleep')
+    def test_no_manifest_on_failure(self, mock_sleep):
+        self.connection.put_object.side_effect = Exception('down')
+        rich_queue = mock.Mock()
+        rich_queue.get_messages.return_value = iter([b'a'])
+        self.storage.upload_manifest = mock.Mock()
+        self.assertRaises(exceptions.StorageException,
+                          self.storage.write_backup,
+                          rich_queue, mock.Mock())
+        self.storage.upload_manifest.assert_not_called()
+
+
+class TestSwiftParallelDownload(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSwiftParallelDownload, self).setUp()
+        self.connection = mock.MagicMock()
+        self.client_manager = mock.MagicMock()
+        self.client_manager.create_swift.return_value = self.connection
+        self.backup = mock.Mock()
+        self.backup.segments_path = 'container/path/segments'
+        self.backup.data_path = 'container/path/data'
+
+    def _storage(self, download_concurrency):
+        return swift.SwiftStorage(
+            self.client_manager, 'container', 1024, skip_prepare=True,
+            download_concurrency=download_concurrency)
+
+    def test_backup_blocks_segments(self):
+        self.connection.get_container.return_value = (None, [
+            {'name': 'path/segments/%08d' % i, 'bytes': 1}
+            for i in (2, 0, 1)])
+        self.connection.get_object.side_effect = (
+            lambda container, obj: (None, obj[-1:].encode()))
+
+        blocks = list(self._storage(3).backup_blocks(self.backup))
+
+        self.assertEqual([b'0', b'1', b'2'], blocks)
+        self.connection.get_container.assert_called_once_with(
+            'container', prefix='path/segments/', full_listing=True)
+
+    def test_backup_blocks_single_stream(self):
+        self.connection.get_object.return_value = (None, iter([b'a', b'b']))
+
+        blocks = list(self._storage(1).backup_blocks(self.backup))
+
+        self.assertEqual([b'a', b'b'], blocks)
+        self.connection.get_container.assert_not_called()
+        self.connection.get_object.assert_called_once_with(
+            'container', 'path/data', resp_chunk_size=1024)
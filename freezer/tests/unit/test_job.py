@@ -64,6 +64,18 @@ class TestBackupJob(TestJob):
             job = jobs.BackupJob(backup_opt, backup_opt.storage)
         self.assertRaises(Exception, job.execute)  # noqa
 
+    def test_dir_change_tracking_without_change_log_raise(self):
+        backup_opt = commons.BackupOpt1()
+        backup_opt.mode = 'fs'
+        backup_opt.incremental = True
+        backup_opt.dir_change_tracking = True
+        with mock.patch('openstack.connection.Connection'):
+            self.assertRaisesRegex(ValueError, '--change-log',
+                                   jobs.BackupJob, backup_opt,
+                                   backup_opt.storage)
+            backup_opt.change_log = '/var/lib/freezer/changes'
+            jobs.BackupJob(backup_opt, backup_opt.storage)
+
     @mock.patch('freezer.openstack.backup.BackupOs')
     def test_execute_cindernative(self, mock_backup_os):
         backup_opt = commons.BackupOpt1()
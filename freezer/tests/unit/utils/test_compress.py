@@ -0,0 +1,149 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import importlib.util
+import random
+import unittest
+from unittest import mock
+
+from freezer.utils import compress
+
+
+def _available(compression_algo):
+    module_name = compress.get_compression_algo(compression_algo)
+    return importlib.util.find_spec(module_name.split('.')[0]) is not None
+
+
+class CompressTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(CompressTestCase, self).setUp()
+        rnd = random.Random(0)
+        self.data = b''.join(rnd.randbytes(100) * 10 for _ in range(50))
+
+    def _round_trip(self, compression_algo, **kwargs):
+        if not _available(compression_algo):
+            self.skipTest('{} not installed'.format(compression_algo))
+        compressor = compress.Compressor(compression_algo, **kwargs)
+        compressed = b''.join(
+            [compressor.compress(self.data[i:i + 3000])
+             for i in range(0, len(self.data), 3000)] + [compressor.flush()])
+        self.assertLess(len(compressed), len(self.data))
+
+        decompressor = compress.Decompressor(compression_algo)
+        data = b''.join(
+            [decompressor.decompress(compressed[i:i + 777])
+             for i in range(0, len(compressed), 777)] +
+            [decompressor.flush()])
+        self.assertEqual(self.data, data)
+
+        # the streams are read by the one shot functions, and back
+        self.assertEqual(self.data, compress.one_shot_decompress(
+            compression_algo, compressed))
+        self.assertEqual(self.data, compress.one_shot_decompress(
+            compression_algo, compress.one_shot_compress(compression_algo,
+                                                         self.data)))
+
+    def test_gzip(self):
+        self._round_trip('gzip')
+        self._round_trip('gzip', level=1)
+
+    def test_bzip2(self):
+        self._round_trip('bzip2')
+
+    def test_xz(self):
+        self._round_trip('xz')
+
+    def test_zstd(self):
+        self._round_trip('zstd')
+        self._round_trip('zstd', level=19)
+        self._round_trip('zstd', threads=2)
+
+    def test_lz4(self):
+        self._round_trip('lz4')
+        self._round_trip('lz4', level=9)
+
+    def test_lz4_empty(self):
+        if not _available('lz4'):
+            self.skipTest('lz4 not installed')
+        compressor = compress.Compressor('lz4')
+        self.assertEqual(b'', compress.one_shot_decompress(
+            'lz4', compressor.flush()))
+
+    @mock.patch('importlib.import_module', side_effect=ImportError)
+    def test_missing_module(self, mock_import):
+        self.assertRaisesRegex(ImportError,
+                               r'install the zstandard module, or the '
+                               r'freezer\[zstd\] extra',
+                               compress.Compressor, 'zstd')
+
+
+@mock.patch.object(compress, 'FRAME_SIZE', 4096)
+class FrameCompressTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(FrameCompressTestCase, self).setUp()
+        rnd = random.Random(0)
+        # compressible frames then random ones
+        self.data = b'text ' * 4096 + rnd.randbytes(3 * 4096 + 10)
+
+    def _round_trip(self, compressor, threads=0):
+        compressed = b''.join(
+            [compressor.compress(self.data[i:i + 3000])
+             for i in range(0, len(self.data), 3000)] + [compressor.flush()])
+
+        decompressor = compress.FrameDecompressor('gzip', threads)
+        data = b''.join(
+            [decompressor.decompress(compressed[i:i + 777])
+             for i in range(0, len(compressed), 777)] +
+            [decompressor.flush()])
+        self.assertEqual(self.data, data)
+        return compressed
+
+    def test_frames(self):
+        compressor = compress.FrameCompressor('gzip', level=1)
+        self._round_trip(compressor)
+        self.assertEqual(9, compressor.frames)
+        self.assertEqual(0, compressor.stored_frames)
+
+    def test_adaptive(self):
+        compressor = compress.FrameCompressor('gzip', adaptive=True)
+        compressed = self._round_trip(compressor)
+        self.assertEqual(9, compressor.frames)
+        self.assertEqual(4, compressor.stored_frames)
+        # the stored frames only add their header
+        self.assertLess(len(compressed), 5 * 4096)
+
+    @mock.patch.object(compress, 'FRAMES_IN_FLIGHT_PER_THREAD', 1)
+    def test_threads(self):
+        compressor = compress.FrameCompressor('gzip', adaptive=True)
+        compressed = self._round_trip(compressor)
+
+        # the frames are reassembled in order
+        compressor = compress.FrameCompressor('gzip', threads=3,
+                                              adaptive=True)
+        self.assertEqual(compressed, self._round_trip(compressor, threads=2))
+        self.assertEqual(9, compressor.frames)
+        self.assertEqual(4, compressor.stored_frames)
+        self.assertIsNone(compressor._executor)
+
+    def test_truncated(self):
+        compressor = compress.FrameCompressor('gzip')
+        compressed = compressor.compress(self.data) + compressor.flush()
+        decompressor = compress.FrameDecompressor('gzip')
+        decompressor.decompress(compressed[:-1])
+        self.assertRaises(ValueError, decompressor.flush)
+
+    def test_is_compressible(self):
+        self.assertTrue(compress.is_compressible(self.data[:20000]))
+        self.assertFalse(compress.is_compressible(self.data[-12000:]))
+        self.assertFalse(compress.is_compressible(b''))
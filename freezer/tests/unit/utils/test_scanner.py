@@ -0,0 +1,76 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from freezer.utils import scanner
+
+
+class ScannerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(ScannerTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        for path in ('a/b/c', 'a/d', 'e'):
+            os.makedirs(os.path.join(self.tmpdir, path))
+        for path in ('f', 'a/g', 'a/b/c/h'):
+            with open(os.path.join(self.tmpdir, path), 'wb') as f:
+                f.write(b'data')
+        os.symlink('a', os.path.join(self.tmpdir, 'l'))
+
+    def tearDown(self):
+        super(ScannerTestCase, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def _walk(self, workers):
+        tree = []
+        for dirpath, dirs, files in scanner.walk(self.tmpdir, workers):
+            tree.append((os.path.relpath(dirpath, self.tmpdir),
+                         sorted(entry.name for entry in dirs),
+                         sorted(entry.name for entry in files)))
+        return tree
+
+    def test_walk(self):
+        expected = [('.', ['a', 'e'], ['f', 'l']),
+                    ('a', ['b', 'd'], ['g']),
+                    ('e', [], []),
+                    ('a/b', ['c'], []),
+                    ('a/d', [], []),
+                    ('a/b/c', [], ['h'])]
+        for workers in (1, 4):
+            tree = self._walk(workers)
+            # the order of the subdirectories of a directory may change
+            self.assertEqual(sorted(expected), sorted(tree))
+            parents = [os.path.dirname(path) for path, _, _ in tree[1:]]
+            for index, parent in enumerate(parents, 1):
+                self.assertIn(parent or '.',
+                              [path for path, _, _ in tree[:index]])
+
+    def test_walk_errors(self):
+        shutil.rmtree(os.path.join(self.tmpdir, 'e'))
+        self.assertEqual([('e', [], [])],
+                         [(os.path.basename(d), dirs, files) for d, dirs, files
+                          in scanner.walk(os.path.join(self.tmpdir, 'e'))])
+
+    @mock.patch('grp.getgrgid', return_value=('group', 'x', 1, []))
+    @mock.patch('pwd.getpwuid', return_value=('user', 'x', 1, 1))
+    def test_owner_names(self, mock_getpwuid, mock_getgrgid):
+        names = scanner.OwnerNames()
+        for _ in range(3):
+            self.assertEqual('user', names.user(1))
+            self.assertEqual('group', names.group(1))
+        mock_getpwuid.assert_called_once_with(1)
+        mock_getgrgid.assert_called_once_with(1)
@@ -13,6 +13,8 @@
 # limitations under the License.
 
 import queue
+import threading
+import time
 import unittest
 
 from freezer.utils import streaming
@@ -68,3 +70,112 @@ class StreamingTestCase(unittest.TestCase):
     def test_stream_5(self):
         input_queue = self.create_fifo(5)
         assert input_queue.finish_transmission is True
+
+
+class RichQueueTestCase(unittest.TestCase):
+
+    def test_get_returns_on_finish(self):
+        rich_queue = streaming.RichQueue()
+        consumer = threading.Thread(
+            target=lambda: list(rich_queue.get_messages()))
+        consumer.start()
+        started = time.monotonic()
+        rich_queue.finish()
+        consumer.join(5)
+        self.assertFalse(consumer.is_alive())
+        self.assertLess(time.monotonic() - started, 0.5)
+
+    def test_byte_budget(self):
+        rich_queue = streaming.RichQueue(size=10, max_bytes=5)
+        rich_queue.put(b'abc')
+        producer = threading.Thread(target=rich_queue.put, args=(b'def',))
+        producer.start()
+        producer.join(0.1)
+        # b'def' does not fit in the budget until b'abc' is consumed
+        self.assertTrue(producer.is_alive())
+        self.assertEqual(b'abc', rich_queue.get())
+        producer.join(5)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(b'def', rich_queue.get())
+
+    def test_message_bigger_than_budget(self):
+        rich_queue = streaming.RichQueue(size=10, max_bytes=2)
+        rich_queue.put(b'abcdef')
+        self.assertEqual(b'abcdef', rich_queue.get())
+
+    def test_force_stop_wakes_producer(self):
+        rich_queue = streaming.RichQueue(size=1)
+        rich_queue.put(b'a')
+        errors = []
+
+        def put():
+            try:
+                rich_queue.put(b'b')
+            except Exception as e:
+                errors.append(e)
+
+        producer = threading.Thread(target=put)
+        producer.start()
+        rich_queue.force_stop()
+        producer.join(5)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(1, len(errors))
+
+    def test_stats(self):
+        rich_queue = streaming.RichQueue(size=1)
+        producer = threading.Thread(
+            target=rich_queue.put_messages, args=([b'ab', b'cde', b'f'],))
+        producer.start()
+        time.sleep(0.05)
+        messages = list(rich_queue.get_messages())
+        producer.join()
+
+        self.assertEqual([b'ab', b'cde', b'f'], messages)
+        stats = rich_queue.stats()
+        self.assertEqual(6, stats['bytes'])
+        self.assertEqual(3, stats['messages'])
+        self.assertGreater(stats['put_wait_time'], 0)
+
+
+class SegmentAssemblerTestCase(unittest.TestCase):
+
+    def test_take_all(self):
+        segment = streaming.SegmentAssembler()
+        for chunk in (b'ab', b'', bytearray(b'cd'), b'e'):
+            segment.append(chunk)
+        self.assertEqual(5, len(segment))
+        self.assertEqual(b'abcde', segment.take())
+        self.assertEqual(0, len(segment))
+        self.assertEqual(b'', segment.take())
+
+    def test_take_size(self):
+        segment = streaming.SegmentAssembler()
+        segment.append(b'abc')
+        segment.append(b'defgh')
+        self.assertEqual(b'ab', segment.take(2))
+        self.assertEqual(b'cdef', segment.take(4))
+        self.assertIsInstance(segment.take(1), bytes)
+        self.assertEqual(1, len(segment))
+        self.assertEqual(b'h', segment.take(10))
+
+
+class ChunkReaderTestCase(unittest.TestCase):
+
+    def test_read(self):
+        reader = streaming.ChunkReader(iter([b'abc', b'', b'defgh']))
+        self.assertEqual(b'ab', reader.read(2))
+        # a read does not span chunks
+        self.assertEqual(b'c', reader.read(4))
+        self.assertEqual(b'def', reader.read(3))
+        reader.unread(b'ef')
+        self.assertEqual(b'efgh', b''.join([reader.read(2), reader.read()]))
+        self.assertRaises(StopIteration, reader.read, 1)
+
+    def test_chunks_released(self):
+        chunks = [bytearray(b'abc'), bytearray(b'def')]
+        reader = streaming.ChunkReader(chunks)
+        reader.read(3)
+        reader.read(1)
+        # the first chunk is not referenced anymore and can be resized
+        chunks[0].extend(b'x')
+        self.assertRaises(BufferError, chunks[1].extend, b'x')
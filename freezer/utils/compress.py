@@ -12,30 +12,87 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
+from concurrent import futures
+import importlib
+import struct
+import zlib
+
 GZIP = 'zlib'
 BZIP2 = 'bz2'
 XZ = 'lzma'
+ZSTD = 'zstandard'
+LZ4 = 'lz4.frame'
 
 COMPRESS_METHOD = 'compress'
 DECOMPRESS_METHOD = 'decompress'
 
+# Level of the streaming compressors when not set
+DEFAULT_LEVELS = {
+    'gzip': 9,
+    'bzip2': 9,
+    'xz': 6,
+    'zstd': 3,
+    'lz4': 0,
+}
+
+# Size of the data of a frame of the framed streams
+FRAME_SIZE = 1024 * 1024
+
+# Header of the frames: codec flag and size of the frame data
+FRAME_HEADER = struct.Struct('>BI')
+FRAME_STORED = 0
+FRAME_COMPRESSED = 1
+
+# Frames compressed or decompressed ahead of the one written, per thread
+FRAMES_IN_FLIGHT_PER_THREAD = 4
+
+# Adaptive compression: size and number of the blocks of a frame sampled,
+# the frame is stored when zlib at level 1 does not save ADAPTIVE_MIN_SAVING
+# of the samples
+ADAPTIVE_SAMPLE_SIZE = 16 * 1024
+ADAPTIVE_SAMPLES = 4
+ADAPTIVE_MIN_SAVING = 0.1
+
 
 def get_compression_algo(compression_algo):
     algo = {
         'gzip': GZIP,
         'bzip2': BZIP2,
         'xz': XZ,
+        'zstd': ZSTD,
+        'lz4': LZ4,
     }
     return algo.get(compression_algo)
 
 
+def import_compression_module(compression_algo):
+    """
+    :return: python module of the compression algorithm
+    :raises ImportError: if the module of zstd or lz4 is not installed
+    """
+    module_name = get_compression_algo(compression_algo)
+    try:
+        return importlib.import_module(module_name)
+    except ImportError:
+        raise ImportError('Please install the {0} module, or the freezer[{1}] '
+                          'extra, for the {1} compression'.format(
+                              module_name.split('.')[0], compression_algo))
+
+
 def one_shot_compress(compression_algo, data):
-    compression_module = __import__(get_compression_algo(compression_algo))
+    compression_module = import_compression_module(compression_algo)
+    if compression_algo == 'zstd':
+        return compression_module.ZstdCompressor().compress(data)
     return getattr(compression_module, COMPRESS_METHOD)(data)
 
 
 def one_shot_decompress(compression_algo, data):
-    compression_module = __import__(get_compression_algo(compression_algo))
+    compression_module = import_compression_module(compression_algo)
+    if compression_algo == 'zstd':
+        # The content size is not known by the frames written by streaming
+        return compression_module.ZstdDecompressor().decompressobj(
+        ).decompress(data)
     return getattr(compression_module, DECOMPRESS_METHOD)(data)
 
 
@@ -45,11 +102,26 @@ class BaseCompressor(object):
     """
 
     def __init__(self, compression_algo):
-        # TODO(raliev): lzma module exists in stdlib since Py3 only
-        if compression_algo == 'xz':
-            raise NotImplementedError('XZ compression not implemented yet')
         self.algo = get_compression_algo(compression_algo)
-        self.module = __import__(self.algo)
+        self.module = import_compression_module(compression_algo)
+
+
+class _LZ4CompressObj(object):
+    """lz4 frame compressor with the interface of zlib.compressobj."""
+
+    def __init__(self, module, level):
+        self._compressor = module.LZ4FrameCompressor(compression_level=level)
+        self._header = self._compressor.begin()
+
+    def compress(self, data):
+        data = self._compressor.compress(data)
+        if self._header:
+            data = self._header + data
+            self._header = b''
+        return data
+
+    def flush(self):
+        return self._header + self._compressor.flush()
 
 
 class Compressor(BaseCompressor):
@@ -57,23 +129,37 @@ class Compressor(BaseCompressor):
     Compress chucks of data.
     """
 
-    MAX_COMPRESS_LEVEL = 9
-
-    def __init__(self, compression_algo):
+    def __init__(self, compression_algo, level=None, threads=0):
+        """
+        :param level: compression level, DEFAULT_LEVELS if not set
+        :param threads: number of threads compressing the data in the
+                        background with zstd, 0 compresses in the calling
+                        thread
+        """
         super(Compressor, self).__init__(compression_algo)
-        self.compressobj = self.create_compressobj(compression_algo)
+        if level is None:
+            level = DEFAULT_LEVELS[compression_algo]
+        self.compressobj = self.create_compressobj(compression_algo, level,
+                                                   threads)
+
+    def create_compressobj(self, compression_algo, level, threads=0):
+        if compression_algo == 'zstd':
+            return self.module.ZstdCompressor(
+                level=level, threads=threads).compressobj()
+        if compression_algo == 'lz4':
+            return _LZ4CompressObj(self.module, level)
+        if compression_algo == 'xz':
+            return self.module.LZMACompressor(preset=level)
 
-    def create_compressobj(self, compression_algo):
         def get_obj_name():
             names = {
                 'gzip': 'compressobj',
                 'bzip2': 'BZ2Compressor',
-                'xz': 'compressobj',
             }
             return names.get(compression_algo)
 
         obj_name = get_obj_name()
-        return getattr(self.module, obj_name)(self.MAX_COMPRESS_LEVEL)
+        return getattr(self.module, obj_name)(level)
 
     def compress(self, data):
         return self.compressobj.compress(data)
@@ -92,11 +178,15 @@ class Decompressor(BaseCompressor):
         self.decompressobj = self.create_decompressobj(compression_algo)
 
     def create_decompressobj(self, compression_algo):
+        if compression_algo == 'zstd':
+            return self.module.ZstdDecompressor().decompressobj()
+
         def get_obj_name():
             names = {
                 'gzip': 'decompressobj',
                 'bzip2': 'BZ2Decompressor',
-                'xz': 'decompressobj',
+                'xz': 'LZMADecompressor',
+                'lz4': 'LZ4FrameDecompressor',
             }
             return names.get(compression_algo)
 
@@ -107,4 +197,184 @@ class Decompressor(BaseCompressor):
         return self.decompressobj.decompress(data)
 
     def flush(self):
-        return self.decompressobj.flush()
+        # Only zlib keeps data until flushed
+        flush = getattr(self.decompressobj, 'flush', None)
+        return flush() if flush else b''
+
+
+def is_compressible(data):
+    """Tell if data is worth compressing from the compression of samples.
+
+    Media files, compressed archives and encrypted data do not compress.
+    The samples are compressed with zlib at its fastest level whatever the
+    compression algorithm, which costs a few percent of the compression of
+    the data.
+    """
+    if len(data) <= ADAPTIVE_SAMPLE_SIZE * ADAPTIVE_SAMPLES:
+        sample = data
+    else:
+        step = len(data) // ADAPTIVE_SAMPLES
+        sample = b''.join(data[offset:offset + ADAPTIVE_SAMPLE_SIZE]
+                          for offset in range(0, step * ADAPTIVE_SAMPLES,
+                                              step))
+    if not sample:
+        return False
+    saving = 1 - len(zlib.compress(sample, 1)) / len(sample)
+    return saving >= ADAPTIVE_MIN_SAVING
+
+
+class _FramePipeline(object):
+    """Process the frames of a stream in order, on a pool of threads.
+
+    The compression modules release the GIL, the frames are processed in
+    parallel by the threads.
+    """
+
+    def __init__(self, threads):
+        """
+        :param threads: number of threads processing the frames, 0
+                        processes them in the calling thread
+        """
+        self._executor = None
+        if threads:
+            self._executor = futures.ThreadPoolExecutor(max_workers=threads)
+        self._max_in_flight = threads * FRAMES_IN_FLIGHT_PER_THREAD
+        self._in_flight = collections.deque()
+
+    def _submit(self, func, *args):
+        """Process a frame.
+
+        :return: results of the frames processed, in the stream order
+        """
+        if self._executor is None:
+            return [func(*args)]
+        self._in_flight.append(self._executor.submit(func, *args))
+        results = []
+        while self._in_flight and (self._in_flight[0].done() or
+                                   len(self._in_flight) >
+                                   self._max_in_flight):
+            results.append(self._in_flight.popleft().result())
+        return results
+
+    def _drain(self):
+        """Wait for the frames in flight and stop the threads.
+
+        :return: results of the frames, in the stream order
+        """
+        results = [future.result() for future in self._in_flight]
+        self._in_flight.clear()
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        return results
+
+
+class FrameCompressor(_FramePipeline):
+    """
+    Compress chunks of data to a stream of frames compressed independently.
+
+    Each frame is a FRAME_HEADER with the codec of the frame, followed by
+    the data of FRAME_SIZE bytes of the stream, compressed or stored. It
+    has the interface of Compressor.
+    """
+
+    def __init__(self, compression_algo, level=None, threads=0,
+                 adaptive=False):
+        """
+        :param threads: number of threads compressing the frames, 0
+                        compresses them in the calling thread
+        :param adaptive: store the frames which do not compress, see
+                         is_compressible
+        """
+        super(FrameCompressor, self).__init__(threads)
+        self.compression_algo = compression_algo
+        self.level = level
+        self.adaptive = adaptive
+        self.frames = 0
+        self.stored_frames = 0
+        self._buffer = bytearray()
+        # Fail early on a missing module or a bad level
+        Compressor(compression_algo, level)
+
+    def _compress_frame(self, data):
+        if self.adaptive and not is_compressible(data):
+            return FRAME_STORED, data
+        compressor = Compressor(self.compression_algo, self.level)
+        return FRAME_COMPRESSED, compressor.compress(data) + compressor.flush()
+
+    def _join(self, frames):
+        chunks = []
+        for flag, data in frames:
+            self.frames += 1
+            if flag == FRAME_STORED:
+                self.stored_frames += 1
+            chunks.append(FRAME_HEADER.pack(flag, len(data)))
+            chunks.append(data)
+        return b''.join(chunks)
+
+    def compress(self, data):
+        self._buffer += data
+        frames = []
+        offset = 0
+        while len(self._buffer) - offset >= FRAME_SIZE:
+            frames.extend(self._submit(
+                self._compress_frame,
+                bytes(self._buffer[offset:offset + FRAME_SIZE])))
+            offset += FRAME_SIZE
+        del self._buffer[:offset]
+        return self._join(frames)
+
+    def flush(self):
+        frames = []
+        if self._buffer:
+            frames = self._submit(self._compress_frame, bytes(self._buffer))
+            self._buffer = bytearray()
+        return self._join(frames + self._drain())
+
+
+class FrameDecompressor(_FramePipeline):
+    """
+    Decompress the chunks of a stream of FrameCompressor.
+    """
+
+    def __init__(self, compression_algo, threads=0):
+        """
+        :param threads: number of threads decompressing the frames, 0
+                        decompresses them in the calling thread
+        """
+        super(FrameDecompressor, self).__init__(threads)
+        self.compression_algo = compression_algo
+        # Fail early on a missing module
+        import_compression_module(compression_algo)
+        self._buffer = bytearray()
+
+    def _decompress_frame(self, data):
+        decompressor = Decompressor(self.compression_algo)
+        return decompressor.decompress(data) + decompressor.flush()
+
+    def decompress(self, data):
+        self._buffer += data
+        chunks = []
+        offset = 0
+        while len(self._buffer) - offset >= FRAME_HEADER.size:
+            flag, size = FRAME_HEADER.unpack_from(self._buffer, offset)
+            end = offset + FRAME_HEADER.size + size
+            if len(self._buffer) < end:
+                break
+            frame = bytes(self._buffer[offset + FRAME_HEADER.size:end])
+            if flag == FRAME_STORED:
+                chunks.extend(self._submit(bytes, frame))
+            elif flag == FRAME_COMPRESSED:
+                chunks.extend(self._submit(self._decompress_frame, frame))
+            else:
+                raise ValueError('Unknown compression frame flag {}'.format(
+                    flag))
+            offset = end
+        del self._buffer[:offset]
+        return b''.join(chunks)
+
+    def flush(self):
+        chunks = self._drain()
+        if self._buffer:
+            raise ValueError('Truncated compression frame')
+        return b''.join(chunks)
@@ -0,0 +1,126 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Freezer file system tree scanner
+"""
+
+import collections
+from concurrent import futures
+import grp
+import os
+import pwd
+import stat
+
+from oslo_log import log
+
+LOG = log.getLogger(__name__)
+
+# Directories listed ahead of the one being processed, per thread
+SCAN_QUEUE_DEPTH = 16
+
+
+def _scan(path, skip=None):
+    """List a directory and stat its entries.
+
+    :return: the directory path, the entries of its subdirectories, the
+             entries of its other files and the paths of the subdirectories
+             to walk
+    """
+    if skip:
+        subdirs = skip(path)
+        if subdirs is not None:
+            return path, None, None, subdirs
+
+    dirs = []
+    files = []
+    try:
+        with os.scandir(path) as it:
+            entries = list(it)
+    except (OSError, IOError) as error:
+        LOG.warning('[*] Unable to list directory {0}: {1}'.format(
+            path, error))
+        return path, dirs, files, []
+
+    for entry in entries:
+        try:
+            # The result is cached by the entry
+            entry_stat = entry.stat(follow_symlinks=False)
+        except (OSError, IOError) as error:
+            LOG.warning('[*] Error on file stat: {}'.format(error))
+            continue
+        if stat.S_ISDIR(entry_stat.st_mode):
+            dirs.append(entry)
+        else:
+            files.append(entry)
+
+    return path, dirs, files, [entry.path for entry in dirs]
+
+
+def walk(top, workers=1, skip=None):
+    """Walk a directory tree like os.walk, with the entries already stat'ed.
+
+    The directories are listed by a pool of threads ahead of the one being
+    processed, which hides the latency of network file systems. They are
+    yielded breadth first, always after their parent directory. Symbolic
+    links to directories are not followed and are returned with the files.
+
+    :param top: path of the tree
+    :param workers: number of threads listing the directories
+    :param skip: function called by the listing threads with the path of
+                 each directory, returning the paths of its subdirectories
+                 to walk without listing it, or None to list it
+    :return: generator of (dirpath, dir entries, file entries) tuples, the
+             entries being os.DirEntry objects whose stat(
+             follow_symlinks=False) result is cached, or None for the
+             directories skipped
+    """
+    pending = collections.deque([top])
+
+    if workers <= 1:
+        while pending:
+            dirpath, dirs, files, subdirs = _scan(pending.popleft(), skip)
+            yield dirpath, dirs, files
+            pending.extend(subdirs)
+        return
+
+    in_flight = collections.deque()
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or in_flight:
+            while pending and len(in_flight) < workers * SCAN_QUEUE_DEPTH:
+                in_flight.append(executor.submit(_scan, pending.popleft(),
+                                                 skip))
+            dirpath, dirs, files, subdirs = in_flight.popleft().result()
+            yield dirpath, dirs, files
+            pending.extend(subdirs)
+
+
+class OwnerNames(object):
+    """User and group names of the file owners, looked up once per id."""
+
+    def __init__(self):
+        self._users = {}
+        self._groups = {}
+
+    def user(self, uid):
+        try:
+            return self._users[uid]
+        except KeyError:
+            name = self._users[uid] = pwd.getpwuid(uid)[0]
+            return name
+
+    def group(self, gid):
+        try:
+            return self._groups[gid]
+        except KeyError:
+            name = self._groups[gid] = grp.getgrgid(gid)[0]
+            return name
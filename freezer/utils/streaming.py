@@ -17,10 +17,11 @@
 Freezer general utils functions
 """
 
+import collections
 import threading
+import time
 
 from oslo_log import log
-import queue
 
 
 LOG = log.getLogger(__name__)
@@ -32,34 +33,91 @@ class Wait(Exception):
 
 class RichQueue(object):
     """
-        :type data_queue: Queue.Queue
+    Bounded producer/consumer channel between a backup stream and a storage.
+
+    Producer and consumer block on a condition variable and are woken up as
+    soon as a message, the end of the transmission or a forced stop is
+    signalled, so no thread ever polls. The capacity is a number of
+    messages and, optionally, a number of bytes: a message bigger than the
+    byte budget is still accepted when the queue is empty.
+
+    The channel counts the bytes passed through it and the time spent by
+    the producer and the consumer waiting on each other, see stats().
     """
-    def __init__(self, size=2):
+    def __init__(self, size=2, max_bytes=None):
         """
+        :param size: maximum number of queued messages
         :type size: int
+        :param max_bytes: maximum number of queued bytes, no limit if unset
+        :type max_bytes: int
         :return:
         """
-        self.data_queue = queue.Queue(maxsize=size)
-        # transmission changes in atomic way so no synchronization needed
+        self.size = size
+        self.max_bytes = max_bytes
         self.finish_transmission = False
         self.is_force_stop = False
+        self._messages = collections.deque()
+        self._queued_bytes = 0
+        self._cond = threading.Condition()
+        self.bytes_passed = 0
+        self.messages_passed = 0
+        self.put_wait_time = 0.0
+        self.get_wait_time = 0.0
+
+    @staticmethod
+    def _message_size(message):
+        try:
+            return len(message)
+        except TypeError:
+            return 0
 
     def finish(self):
-        self.finish_transmission = True
+        with self._cond:
+            self.finish_transmission = True
+            self._cond.notify_all()
 
     def force_stop(self):
-        self.is_force_stop = True
+        with self._cond:
+            self.is_force_stop = True
+            self._cond.notify_all()
 
     def empty(self):
-        return self.data_queue.empty()
+        with self._cond:
+            return not self._messages
 
-    def get(self):
-        try:
-            res = self.data_queue.get(timeout=1)
-            self.data_queue.task_done()
-            return res
-        except queue.Empty:
-            raise Wait()
+    def _full(self, size):
+        if not self._messages:
+            return False
+        if self.size and len(self._messages) >= self.size:
+            return True
+        return bool(self.max_bytes and
+                    self._queued_bytes + size > self.max_bytes)
+
+    def get(self, timeout=None):
+        """
+        Wait for the next message.
+
+        :param timeout: seconds to wait, forever if None
+        :raise Wait: no message is available because the transmission is
+                     finished or the timeout expired
+        """
+        with self._cond:
+            if not self._messages:
+                started = time.monotonic()
+                self._cond.wait_for(
+                    lambda: (self._messages or self.finish_transmission or
+                             self.is_force_stop), timeout)
+                self.get_wait_time += time.monotonic() - started
+            self.check_stop()
+            if not self._messages:
+                raise Wait()
+            message = self._messages.popleft()
+            size = self._message_size(message)
+            self._queued_bytes -= size
+            self.bytes_passed += size
+            self.messages_passed += 1
+            self._cond.notify_all()
+            return message
 
     def check_stop(self):
         if self.is_force_stop:
@@ -71,23 +129,130 @@ class RichQueue(object):
         self.finish()
 
     def has_more(self):
-        self.check_stop()
-        return not self.finish_transmission or not self.data_queue.empty()
+        with self._cond:
+            self.check_stop()
+            return not self.finish_transmission or bool(self._messages)
 
     def put(self, message):
-        while True:
-            try:
-                self.data_queue.put(message, timeout=1)
-                break
-            except queue.Full:
-                self.check_stop()
+        size = self._message_size(message)
+        with self._cond:
+            if self._full(size):
+                started = time.monotonic()
+                self._cond.wait_for(
+                    lambda: self.is_force_stop or not self._full(size))
+                self.put_wait_time += time.monotonic() - started
+            self.check_stop()
+            self._messages.append(message)
+            self._queued_bytes += size
+            self._cond.notify_all()
 
     def get_messages(self):
-        while self.has_more():
+        while True:
             try:
                 yield self.get()
             except Wait:
-                self.check_stop()
+                return
+
+    def stats(self):
+        """
+        :return: dict with the bytes and messages passed through the queue
+                 and the seconds producer and consumer waited on each other
+        """
+        with self._cond:
+            return {'bytes': self.bytes_passed,
+                    'messages': self.messages_passed,
+                    'put_wait_time': self.put_wait_time,
+                    'get_wait_time': self.get_wait_time}
+
+
+class SegmentAssembler(object):
+    """
+    Accumulates chunks of data and hands them back as segments.
+
+    The chunks are kept as they are and copied once, when a segment is
+    taken, instead of copying all the data accumulated so far on every
+    append as ``segment += chunk`` does.
+    """
+    def __init__(self):
+        self._chunks = collections.deque()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, data):
+        if data:
+            self._chunks.append(data)
+            self._size += len(data)
+
+    def take(self, size=None):
+        """
+        Remove a segment from the accumulated data.
+
+        :param size: maximum size of the segment, all the accumulated data
+                     if not set
+        :return: bytes of the segment
+        """
+        if size is None or size >= self._size:
+            chunks = self._chunks
+            self._chunks = collections.deque()
+            self._size = 0
+            return b''.join(chunks)
+
+        parts = []
+        remaining = size
+        while remaining:
+            chunk = self._chunks.popleft()
+            if len(chunk) > remaining:
+                # the rest of the chunk is referenced, not copied
+                view = memoryview(chunk)
+                parts.append(view[:remaining])
+                self._chunks.appendleft(view[remaining:])
+                remaining = 0
+            else:
+                parts.append(chunk)
+                remaining -= len(chunk)
+        self._size -= size
+        return b''.join(parts)
+
+
+class ChunkReader(object):
+    """
+    Reads a stream received by chunks, by byte counts.
+
+    The data read is released with its chunk, instead of being kept in a
+    buffer growing with the chunks received until the end of a read.
+    """
+    def __init__(self, chunks):
+        """
+        :param chunks: iterable of the bytes received
+        """
+        self._chunks = iter(chunks)
+        self._pending = collections.deque()
+
+    def read(self, size=-1):
+        """
+        Read the next bytes of the stream, up to the end of a chunk.
+
+        :param size: maximum number of bytes, up to the end of the chunk if
+                     negative
+        :return: memoryview of at least one byte
+        :raises StopIteration: at the end of the stream
+        """
+        while not self._pending:
+            chunk = next(self._chunks)
+            if chunk:
+                self._pending.append(memoryview(chunk))
+        data = self._pending.popleft()
+        if 0 <= size < len(data):
+            self._pending.appendleft(data[size:])
+            data = data[:size]
+        return data
+
+    def unread(self, data):
+        """Put back bytes read, they are returned by the next read."""
+        if data:
+            self._pending.appendleft(memoryview(data))
 
 
 class QueuedThread(threading.Thread):
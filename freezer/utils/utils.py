@@ -30,6 +30,7 @@ import time
 
 from distutils import spawn as distspawn
 from freezer.exceptions import utils
+from freezer.utils import streaming
 from functools import wraps
 from oslo_log import log
 
@@ -256,7 +257,7 @@ class ReSizeStream(object):
         self.stream = stream
         self.length = length
         self.chunk_size = chunk_size
-        self.reminder = bytes()
+        self.reminder = streaming.SegmentAssembler()
         self.transmitted = 0
 
     def __len__(self):
@@ -269,34 +270,21 @@ class ReSizeStream(object):
         LOG.debug("Transmitted {0} of {1}".format(self.transmitted,
                                                   self.length))
         chunk_size = self.chunk_size
-        if len(self.reminder) > chunk_size:
-            result = self.reminder[:chunk_size]
-            self.reminder = self.reminder[chunk_size:]
-            self.transmitted += len(result)
-            return result
-        else:
-            stop = False
-            while not stop and len(self.reminder) < chunk_size:
-                try:
-                    next_method = getattr(self.stream, 'next', None)
-                    if callable(next_method):
-                        self.reminder += self.stream.next()
-                    else:
-                        self.reminder += next(self.stream)
-                except StopIteration:
-                    stop = True
-            if stop:
-                result = self.reminder
-                if len(self.reminder) == 0:
-                    return
-                self.reminder = bytes()
-                self.transmitted += len(result)
-                return result
-            else:
-                result = self.reminder[:chunk_size]
-                self.reminder = self.reminder[chunk_size:]
-                self.transmitted += len(result)
-                return result
+        stop = False
+        while not stop and len(self.reminder) < chunk_size:
+            try:
+                next_method = getattr(self.stream, 'next', None)
+                if callable(next_method):
+                    self.reminder.append(self.stream.next())
+                else:
+                    self.reminder.append(next(self.stream))
+            except StopIteration:
+                stop = True
+        if not len(self.reminder):
+            return
+        result = self.reminder.take(chunk_size)
+        self.transmitted += len(result)
+        return result
 
     def read(self, chunk_size):
         self.chunk_size = chunk_size